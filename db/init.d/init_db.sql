@@ -25,8 +25,11 @@ create table if not exists physical_devices (
     properties jsonb not null default '{}'
 );
 
-create table if not exists physical_timeseries ( 
-    uid integer generated always as identity primary key,
+-- physical_timeseries is partitioned by month on ts. The partitions are
+-- created by create_physical_timeseries_partitions, which the logical mapper
+-- calls periodically to keep partitions ahead of the incoming messages.
+create table if not exists physical_timeseries (
+    uid integer generated always as identity,
     physical_uid integer not null references physical_devices(uid),
     -- The logical_uid will be null for messages from unmapped devices. This is ok.
     logical_uid integer,
@@ -34,9 +37,294 @@ create table if not exists physical_timeseries (
     ts timestamptz not null,
     ts_delta interval,
     -- The message is stored in the brokers format as a JSONB object.
-    json_msg jsonb not null
+    json_msg jsonb not null,
+    -- The partition key must be part of the primary key.
+    primary key (uid, ts)
+) partition by range (ts);
+
+-- Indexes created on the partitioned table are created on every partition.
+create index if not exists pts_logical_uid_ts_idx on physical_timeseries (logical_uid, ts);
+create index if not exists pts_physical_uid_ts_idx on physical_timeseries (physical_uid, ts);
+
+-- Catches messages with timestamps outside the range of the monthly partitions.
+create table if not exists physical_timeseries_default partition of physical_timeseries default;
+
+create or replace function update_physical_timeseries_ts_delta()
+returns trigger as $$
+begin
+  NEW.ts_delta = NEW.received_at - NEW.ts;
+  return NEW;
+end;
+$$ language plpgsql;
+
+create trigger update_physical_timeseries_ts_delta_trigger
+before insert or update on physical_timeseries
+for each row
+execute function update_physical_timeseries_ts_delta();
+
+-- The names of the values in the timeseries arrays of messages, so timeseries_values
+-- rows can refer to them by number.
+create table if not exists timeseries_variables (
+    uid integer generated always as identity primary key,
+    name text not null unique
+);
+
+-- The numeric values from the timeseries arrays of the physical_timeseries messages,
+-- one row per value, so a variable's series can be read without reading json_msg.
+-- Rows are added by a trigger on physical_timeseries, and by backfill_timeseries_values
+-- for messages that were stored before this table existed.
+--
+-- There is no foreign key to physical_timeseries because creating a partition moves
+-- rows out of the default partition, which would cascade to these rows.
+create table if not exists timeseries_values (
+    pts_uid integer not null,
+    physical_uid integer not null,
+    logical_uid integer,
+    ts timestamptz not null,
+    variable_uid integer not null,
+    value double precision not null,
+    primary key (pts_uid, variable_uid, ts)
+) partition by range (ts);
+
+-- The value column is included so series queries are satisfied from the index alone.
+create index if not exists tsv_variable_logical_uid_ts_idx on timeseries_values (variable_uid, logical_uid, ts) include (value);
+create index if not exists tsv_variable_physical_uid_ts_idx on timeseries_values (variable_uid, physical_uid, ts) include (value);
+
+create table if not exists timeseries_values_default partition of timeseries_values default;
+
+-- The numeric values in a message's timeseries array.
+create or replace function message_timeseries_values(msg jsonb)
+returns table (name text, value double precision) as $$
+  select e->>'name', (e->>'value')::double precision
+    from jsonb_array_elements(case when jsonb_typeof(msg->'timeseries') = 'array' then msg->'timeseries' else '[]'::jsonb end) as e
+   where e->>'name' is not null
+     and jsonb_typeof(e->'value') = 'number'
+$$ language sql immutable;
+
+-- Adds the values of the messages inserted by a statement to timeseries_values. A
+-- statement level trigger handles a whole COPY or multi-row insert with two inserts.
+create or replace function insert_timeseries_values()
+returns trigger as $$
+begin
+  insert into timeseries_variables (name)
+  select distinct v.name
+    from new_rows r cross join message_timeseries_values(r.json_msg) v
+   where not exists (select 1 from timeseries_variables tv where tv.name = v.name)
+  on conflict (name) do nothing;
+
+  insert into timeseries_values (pts_uid, physical_uid, logical_uid, ts, variable_uid, value)
+  select r.uid, r.physical_uid, r.logical_uid, r.ts, tv.uid, v.value
+    from new_rows r
+    cross join message_timeseries_values(r.json_msg) v
+    join timeseries_variables tv on tv.name = v.name
+  on conflict do nothing;
+
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger insert_timeseries_values_trigger
+after insert on physical_timeseries
+referencing new table as new_rows
+for each statement
+execute function insert_timeseries_values();
+
+-- The physical_timeseries rows with uids up to next_uid may not have had their
+-- values added to timeseries_values yet.
+create table if not exists timeseries_values_backfill_state (
+    next_uid integer not null
+);
+
+-- Adds the values of up to max_uids of the messages stored before the
+-- insert_timeseries_values_trigger existed to timeseries_values, newest first.
+-- Returns the number of uids covered, which is 0 once the backfill is complete.
+create or replace function backfill_timeseries_values(max_uids integer)
+returns integer as $$
+declare
+  upper_uid integer;
+  lower_uid integer;
+begin
+  select next_uid into upper_uid from timeseries_values_backfill_state for update;
+  if upper_uid is null or upper_uid < 1 then
+    return 0;
+  end if;
+
+  lower_uid := greatest(upper_uid - max_uids, 0);
+
+  insert into timeseries_variables (name)
+  select distinct v.name
+    from physical_timeseries r cross join message_timeseries_values(r.json_msg) v
+   where r.uid > lower_uid and r.uid <= upper_uid
+     and not exists (select 1 from timeseries_variables tv where tv.name = v.name)
+  on conflict (name) do nothing;
+
+  insert into timeseries_values (pts_uid, physical_uid, logical_uid, ts, variable_uid, value)
+  select r.uid, r.physical_uid, r.logical_uid, r.ts, tv.uid, v.value
+    from physical_timeseries r
+    cross join message_timeseries_values(r.json_msg) v
+    join timeseries_variables tv on tv.name = v.name
+   where r.uid > lower_uid and r.uid <= upper_uid
+  on conflict do nothing;
+
+  update timeseries_values_backfill_state set next_uid = lower_uid;
+
+  return upper_uid - lower_uid;
+end;
+$$ language plpgsql;
+
+insert into timeseries_values_backfill_state values (0);
+
+-- Creates the partition of the parent table for the month starting at
+-- month_start, if it does not already exist. Returns true if the partition was
+-- created. The parent must be partitioned by range on a ts column, and have a
+-- default partition named <parent>_default.
+--
+-- Rows that arrived before a month's partition was created are in the default
+-- partition. They are moved into the new partition before it is attached
+-- because a partition cannot be attached while the default partition holds
+-- rows belonging to it.
+create or replace function create_monthly_partition(parent text, month_start timestamp)
+returns boolean as $$
+declare
+  part_name text := parent || '_' || to_char(month_start, 'YYYY_MM');
+  from_ts timestamptz := month_start at time zone 'UTC';
+  to_ts timestamptz := (month_start + interval '1 month') at time zone 'UTC';
+begin
+  if to_regclass(part_name) is not null then
+    return false;
+  end if;
+
+  execute format('create table %I (like %I including defaults including constraints)', part_name, parent);
+
+  execute format('with moved as (delete from %I where ts >= %L and ts < %L returning *) insert into %I select * from moved',
+    parent || '_default', from_ts, to_ts, part_name);
+
+  execute format('alter table %I attach partition %I for values from (%L) to (%L)', parent, part_name, from_ts, to_ts);
+
+  return true;
+end;
+$$ language plpgsql;
+
+-- Creates the monthly partitions of physical_timeseries and timeseries_values
+-- for every month from start_ts to end_ts inclusive, if they do not already
+-- exist. Returns the number of partitions created.
+create or replace function create_physical_timeseries_partitions(start_ts timestamptz, end_ts timestamptz)
+returns integer as $$
+declare
+  month_start timestamp;
+  last_month timestamp;
+  created integer := 0;
+begin
+  month_start := date_trunc('month', start_ts at time zone 'UTC');
+  last_month := date_trunc('month', end_ts at time zone 'UTC');
+
+  while month_start <= last_month loop
+    if create_monthly_partition('physical_timeseries', month_start) then
+      created := created + 1;
+    end if;
+
+    if create_monthly_partition('timeseries_values', month_start) then
+      created := created + 1;
+    end if;
+
+    month_start := month_start + interval '1 month';
+  end loop;
+
+  return created;
+end;
+$$ language plpgsql;
+
+select create_physical_timeseries_partitions(now(), now() + interval '3 months');
+
+-- Hourly and daily aggregates of the numeric values in the timeseries arrays of
+-- physical_timeseries messages, per logical device and value name. The buckets
+-- are UTC hours and days. The average is sum / count.
+create table if not exists timeseries_rollup_hourly (
+    logical_uid integer not null,
+    name text not null,
+    bucket timestamptz not null,
+    count bigint not null,
+    sum double precision not null,
+    min double precision not null,
+    max double precision not null,
+    primary key (logical_uid, name, bucket)
+);
+
+create table if not exists timeseries_rollup_daily (
+    logical_uid integer not null,
+    name text not null,
+    bucket timestamptz not null,
+    count bigint not null,
+    sum double precision not null,
+    min double precision not null,
+    max double precision not null,
+    primary key (logical_uid, name, bucket)
 );
 
+-- The physical_timeseries rows with uids up to high_water_uid have been added to
+-- the rollups. next_high_water_uid is the largest uid when the rollups were last
+-- updated. Rows with uids below it may not have been committed at that time, but
+-- will have been by the next update, so that update can safely add them.
+create table if not exists timeseries_rollup_state (
+    high_water_uid integer not null,
+    next_high_water_uid integer not null
+);
+
+insert into timeseries_rollup_state select 0, 0 where not exists (select 1 from timeseries_rollup_state);
+
+-- Adds the physical_timeseries rows inserted since the last call to the rollup
+-- tables, covering at most max_uids uids. Returns the number of uids covered, so
+-- a value of max_uids means there may be more rows to add.
+create or replace function update_timeseries_rollups(max_uids integer)
+returns integer as $$
+declare
+  hwm integer;
+  next_hwm integer;
+  upper_uid integer;
+begin
+  -- Locking the state row makes concurrent callers take turns.
+  select high_water_uid, next_high_water_uid into hwm, next_hwm from timeseries_rollup_state for update;
+  upper_uid := least(next_hwm, hwm + max_uids);
+
+  if upper_uid > hwm then
+    with new_values as (
+      select pt.logical_uid, e->>'name' as name, (e->>'value')::double precision as value, pt.ts
+        from physical_timeseries pt
+        cross join jsonb_array_elements(case when jsonb_typeof(pt.json_msg->'timeseries') = 'array' then pt.json_msg->'timeseries' else '[]'::jsonb end) as e
+       where pt.uid > hwm and pt.uid <= upper_uid
+         and pt.logical_uid is not null
+         and e->>'name' is not null
+         and jsonb_typeof(e->'value') = 'number'
+    ),
+    hourly as (
+      select logical_uid, name, date_trunc('hour', ts, 'UTC') as bucket, count(*) as count, sum(value) as sum, min(value) as min, max(value) as max
+        from new_values
+       group by 1, 2, 3
+    ),
+    hourly_upsert as (
+      insert into timeseries_rollup_hourly as r
+      select * from hourly
+      on conflict (logical_uid, name, bucket) do update
+         set count = r.count + excluded.count, sum = r.sum + excluded.sum, min = least(r.min, excluded.min), max = greatest(r.max, excluded.max)
+    )
+    insert into timeseries_rollup_daily as r
+    select logical_uid, name, date_trunc('day', bucket, 'UTC'), sum(count), sum(sum), min(min), max(max)
+      from hourly
+     group by 1, 2, 3
+    on conflict (logical_uid, name, bucket) do update
+       set count = r.count + excluded.count, sum = r.sum + excluded.sum, min = least(r.min, excluded.min), max = greatest(r.max, excluded.max);
+  end if;
+
+  if upper_uid >= next_hwm then
+    select coalesce(max(uid), next_hwm) into next_hwm from physical_timeseries;
+  end if;
+
+  update timeseries_rollup_state set high_water_uid = greatest(hwm, upper_uid), next_high_water_uid = next_hwm;
+
+  return greatest(upper_uid - hwm, 0);
+end;
+$$ language plpgsql;
+
 create table if not exists raw_messages (
     uid integer generated always as identity primary key,
     source_name text not null references sources,
@@ -103,11 +391,82 @@ create table if not exists users (
     read_only boolean default True not null
 );
 
+-- Requests are authenticated by looking up their token.
+create unique index if not exists users_auth_token_idx on users (auth_token);
+
+-- Notifications on the user_changes channel let processes caching users by
+-- their authentication tokens invalidate their caches.
+create or replace function notify_user_change()
+returns trigger as $$
+begin
+  perform pg_notify('user_changes', json_build_object('uid', OLD.uid)::text);
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger users_notify_trigger
+after update or delete on users
+for each row
+execute function notify_user_change();
+
 create table if not exists version (
     version integer not null
 );
 
 create index if not exists pd_src_id_idx on physical_devices using GIN (source_ids);
 
+-- Notifications on the device_changes channel let processes caching devices
+-- and mappings invalidate their caches.
+create or replace function notify_device_change()
+returns trigger as $$
+declare
+  r record;
+begin
+  if TG_OP = 'DELETE' then
+    r := OLD;
+  else
+    r := NEW;
+  end if;
+
+  if TG_TABLE_NAME = 'physical_logical_map' then
+    perform pg_notify('device_changes', json_build_object('table', TG_TABLE_NAME, 'physical_uid', r.physical_uid, 'logical_uid', r.logical_uid)::text);
+  else
+    perform pg_notify('device_changes', json_build_object('table', TG_TABLE_NAME, 'uid', r.uid)::text);
+  end if;
+
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger physical_logical_map_notify_trigger
+after insert or update or delete on physical_logical_map
+for each row
+execute function notify_device_change();
+
+create trigger physical_devices_notify_trigger
+after insert or delete on physical_devices
+for each row
+execute function notify_device_change();
+
+-- last_seen changes with every message, so do not notify for that alone.
+create trigger physical_devices_update_notify_trigger
+after update on physical_devices
+for each row
+when ((to_jsonb(OLD) - 'last_seen') is distinct from (to_jsonb(NEW) - 'last_seen'))
+execute function notify_device_change();
+
+create trigger logical_devices_notify_trigger
+after insert or delete on logical_devices
+for each row
+execute function notify_device_change();
+
+-- The logical mapper updates last_seen and the last_msg property with every
+-- message, so do not notify for those alone.
+create trigger logical_devices_update_notify_trigger
+after update on logical_devices
+for each row
+when (((to_jsonb(OLD) - 'last_seen') #- '{properties,last_msg}') is distinct from ((to_jsonb(NEW) - 'last_seen') #- '{properties,last_msg}'))
+execute function notify_device_change();
+
 insert into sources values ('ttn'), ('greenbrain'), ('wombat'), ('ydoc'), ('ict_eagleio'), ('dragino_json'), ('ict_mqtt');
-insert into version values (2);
+insert into version values (7);
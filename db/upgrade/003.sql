@@ -0,0 +1,99 @@
+-- Upgrade to version 3: convert physical_timeseries to a table partitioned
+-- by month on ts, with indexes supporting the queries made for the
+-- /messages endpoint.
+--
+-- The existing rows are copied into the new table, so this can take some time
+-- on a large database. Stop the logical mapper before running it.
+
+begin;
+
+-- Creates a monthly partition of physical_timeseries for every month from
+-- start_ts to end_ts inclusive, if the partition does not already exist.
+-- Returns the number of partitions created.
+--
+-- Rows that arrived before a month's partition was created are in the default
+-- partition. They are moved into the new partition before it is attached
+-- because a partition cannot be attached while the default partition holds
+-- rows belonging to it.
+create or replace function create_physical_timeseries_partitions(start_ts timestamptz, end_ts timestamptz)
+returns integer as $$
+declare
+  month_start timestamp;
+  last_month timestamp;
+  part_name text;
+  created integer := 0;
+begin
+  month_start := date_trunc('month', start_ts at time zone 'UTC');
+  last_month := date_trunc('month', end_ts at time zone 'UTC');
+
+  while month_start <= last_month loop
+    part_name := 'physical_timeseries_' || to_char(month_start, 'YYYY_MM');
+
+    if to_regclass(part_name) is null then
+      execute format('create table %I (like physical_timeseries including defaults including constraints)', part_name);
+
+      execute format('with moved as (delete from physical_timeseries_default where ts >= %L and ts < %L returning *) insert into %I select * from moved',
+        month_start at time zone 'UTC', (month_start + interval '1 month') at time zone 'UTC', part_name);
+
+      execute format('alter table physical_timeseries attach partition %I for values from (%L) to (%L)',
+        part_name, month_start at time zone 'UTC', (month_start + interval '1 month') at time zone 'UTC');
+
+      created := created + 1;
+    end if;
+
+    month_start := month_start + interval '1 month';
+  end loop;
+
+  return created;
+end;
+$$ language plpgsql;
+
+alter table physical_timeseries rename to physical_timeseries_old;
+drop trigger if exists update_physical_timeseries_ts_delta_trigger on physical_timeseries_old;
+
+create table physical_timeseries (
+    uid integer generated always as identity,
+    physical_uid integer not null references physical_devices(uid),
+    -- The logical_uid will be null for messages from unmapped devices. This is ok.
+    logical_uid integer,
+    received_at timestamptz not null default now(),
+    ts timestamptz not null,
+    ts_delta interval,
+    -- The message is stored in the brokers format as a JSONB object.
+    json_msg jsonb not null,
+    -- The partition key must be part of the primary key.
+    primary key (uid, ts)
+) partition by range (ts);
+
+-- Indexes created on the partitioned table are created on every partition,
+-- including partitions created or attached later.
+create index if not exists pts_logical_uid_ts_idx on physical_timeseries (logical_uid, ts);
+create index if not exists pts_physical_uid_ts_idx on physical_timeseries (physical_uid, ts);
+
+-- Catches messages with timestamps outside the range of the monthly partitions,
+-- such as those from devices with unset clocks.
+create table if not exists physical_timeseries_default partition of physical_timeseries default;
+
+create trigger update_physical_timeseries_ts_delta_trigger
+before insert or update on physical_timeseries
+for each row
+execute function update_physical_timeseries_ts_delta();
+
+-- Create the partitions for the existing rows, ignoring rows with timestamps that
+-- are obviously wrong; those will go to the default partition. Then create the
+-- partitions for the next few months.
+select create_physical_timeseries_partitions(
+    coalesce((select min(ts) from physical_timeseries_old where ts >= '2000-01-01T00:00:00Z'), now()),
+    now() + interval '3 months');
+
+insert into physical_timeseries (uid, physical_uid, logical_uid, received_at, ts, ts_delta, json_msg) overriding system value
+    select uid, physical_uid, logical_uid, coalesce(received_at, ts), ts, ts_delta, json_msg from physical_timeseries_old;
+
+select setval(pg_get_serial_sequence('physical_timeseries', 'uid'), coalesce((select max(uid) from physical_timeseries), 0) + 1, false);
+
+drop table physical_timeseries_old;
+
+TRUNCATE version;
+insert into version values (3);
+
+commit;
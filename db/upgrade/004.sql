@@ -0,0 +1,61 @@
+-- Upgrade to version 4: send notifications on the device_changes channel when
+-- devices or mappings change, so processes caching them can invalidate their
+-- caches.
+
+begin;
+
+create or replace function notify_device_change()
+returns trigger as $$
+declare
+  r record;
+begin
+  if TG_OP = 'DELETE' then
+    r := OLD;
+  else
+    r := NEW;
+  end if;
+
+  if TG_TABLE_NAME = 'physical_logical_map' then
+    perform pg_notify('device_changes', json_build_object('table', TG_TABLE_NAME, 'physical_uid', r.physical_uid, 'logical_uid', r.logical_uid)::text);
+  else
+    perform pg_notify('device_changes', json_build_object('table', TG_TABLE_NAME, 'uid', r.uid)::text);
+  end if;
+
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger physical_logical_map_notify_trigger
+after insert or update or delete on physical_logical_map
+for each row
+execute function notify_device_change();
+
+create trigger physical_devices_notify_trigger
+after insert or delete on physical_devices
+for each row
+execute function notify_device_change();
+
+-- last_seen changes with every message, so do not notify for that alone.
+create trigger physical_devices_update_notify_trigger
+after update on physical_devices
+for each row
+when ((to_jsonb(OLD) - 'last_seen') is distinct from (to_jsonb(NEW) - 'last_seen'))
+execute function notify_device_change();
+
+create trigger logical_devices_notify_trigger
+after insert or delete on logical_devices
+for each row
+execute function notify_device_change();
+
+-- The logical mapper updates last_seen and the last_msg property with every
+-- message, so do not notify for those alone.
+create trigger logical_devices_update_notify_trigger
+after update on logical_devices
+for each row
+when (((to_jsonb(OLD) - 'last_seen') #- '{properties,last_msg}') is distinct from ((to_jsonb(NEW) - 'last_seen') #- '{properties,last_msg}'))
+execute function notify_device_change();
+
+TRUNCATE version;
+insert into version values (4);
+
+commit;
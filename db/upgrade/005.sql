@@ -0,0 +1,99 @@
+-- Upgrade to version 5: hourly and daily rollups of the timeseries values in
+-- physical_timeseries. The rollups are filled by update_timeseries_rollups(),
+-- starting from the oldest message, when the logical mapper next runs.
+
+begin;
+
+-- Hourly and daily aggregates of the numeric values in the timeseries arrays of
+-- physical_timeseries messages, per logical device and value name. The buckets
+-- are UTC hours and days. The average is sum / count.
+create table if not exists timeseries_rollup_hourly (
+    logical_uid integer not null,
+    name text not null,
+    bucket timestamptz not null,
+    count bigint not null,
+    sum double precision not null,
+    min double precision not null,
+    max double precision not null,
+    primary key (logical_uid, name, bucket)
+);
+
+create table if not exists timeseries_rollup_daily (
+    logical_uid integer not null,
+    name text not null,
+    bucket timestamptz not null,
+    count bigint not null,
+    sum double precision not null,
+    min double precision not null,
+    max double precision not null,
+    primary key (logical_uid, name, bucket)
+);
+
+-- The physical_timeseries rows with uids up to high_water_uid have been added to
+-- the rollups. next_high_water_uid is the largest uid when the rollups were last
+-- updated. Rows with uids below it may not have been committed at that time, but
+-- will have been by the next update, so that update can safely add them.
+create table if not exists timeseries_rollup_state (
+    high_water_uid integer not null,
+    next_high_water_uid integer not null
+);
+
+insert into timeseries_rollup_state select 0, 0 where not exists (select 1 from timeseries_rollup_state);
+
+-- Adds the physical_timeseries rows inserted since the last call to the rollup
+-- tables, covering at most max_uids uids. Returns the number of uids covered, so
+-- a value of max_uids means there may be more rows to add.
+create or replace function update_timeseries_rollups(max_uids integer)
+returns integer as $$
+declare
+  hwm integer;
+  next_hwm integer;
+  upper_uid integer;
+begin
+  -- Locking the state row makes concurrent callers take turns.
+  select high_water_uid, next_high_water_uid into hwm, next_hwm from timeseries_rollup_state for update;
+  upper_uid := least(next_hwm, hwm + max_uids);
+
+  if upper_uid > hwm then
+    with new_values as (
+      select pt.logical_uid, e->>'name' as name, (e->>'value')::double precision as value, pt.ts
+        from physical_timeseries pt
+        cross join jsonb_array_elements(case when jsonb_typeof(pt.json_msg->'timeseries') = 'array' then pt.json_msg->'timeseries' else '[]'::jsonb end) as e
+       where pt.uid > hwm and pt.uid <= upper_uid
+         and pt.logical_uid is not null
+         and e->>'name' is not null
+         and jsonb_typeof(e->'value') = 'number'
+    ),
+    hourly as (
+      select logical_uid, name, date_trunc('hour', ts, 'UTC') as bucket, count(*) as count, sum(value) as sum, min(value) as min, max(value) as max
+        from new_values
+       group by 1, 2, 3
+    ),
+    hourly_upsert as (
+      insert into timeseries_rollup_hourly as r
+      select * from hourly
+      on conflict (logical_uid, name, bucket) do update
+         set count = r.count + excluded.count, sum = r.sum + excluded.sum, min = least(r.min, excluded.min), max = greatest(r.max, excluded.max)
+    )
+    insert into timeseries_rollup_daily as r
+    select logical_uid, name, date_trunc('day', bucket, 'UTC'), sum(count), sum(sum), min(min), max(max)
+      from hourly
+     group by 1, 2, 3
+    on conflict (logical_uid, name, bucket) do update
+       set count = r.count + excluded.count, sum = r.sum + excluded.sum, min = least(r.min, excluded.min), max = greatest(r.max, excluded.max);
+  end if;
+
+  if upper_uid >= next_hwm then
+    select coalesce(max(uid), next_hwm) into next_hwm from physical_timeseries;
+  end if;
+
+  update timeseries_rollup_state set high_water_uid = greatest(hwm, upper_uid), next_high_water_uid = next_hwm;
+
+  return greatest(upper_uid - hwm, 0);
+end;
+$$ language plpgsql;
+
+TRUNCATE version;
+insert into version values (5);
+
+commit;
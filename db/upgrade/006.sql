@@ -0,0 +1,187 @@
+-- Upgrade to version 6: store the numeric timeseries values of messages in the
+-- narrow timeseries_values table, with the value names in timeseries_variables.
+-- New messages are added by a trigger. Existing messages are added by
+-- backfill_timeseries_values(), which the logical mapper runs in the background.
+
+begin;
+
+-- The names of the values in the timeseries arrays of messages, so timeseries_values
+-- rows can refer to them by number.
+create table if not exists timeseries_variables (
+    uid integer generated always as identity primary key,
+    name text not null unique
+);
+
+-- The numeric values from the timeseries arrays of the physical_timeseries messages,
+-- one row per value, so a variable's series can be read without reading json_msg.
+-- Rows are added by a trigger on physical_timeseries, and by backfill_timeseries_values
+-- for messages that were stored before this table existed.
+--
+-- There is no foreign key to physical_timeseries because creating a partition moves
+-- rows out of the default partition, which would cascade to these rows.
+create table if not exists timeseries_values (
+    pts_uid integer not null,
+    physical_uid integer not null,
+    logical_uid integer,
+    ts timestamptz not null,
+    variable_uid integer not null,
+    value double precision not null,
+    primary key (pts_uid, variable_uid, ts)
+) partition by range (ts);
+
+-- The value column is included so series queries are satisfied from the index alone.
+create index if not exists tsv_variable_logical_uid_ts_idx on timeseries_values (variable_uid, logical_uid, ts) include (value);
+create index if not exists tsv_variable_physical_uid_ts_idx on timeseries_values (variable_uid, physical_uid, ts) include (value);
+
+create table if not exists timeseries_values_default partition of timeseries_values default;
+
+-- The numeric values in a message's timeseries array.
+create or replace function message_timeseries_values(msg jsonb)
+returns table (name text, value double precision) as $$
+  select e->>'name', (e->>'value')::double precision
+    from jsonb_array_elements(case when jsonb_typeof(msg->'timeseries') = 'array' then msg->'timeseries' else '[]'::jsonb end) as e
+   where e->>'name' is not null
+     and jsonb_typeof(e->'value') = 'number'
+$$ language sql immutable;
+
+-- Adds the values of the messages inserted by a statement to timeseries_values. A
+-- statement level trigger handles a whole COPY or multi-row insert with two inserts.
+create or replace function insert_timeseries_values()
+returns trigger as $$
+begin
+  insert into timeseries_variables (name)
+  select distinct v.name
+    from new_rows r cross join message_timeseries_values(r.json_msg) v
+   where not exists (select 1 from timeseries_variables tv where tv.name = v.name)
+  on conflict (name) do nothing;
+
+  insert into timeseries_values (pts_uid, physical_uid, logical_uid, ts, variable_uid, value)
+  select r.uid, r.physical_uid, r.logical_uid, r.ts, tv.uid, v.value
+    from new_rows r
+    cross join message_timeseries_values(r.json_msg) v
+    join timeseries_variables tv on tv.name = v.name
+  on conflict do nothing;
+
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger insert_timeseries_values_trigger
+after insert on physical_timeseries
+referencing new table as new_rows
+for each statement
+execute function insert_timeseries_values();
+
+-- The physical_timeseries rows with uids up to next_uid may not have had their
+-- values added to timeseries_values yet.
+create table if not exists timeseries_values_backfill_state (
+    next_uid integer not null
+);
+
+-- Adds the values of up to max_uids of the messages stored before the
+-- insert_timeseries_values_trigger existed to timeseries_values, newest first.
+-- Returns the number of uids covered, which is 0 once the backfill is complete.
+create or replace function backfill_timeseries_values(max_uids integer)
+returns integer as $$
+declare
+  upper_uid integer;
+  lower_uid integer;
+begin
+  select next_uid into upper_uid from timeseries_values_backfill_state for update;
+  if upper_uid is null or upper_uid < 1 then
+    return 0;
+  end if;
+
+  lower_uid := greatest(upper_uid - max_uids, 0);
+
+  insert into timeseries_variables (name)
+  select distinct v.name
+    from physical_timeseries r cross join message_timeseries_values(r.json_msg) v
+   where r.uid > lower_uid and r.uid <= upper_uid
+     and not exists (select 1 from timeseries_variables tv where tv.name = v.name)
+  on conflict (name) do nothing;
+
+  insert into timeseries_values (pts_uid, physical_uid, logical_uid, ts, variable_uid, value)
+  select r.uid, r.physical_uid, r.logical_uid, r.ts, tv.uid, v.value
+    from physical_timeseries r
+    cross join message_timeseries_values(r.json_msg) v
+    join timeseries_variables tv on tv.name = v.name
+   where r.uid > lower_uid and r.uid <= upper_uid
+  on conflict do nothing;
+
+  update timeseries_values_backfill_state set next_uid = lower_uid;
+
+  return upper_uid - lower_uid;
+end;
+$$ language plpgsql;
+
+-- Messages stored before the trigger was created need backfilling. Creating the trigger
+-- waited for any inserts in progress, so every message up to the current uid is visible.
+insert into timeseries_values_backfill_state select coalesce(max(uid), 0) from physical_timeseries;
+
+-- Creates the partition of the parent table for the month starting at
+-- month_start, if it does not already exist. Returns true if the partition was
+-- created. The parent must be partitioned by range on a ts column, and have a
+-- default partition named <parent>_default.
+--
+-- Rows that arrived before a month's partition was created are in the default
+-- partition. They are moved into the new partition before it is attached
+-- because a partition cannot be attached while the default partition holds
+-- rows belonging to it.
+create or replace function create_monthly_partition(parent text, month_start timestamp)
+returns boolean as $$
+declare
+  part_name text := parent || '_' || to_char(month_start, 'YYYY_MM');
+  from_ts timestamptz := month_start at time zone 'UTC';
+  to_ts timestamptz := (month_start + interval '1 month') at time zone 'UTC';
+begin
+  if to_regclass(part_name) is not null then
+    return false;
+  end if;
+
+  execute format('create table %I (like %I including defaults including constraints)', part_name, parent);
+
+  execute format('with moved as (delete from %I where ts >= %L and ts < %L returning *) insert into %I select * from moved',
+    parent || '_default', from_ts, to_ts, part_name);
+
+  execute format('alter table %I attach partition %I for values from (%L) to (%L)', parent, part_name, from_ts, to_ts);
+
+  return true;
+end;
+$$ language plpgsql;
+
+-- Creates the monthly partitions of physical_timeseries and timeseries_values
+-- for every month from start_ts to end_ts inclusive, if they do not already
+-- exist. Returns the number of partitions created.
+create or replace function create_physical_timeseries_partitions(start_ts timestamptz, end_ts timestamptz)
+returns integer as $$
+declare
+  month_start timestamp;
+  last_month timestamp;
+  created integer := 0;
+begin
+  month_start := date_trunc('month', start_ts at time zone 'UTC');
+  last_month := date_trunc('month', end_ts at time zone 'UTC');
+
+  while month_start <= last_month loop
+    if create_monthly_partition('physical_timeseries', month_start) then
+      created := created + 1;
+    end if;
+
+    if create_monthly_partition('timeseries_values', month_start) then
+      created := created + 1;
+    end if;
+
+    month_start := month_start + interval '1 month';
+  end loop;
+
+  return created;
+end;
+$$ language plpgsql;
+
+select create_physical_timeseries_partitions(coalesce((select min(ts) from physical_timeseries where ts >= '2000-01-01'), now()), now() + interval '3 months');
+
+TRUNCATE version;
+insert into version values (6);
+
+commit;
@@ -0,0 +1,28 @@
+-- Upgrade to version 7: index users by authentication token, and send
+-- notifications on the user_changes channel when users change so the REST API
+-- can cache users by token.
+
+begin;
+
+-- Requests are authenticated by looking up their token.
+create unique index if not exists users_auth_token_idx on users (auth_token);
+
+-- Notifications on the user_changes channel let processes caching users by
+-- their authentication tokens invalidate their caches.
+create or replace function notify_user_change()
+returns trigger as $$
+begin
+  perform pg_notify('user_changes', json_build_object('uid', OLD.uid)::text);
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger users_notify_trigger
+after update or delete on users
+for each row
+execute function notify_user_change();
+
+TRUNCATE version;
+insert into version values (7);
+
+commit;
@@ -7,6 +7,9 @@ TIMESTAMP_KEY = 'timestamp'
 TIMESERIES_KEY = 'timeseries'
 LAST_MSG = 'last_msg'
 
+# The logical device property holding its delivery policy, see delivery.DeliveryPolicies.
+DELIVERY_POLICY_KEY = 'delivery_policy'
+
 # Source names
 TTN = 'ttn'
 GREENBRAIN = 'greenbrain'
@@ -23,4 +26,8 @@ LAST_MESSAGE_HASH_KEY = 'last_message_hash'
 PHYSICAL_TIMESERIES_EXCHANGE_NAME = 'pts_exchange'
 LOGICAL_TIMESERIES_EXCHANGE_NAME = 'lts_exchange'
 
+# The AMQP header holding the uid of the physical_timeseries row a logical_timeseries
+# message was stored in.
+PHYSICAL_TIMESERIES_UID_HEADER = 'pts_uid'
+
 LOGGER_FORMAT='%(asctime)s|%(levelname)-7s|%(module)s|%(message)s'
@@ -0,0 +1,141 @@
+"""
+Awaitable versions of the DAO functions, for use by asyncio code such as the
+REST API.
+
+Calling the DAO functions directly from a coroutine blocks the event loop for
+the duration of every query, so only one request can be served at a time.
+The functions in this module have the same names and signatures as those in
+api.client.DAO, but run them on a dedicated thread pool and return awaitables,
+leaving the event loop free to serve other requests.
+
+The thread pool is the same size as the DAO connection pool so requests wait
+here, without holding a thread, rather than failing to get a connection.
+
+The DAO exception classes are re-exported so callers can use this module in
+place of api.client.DAO.
+"""
+
+import asyncio, functools, itertools, os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List
+
+import api.client.DAO as dao
+
+from api.client.DAO import DAOBusy, DAOException, DAODeviceNotFound, DAOUserNotFound, DAOUniqeConstraintException
+
+_executor = ThreadPoolExecutor(max_workers=dao.POOL_MAX_CONNECTIONS, thread_name_prefix='async_dao')
+
+# The functions that hash passwords spend most of their time in scrypt, so they run on
+# their own threads to avoid delaying queries while several users log in.
+_password_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PASSWORD_HASH_THREADS', '2')), thread_name_prefix='async_dao_pw')
+
+
+def _run_in_executor(fn: Callable[..., Any], executor: ThreadPoolExecutor = _executor) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    return wrapper
+
+
+async def stream_physical_timeseries_message(*args, **kwargs) -> AsyncIterator[Dict]:
+    """
+    Takes the same arguments as DAO.stream_physical_timeseries_message, and returns an async
+    iterator over the messages. The query is run and the first rows are read before this
+    returns, so query errors are raised here rather than part way through the iteration.
+    """
+    loop = asyncio.get_running_loop()
+    chunk_size = kwargs.get('itersize') or dao.STREAM_ITERSIZE
+
+    msgs = dao.stream_physical_timeseries_message(*args, **kwargs)
+    try:
+        first = await loop.run_in_executor(_executor, _next_chunk, msgs, chunk_size)
+    except BaseException:
+        await loop.run_in_executor(_executor, msgs.close)
+        raise
+
+    return _iterate_chunks(msgs, first, chunk_size)
+
+
+def _next_chunk(msgs: Iterator[Dict], chunk_size: int) -> List[Dict]:
+    return list(itertools.islice(msgs, chunk_size))
+
+
+async def _iterate_chunks(msgs: Iterator[Dict], chunk: List[Dict], chunk_size: int) -> AsyncIterator[Dict]:
+    loop = asyncio.get_running_loop()
+    try:
+        while len(chunk) > 0:
+            for msg in chunk:
+                yield msg
+
+            chunk = await loop.run_in_executor(_executor, _next_chunk, msgs, chunk_size)
+    finally:
+        # Closing the generator closes its connection.
+        await loop.run_in_executor(_executor, msgs.close)
+
+
+def stop() -> None:
+    _executor.shutdown(wait=True)
+    _password_executor.shutdown(wait=True)
+    dao.stop()
+
+
+# Physical device sources
+get_all_physical_sources = _run_in_executor(dao.get_all_physical_sources)
+add_physical_source = _run_in_executor(dao.add_physical_source)
+
+# Physical devices
+create_physical_device = _run_in_executor(dao.create_physical_device)
+get_physical_device = _run_in_executor(dao.get_physical_device)
+get_pyhsical_devices_using_source_ids = _run_in_executor(dao.get_pyhsical_devices_using_source_ids)
+get_all_physical_devices = _run_in_executor(dao.get_all_physical_devices)
+get_physical_devices_from_source = _run_in_executor(dao.get_physical_devices_from_source)
+get_physical_devices = _run_in_executor(dao.get_physical_devices)
+update_physical_device = _run_in_executor(dao.update_physical_device)
+delete_physical_device = _run_in_executor(dao.delete_physical_device)
+get_unmapped_physical_devices = _run_in_executor(dao.get_unmapped_physical_devices)
+
+# Physical device notes
+create_physical_device_note = _run_in_executor(dao.create_physical_device_note)
+get_physical_device_notes = _run_in_executor(dao.get_physical_device_notes)
+update_physical_device_note = _run_in_executor(dao.update_physical_device_note)
+delete_physical_device_note = _run_in_executor(dao.delete_physical_device_note)
+
+# Logical devices
+create_logical_device = _run_in_executor(dao.create_logical_device)
+get_logical_device = _run_in_executor(dao.get_logical_device)
+get_logical_devices = _run_in_executor(dao.get_logical_devices)
+update_logical_device = _run_in_executor(dao.update_logical_device)
+delete_logical_device = _run_in_executor(dao.delete_logical_device)
+
+# Mappings
+insert_mapping = _run_in_executor(dao.insert_mapping)
+end_mapping = _run_in_executor(dao.end_mapping)
+delete_mapping = _run_in_executor(dao.delete_mapping)
+toggle_device_mapping = _run_in_executor(dao.toggle_device_mapping)
+get_current_device_mapping = _run_in_executor(dao.get_current_device_mapping)
+get_logical_device_mappings = _run_in_executor(dao.get_logical_device_mappings)
+get_physical_device_mappings = _run_in_executor(dao.get_physical_device_mappings)
+get_all_current_mappings = _run_in_executor(dao.get_all_current_mappings)
+
+# Messages
+add_raw_json_message = _run_in_executor(dao.add_raw_json_message)
+add_raw_text_message = _run_in_executor(dao.add_raw_text_message)
+insert_physical_timeseries_message = _run_in_executor(dao.insert_physical_timeseries_message)
+insert_physical_timeseries_messages = _run_in_executor(dao.insert_physical_timeseries_messages)
+get_physical_timeseries_message = _run_in_executor(dao.get_physical_timeseries_message)
+get_timeseries_rollups = _run_in_executor(dao.get_timeseries_rollups)
+
+# Users and authentication
+user_add = _run_in_executor(dao.user_add, _password_executor)
+user_rm = _run_in_executor(dao.user_rm)
+user_set_read_only = _run_in_executor(dao.user_set_read_only)
+get_user = _run_in_executor(dao.get_user)
+user_ls = _run_in_executor(dao.user_ls)
+user_get_token = _run_in_executor(dao.user_get_token, _password_executor)
+token_is_valid = _run_in_executor(dao.token_is_valid)
+token_refresh = _run_in_executor(dao.token_refresh)
+user_change_password = _run_in_executor(dao.user_change_password, _password_executor)
+user_change_password_and_token = _run_in_executor(dao.user_change_password_and_token, _password_executor)
+token_disable = _run_in_executor(dao.token_disable)
+token_enable = _run_in_executor(dao.token_enable)
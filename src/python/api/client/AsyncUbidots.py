@@ -0,0 +1,140 @@
+"""
+Awaitable versions of the Ubidots client functions, for use by asyncio code.
+
+The functions in this module have the same names and signatures as those in
+api.client.Ubidots, and make their requests with an httpx.AsyncClient over a
+pool of keep-alive connections. They share the rate limiter and metrics of
+api.client.Ubidots, so sync and async callers in the same process together stay
+within the account's request quota.
+
+The client is created on first use, and belongs to the event loop that was
+running then. Call close() before that event loop finishes.
+"""
+
+import asyncio, logging, time
+from typing import List, Optional
+
+import httpx
+
+import api.client.Ubidots as ubidots
+from api.client.Ubidots import BASE_1_6, BASE_2_0, stats
+from pdmodels.Models import LogicalDevice
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+
+    if _client is None:
+        limits = httpx.Limits(max_connections=ubidots.POOL_SIZE, max_keepalive_connections=ubidots.POOL_SIZE)
+        _client = httpx.AsyncClient(headers=ubidots.headers, timeout=ubidots.TIMEOUT, limits=limits)
+
+    return _client
+
+
+async def _request(op: str, method: str, url: str, logging_ctx: Optional[dict] = None, **kwargs) -> Optional[httpx.Response]:
+    """
+    Make a rate limited request, retrying temporary failures. Returns the final response, or
+    None if no response was received.
+    """
+    attempt = 0
+    while True:
+        await ubidots.limiter.acquire_async()
+        response = None
+        err = None
+        start = time.monotonic()
+        try:
+            response = await _get_client().request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            err = e
+
+        if not ubidots._should_retry(op, attempt, start, response, err, logging_ctx):
+            if err is not None:
+                ubidots._log(logging.ERROR, f'{method} {url} failed: {err}', logging_ctx)
+            return response
+
+        await asyncio.sleep(ubidots._retry_delay(attempt, response))
+        attempt += 1
+
+
+async def close() -> None:
+    global _client
+
+    if _client is not None:
+        client = _client
+        _client = None
+        await client.aclose()
+
+
+async def get_all_devices() -> List[LogicalDevice]:
+    """
+    Returns every device in the account. The first page of devices is used to find how many
+    pages there are, and the rest are fetched concurrently.
+    """
+    async def get_page(page: int) -> Optional[dict]:
+        r = await _request('get_all_devices', 'GET', f'{BASE_2_0}/devices/', params={'page': page})
+        if r is None or r.status_code != 200:
+            if r is not None:
+                logging.warning(f'devices/ page {page} received response: {r.status_code}: {r.reason_phrase}')
+            return None
+
+        return r.json()
+
+    first = await get_page(1)
+    if first is None:
+        logging.warning('Returning before all devices were retrieved.')
+        return []
+
+    pages = [first]
+    page_count = ubidots._page_count(first)
+    if page_count is not None:
+        pages += await asyncio.gather(*[get_page(page) for page in range(2, page_count + 1)])
+    else:
+        while pages[-1] is not None and pages[-1]['next'] is not None:
+            pages.append(await get_page(len(pages) + 1))
+
+    devices = []
+    for response_obj in pages:
+        if response_obj is None:
+            logging.warning('Returning before all devices were retrieved.')
+            break
+
+        for u in response_obj['results']:
+            devices.append(ubidots._dict_to_logical_device(u))
+
+    return devices
+
+
+async def get_device(label: str, logging_ctx: dict) -> LogicalDevice:
+    url = f'{BASE_2_0}/devices/~{label}'
+    r = await _request('get_device', 'GET', url, logging_ctx)
+    if r is None or r.status_code != 200:
+        if r is not None:
+            ubidots._log(logging.ERROR, f'devices/~{label} received response: {r.status_code}: {r.reason_phrase}', logging_ctx)
+        return None
+
+    return ubidots._dict_to_logical_device(r.json())
+
+
+async def post_device_data(label: str, body: dict, logging_ctx: dict) -> bool:
+    """
+    Post timeseries data to an Ubidots device, see api.client.Ubidots.post_device_data.
+    """
+    url = f'{BASE_1_6}/devices/{label}'
+    r = await _request('post_device_data', 'POST', url, logging_ctx, json=body)
+    if r is None:
+        return False
+
+    if r.status_code != 200:
+        ubidots._log(logging.INFO, f'POST {url}: {r.status_code}: {r.reason_phrase}', logging_ctx)
+        return False
+
+    return True
+
+
+async def update_device(label: str, patch_obj: dict, logging_ctx: dict) -> None:
+    url = f'{BASE_2_0}/devices/~{label}'
+    r = await _request('update_device', 'PATCH', url, logging_ctx, json=patch_obj)
+    if r is not None and r.status_code != 200:
+        ubidots._log(logging.ERROR, f'PATCH response: {r.status_code}: {r.reason_phrase}', logging_ctx)
@@ -0,0 +1,287 @@
+"""
+A thread-safe psycopg2 connection pool that waits for a connection to become
+free rather than failing when all connections are in use.
+
+psycopg2's ThreadedConnectionPool raises PoolError as soon as maxconn
+connections are checked out, so a burst of requests produces errors instead of
+queueing. This pool blocks in getconn() for up to a timeout, and raises
+PoolTimeout, a PoolError subclass, if no connection becomes free in that time.
+
+Connections are recycled when they are older than max_age seconds, or when they
+are returned closed or in an unknown state. A connection that has been idle for
+more than check_after_idle seconds is tested with a trivial query before it is
+handed out. If that fails the database has probably restarted, so every idle
+connection is discarded and new connections are opened as required.
+
+stats() returns counters and gauges describing the pool's behaviour, such as
+how long callers waited for connections and how often the pool was exhausted.
+"""
+
+import logging, time
+from threading import Condition
+from typing import Any, Dict, List
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class _PooledConnection:
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    def __init__(self, min_conn: int = 1, max_conn: int = 5, timeout: float = 30.0, max_age: float = 3600.0, check_after_idle: float = 30.0, *args, **kwargs) -> None:
+        """
+        min_conn: the number of connections opened when the pool is created.
+        max_conn: the maximum number of connections the pool will have open at once.
+        timeout: the default number of seconds getconn() waits for a free connection.
+        max_age: connections are closed rather than reused once they are this many seconds old.
+        check_after_idle: connections idle for longer than this many seconds are tested before use.
+
+        Any other arguments are passed to psycopg2.connect().
+        """
+        if min_conn < 0 or max_conn < 1 or min_conn > max_conn:
+            raise ValueError(f'Invalid connection pool size: min {min_conn}, max {max_conn}.')
+
+        self.min_conn = min_conn
+        self.max_conn = max_conn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_after_idle = check_after_idle
+
+        self._args = args
+        self._kwargs = kwargs
+
+        self._cond = Condition()
+        self._closed = False
+
+        # Most recently used last, so the connections that are reused are the ones least
+        # likely to need a health check.
+        self._idle: List[_PooledConnection] = []
+        self._in_use: Dict[int, _PooledConnection] = {}
+
+        # Connections being opened or checked by getconn(), counted against max_conn.
+        self._pending = 0
+
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._exhausted = 0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._failed_checks = 0
+
+        for _ in range(min_conn):
+            self._idle.append(self._connect())
+
+    def getconn(self, timeout: float | None = None):
+        """
+        Return a connection from the pool, waiting up to timeout seconds for one to become
+        free. If timeout is None the pool's default timeout is used.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        while True:
+            pc = self._reserve(deadline, timeout)
+
+            try:
+                if pc is None:
+                    pc = self._connect()
+                elif not self._usable(pc):
+                    self._close(pc.conn)
+                    with self._cond:
+                        self._pending -= 1
+                        self._recycled += 1
+                        self._cond.notify()
+                    continue
+
+            except BaseException:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify()
+                raise
+
+            wait = time.monotonic() - start
+            with self._cond:
+                self._pending -= 1
+                self._in_use[id(pc.conn)] = pc
+                self._checkouts += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+
+            return pc.conn
+
+    def putconn(self, conn, close: bool = False) -> None:
+        """
+        Return a connection to the pool. Connections that are closed, broken or too old are
+        discarded, as are all connections if close is True.
+        """
+        with self._cond:
+            pc = self._in_use.pop(id(conn), None)
+
+        if pc is None:
+            # Connections still in use when the pool was closed have already been closed.
+            if self._closed:
+                return
+
+            raise PoolError('Trying to put a connection that did not come from this pool.')
+
+        discard = close or self._closed or conn.closed != 0 or time.monotonic() - pc.created > self.max_age
+        if not discard:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        if discard:
+            self._close(conn)
+
+        with self._cond:
+            if discard:
+                self._recycled += 1
+            else:
+                pc.last_used = time.monotonic()
+                self._idle.append(pc)
+
+            self._cond.notify()
+
+    def closeall(self) -> None:
+        """
+        Close every connection and stop the pool handing out connections.
+        """
+        with self._cond:
+            self._closed = True
+            conns = [pc.conn for pc in self._idle] + [pc.conn for pc in self._in_use.values()]
+            self._idle.clear()
+            self._in_use.clear()
+            self._cond.notify_all()
+
+        for conn in conns:
+            self._close(conn)
+
+    def recycle_idle(self) -> int:
+        """
+        Close all idle connections so that new ones are opened when next required.
+        Returns the number of connections closed.
+        """
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._recycled += len(idle)
+
+        for pc in idle:
+            self._close(pc.conn)
+
+        return len(idle)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the pool's configuration, current state and counters. Wait times and
+        connection ages are in seconds.
+        """
+        now = time.monotonic()
+        with self._cond:
+            ages = [now - pc.created for pc in self._idle] + [now - pc.created for pc in self._in_use.values()]
+            return {
+                'min_conn': self.min_conn,
+                'max_conn': self.max_conn,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'opening': self._pending,
+                'checkouts': self._checkouts,
+                'mean_wait': self._total_wait / self._checkouts if self._checkouts > 0 else 0.0,
+                'max_wait': self._max_wait,
+                'exhausted': self._exhausted,
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'recycled': self._recycled,
+                'failed_checks': self._failed_checks,
+                'oldest_connection_age': max(ages, default=0.0),
+                'mean_connection_age': sum(ages) / len(ages) if len(ages) > 0 else 0.0,
+            }
+
+    def _reserve(self, deadline: float, timeout: float) -> _PooledConnection | None:
+        """
+        Wait until an idle connection is available or a new one may be opened, and reserve it.
+        Returns the idle connection, or None if the caller should open a new connection.
+        """
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError('Connection pool is closed.')
+
+                if len(self._idle) > 0:
+                    self._pending += 1
+                    return self._idle.pop()
+
+                if len(self._in_use) + self._pending < self.max_conn:
+                    self._pending += 1
+                    return None
+
+                if not waited:
+                    waited = True
+                    self._exhausted += 1
+                    logging.debug(f'All {self.max_conn} connections are in use, waiting.')
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    logging.warning(f'No database connection became free within {timeout} seconds.')
+                    raise PoolTimeout(f'No connection became free within {timeout} seconds.')
+
+                self._cond.wait(remaining)
+
+    def _usable(self, pc: _PooledConnection) -> bool:
+        """
+        Returns False if the connection should be discarded rather than handed out.
+        """
+        now = time.monotonic()
+        if pc.conn.closed != 0 or now - pc.created > self.max_age:
+            return False
+
+        if now - pc.last_used <= self.check_after_idle:
+            return True
+
+        try:
+            with pc.conn.cursor() as cursor:
+                cursor.execute('select 1')
+            pc.conn.rollback()
+            return True
+        except psycopg2.Error as err:
+            # The other idle connections were very likely broken by the same cause,
+            # such as a database restart, so replace them all.
+            logging.warning(f'Idle connection failed health check, recycling idle connections: {err}')
+            with self._cond:
+                self._failed_checks += 1
+            self.recycle_idle()
+            return False
+
+    def _connect(self) -> _PooledConnection:
+        conn = psycopg2.connect(*self._args, **self._kwargs)
+        with self._cond:
+            self._opened += 1
+
+        return _PooledConnection(conn)
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
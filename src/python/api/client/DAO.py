@@ -1,19 +1,20 @@
 from contextlib import contextmanager
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import logging, warnings
 import dateutil.parser
 import psycopg2
-from psycopg2 import pool
 import psycopg2.errors
+from psycopg2.pool import PoolError
 from psycopg2.extensions import AsIs
-from psycopg2.extras import Json, register_uuid
-from typing import Any, Dict, List, Optional, Tuple, Union
-import hashlib
-import os
+from psycopg2.extras import Json, execute_values, register_uuid
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+import hashlib, hmac
+import io, json, os, time
 
 import BrokerConstants
+from api.client.ConnectionPool import ConnectionPool
 from pdmodels.Models import BaseDevice, DeviceNote, LogicalDevice, PhysicalDevice, PhysicalToLogicalMapping, User
-from threading import Lock
+from threading import BoundedSemaphore, Condition, Lock, Thread
 
 logging.captureWarnings(True)
 
@@ -42,7 +43,43 @@ class DAOUniqeConstraintException(DAOException):
     pass
 
 
+# This is raised when a limited resource, such as a streaming query connection, is not
+# available, so the caller can ask its client to try again later.
+class DAOBusy(DAOException):
+    pass
+
+
+def is_unavailable(err: Exception) -> bool:
+    """
+    Returns True if err, or the exception wrapped by a DAOException, means the database could
+    not be used at the time, so the operation may succeed if it is tried again later. Returns
+    False if the operation itself failed, eg due to invalid data.
+    """
+    while isinstance(err, DAOException):
+        err = err.wrapped
+
+    return isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError))
+
+
 conn_pool = None
+
+# Connection pool settings. Callers wait up to POOL_TIMEOUT seconds for a connection
+# when all POOL_MAX_CONNECTIONS are in use. See api.client.ConnectionPool for the others.
+POOL_MIN_CONNECTIONS = int(os.getenv('DB_POOL_MIN', '1'))
+POOL_MAX_CONNECTIONS = int(os.getenv('DB_POOL_MAX', '5'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+POOL_MAX_CONNECTION_AGE = float(os.getenv('DB_POOL_MAX_AGE', '3600'))
+POOL_CHECK_AFTER_IDLE = float(os.getenv('DB_POOL_CHECK_AFTER_IDLE', '30'))
+
+# The default number of rows fetched from the server at a time by the streaming queries.
+STREAM_ITERSIZE = int(os.getenv('DB_STREAM_ITERSIZE', '2000'))
+
+# The streaming queries hold a connection while their caller reads the results, which may take
+# as long as a slow client takes to download them. They use their own connections rather than
+# the pool's, and at most STREAM_MAX_CONNECTIONS are open at once.
+STREAM_MAX_CONNECTIONS = int(os.getenv('DB_STREAM_MAX', '4'))
+_stream_slots = BoundedSemaphore(max(1, STREAM_MAX_CONNECTIONS))
+
 _physical_device_select_all_cols = """
 select uid, source_name, name, (select row_to_json(_) from (select ST_Y(location) as lat, ST_X(location) as long) as _) as location, last_seen, source_ids, properties from physical_devices
 """
@@ -52,6 +89,22 @@ select uid, name, (select row_to_json(_) from (select ST_Y(location) as lat, ST_
 """
 
 
+# Selects mappings with both devices in one query. The device columns are in the same
+# order as the _physical_device_select_all_cols and _logical_device_select_all_cols queries.
+_mapping_select_with_devices = """
+select m.physical_uid, m.logical_uid, m.start_time, m.end_time, m.is_active,
+    p.source_name, p.name, (select row_to_json(_) from (select ST_Y(p.location) as lat, ST_X(p.location) as long) as _) as location, p.last_seen, p.source_ids, p.properties,
+    l.name, (select row_to_json(_) from (select ST_Y(l.location) as lat, ST_X(l.location) as long) as _) as location, l.last_seen, l.properties
+from physical_logical_map m
+join physical_devices p on p.uid = m.physical_uid
+join logical_devices l on l.uid = m.logical_uid
+"""
+
+_mapping_select_uids = """
+select m.physical_uid, m.logical_uid, m.start_time, m.end_time, m.is_active from physical_logical_map m
+"""
+
+
 _stopped = False
 
 
@@ -89,9 +142,11 @@ def _get_connection():
         # Try lazy initialisation the connection pool to give the db as
         # much time as possible to start.
         if conn_pool is None:
-            logging.info('Creating connection pool, registering type converters.')
-            conn_pool = pool.ThreadedConnectionPool(1, 5)
-            register_uuid()
+            with _lock:
+                if conn_pool is None:
+                    logging.info('Creating connection pool, registering type converters.')
+                    conn_pool = ConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, POOL_TIMEOUT, POOL_MAX_CONNECTION_AGE, POOL_CHECK_AFTER_IDLE)
+                    register_uuid()
 
         conn = conn_pool.getconn()
         logging.debug(f'Taking conn {conn}')
@@ -117,6 +172,33 @@ def free_conn(conn) -> None:
         conn_pool.putconn(conn)
 
 
+def pool_stats() -> Dict[str, Any]:
+    """
+    Returns the connection pool metrics, see ConnectionPool.stats(). The dict is empty
+    if the pool has not been created yet.
+    """
+    pool = conn_pool
+    return pool.stats() if pool is not None else {}
+
+
+def health_check() -> bool:
+    """
+    Returns True if a pooled connection can be used to run a query.
+    """
+    conn = None
+    try:
+        conn = _get_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('select 1')
+        conn.rollback()
+        return True
+    except (DAOException, psycopg2.Error) as err:
+        logging.warning(f'Database health check failed: {err}')
+        return False
+    finally:
+        free_conn(conn)
+
+
 def _dict_from_row(result_metadata, row) -> Dict[str, Any]:
     obj = {}
     for i, col_def in enumerate(result_metadata):
@@ -125,6 +207,28 @@ def _dict_from_row(result_metadata, row) -> Dict[str, Any]:
     return obj
 
 
+def _mappings_from_rows(rows, return_uids: bool) -> List[PhysicalToLogicalMapping]:
+    """
+    Build PhysicalToLogicalMapping objects from rows selected by _mapping_select_with_devices,
+    or by _mapping_select_uids if return_uids is True, in which case the pd and ld fields of the
+    mappings are the device uids.
+    """
+    mappings = []
+    for row in rows:
+        p_uid, l_uid, start_time, end_time, is_active = row[:5]
+        if return_uids:
+            pd = p_uid
+            ld = l_uid
+        else:
+            p_source_name, p_name, p_location, p_last_seen, p_source_ids, p_properties, l_name, l_location, l_last_seen, l_properties = row[5:]
+            pd = PhysicalDevice.parse_obj({'uid': p_uid, 'source_name': p_source_name, 'name': p_name, 'location': p_location, 'last_seen': p_last_seen, 'source_ids': p_source_ids, 'properties': p_properties})
+            ld = LogicalDevice.parse_obj({'uid': l_uid, 'name': l_name, 'location': l_location, 'last_seen': l_last_seen, 'properties': l_properties})
+
+        mappings.append(PhysicalToLogicalMapping(pd=pd, ld=ld, start_time=start_time, end_time=end_time, is_active=is_active))
+
+    return mappings
+
+
 def _device_to_query_params(device: BaseDevice) -> dict:
     dev_fields = {}
     for k, v in vars(device).items():
@@ -675,6 +779,45 @@ def update_logical_device(device: LogicalDevice) -> LogicalDevice:
             free_conn(conn)
 
 
+def init_logical_device_property(uid: int, path: List[str], value: Any) -> Any:
+    """
+    Set the property at path in a logical device's properties, eg ['ubidots', 'label'], to
+    value unless it is already set. The objects along the path are created if necessary, and
+    the rest of the properties are not read or rewritten, so concurrent callers cannot
+    overwrite each other's changes.
+
+    Returns the value of the property afterwards, which is value unless it was already set,
+    or None if the device does not exist.
+    """
+    if len(path) < 1:
+        raise ValueError('path must not be empty.')
+
+    # Build jsonb_set(jsonb_set(properties, '{a}', ...), '{a,b}', ...) so each object on the
+    # path exists before the value is set.
+    expr = 'properties'
+    args = []
+    for i in range(1, len(path)):
+        expr = f"jsonb_set({expr}, %s, coalesce(properties #> %s, '{{}}'::jsonb))"
+        args.extend([path[:i], path[:i]])
+
+    expr = f'jsonb_set({expr}, %s, %s)'
+    args.extend([path, Json(value)])
+
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f'update logical_devices set properties = {expr} where uid = %s and properties #> %s is null', args + [uid, path])
+            cursor.execute('select properties #> %s from logical_devices where uid = %s', (path, uid))
+            row = cursor.fetchone()
+            return row[0] if row is not None else None
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('init_logical_device_property failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
 def delete_logical_device(uid: int) -> LogicalDevice:
     conn = None
     try:
@@ -714,7 +857,7 @@ def insert_mapping(mapping: PhysicalToLogicalMapping) -> None:
             if current_mapping is not None:
                 raise ValueError(f'insert_mapping failed: physical device {current_mapping.pd.uid} / "{current_mapping.pd.name}" is already mapped to logical device {current_mapping.ld.uid} / "{current_mapping.ld.name}"')
 
-            current_mapping = _get_current_device_mapping(conn, ld=mapping.ld.uid)
+            current_mapping = _get_current_device_mapping(conn, ld=mapping.ld.uid, return_uids=True)
             if current_mapping is not None:
                 _end_mapping(conn, ld=mapping.ld.uid)
 
@@ -753,7 +896,7 @@ def end_mapping(pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Un
 
 def _end_mapping(conn, pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Union[LogicalDevice, int]] = None) -> None:
     with conn.cursor() as cursor:
-        mapping: PhysicalToLogicalMapping = _get_current_device_mapping(conn, pd, ld)
+        mapping: PhysicalToLogicalMapping = _get_current_device_mapping(conn, pd, ld, return_uids=True)
         if mapping is None:
             return
 
@@ -837,11 +980,18 @@ def _toggle_device_mapping(conn, is_active, pd: Optional[Union[PhysicalDevice, i
         return None
 
 
-def get_current_device_mapping(pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Union[LogicalDevice, int]] = None, only_current_mapping: bool = True) -> Optional[PhysicalToLogicalMapping]:
+def get_current_device_mapping(pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Union[LogicalDevice, int]] = None, only_current_mapping: bool = True, return_uids: bool = False) -> Optional[PhysicalToLogicalMapping]:
+    """
+    Returns the current mapping for the given physical or logical device, or the latest mapping if
+    only_current_mapping is False.
+
+    If return_uids is True the pd and ld fields of the mapping are the device uids rather than the
+    devices, which saves reading the device rows.
+    """
     conn = None
     try:
         with _get_connection() as conn:
-            mapping = _get_current_device_mapping(conn, pd, ld, only_current_mapping)
+            mapping = _get_current_device_mapping(conn, pd, ld, only_current_mapping, return_uids)
             return mapping
     except Exception as err:
         match err:
@@ -855,7 +1005,7 @@ def get_current_device_mapping(pd: Optional[Union[PhysicalDevice, int]] = None,
             free_conn(conn)
 
 
-def _get_current_device_mapping(conn, pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Union[LogicalDevice, int]] = None, only_current_mapping: bool = True) -> Optional[PhysicalToLogicalMapping]:
+def _get_current_device_mapping(conn, pd: Optional[Union[PhysicalDevice, int]] = None, ld: Optional[Union[LogicalDevice, int]] = None, only_current_mapping: bool = True, return_uids: bool = False) -> Optional[PhysicalToLogicalMapping]:
     mappings = None
 
     if pd is None and ld is None:
@@ -872,21 +1022,18 @@ def _get_current_device_mapping(conn, pd: Optional[Union[PhysicalDevice, int]] =
     if ld is not None:
         l_uid = ld.uid if isinstance(ld, LogicalDevice) else ld
 
-    end_time_clause = 'and end_time is null' if only_current_mapping else ''
+    end_time_clause = 'and m.end_time is null' if only_current_mapping else ''
 
     with conn.cursor() as cursor:
         column_name = 'physical_uid' if p_uid is not None else 'logical_uid'
-        sql = f'select physical_uid, logical_uid, start_time, end_time, is_active from physical_logical_map where {column_name} = %s {end_time_clause} order by start_time desc'
+        select = _mapping_select_uids if return_uids else _mapping_select_with_devices
+        sql = f'{select} where m.{column_name} = %s {end_time_clause} order by m.start_time desc'
         cursor.execute(sql, (p_uid if p_uid is not None else l_uid, ))
 
-        mappings = []
-        for p_uid, l_uid, start_time, end_time, is_active in cursor:
-            pd = _get_physical_device(conn, p_uid)
-            ld = _get_logical_device(conn, l_uid)
-            mappings.append(PhysicalToLogicalMapping(pd=pd, ld=ld, start_time=start_time, end_time=end_time, is_active=is_active))
+        mappings = _mappings_from_rows(cursor, return_uids)
 
         if only_current_mapping and len(mappings) > 1:
-            warnings.warn(f'Found multiple ({cursor.rowcount}) current mappings for {pd.uid} {pd.name} -> {ld.uid} {ld.name}')
+            warnings.warn(f'Found multiple ({len(mappings)}) current mappings for {column_name} {p_uid if p_uid is not None else l_uid}')
             for m in mappings:
                 logging.warning(m)
 
@@ -914,20 +1061,20 @@ def get_unmapped_physical_devices() -> List[PhysicalDevice]:
             free_conn(conn)
 
 
-def get_logical_device_mappings(ld: Union[LogicalDevice, int]) -> List[PhysicalToLogicalMapping]:
+def get_logical_device_mappings(ld: Union[LogicalDevice, int], return_uids: bool = False) -> List[PhysicalToLogicalMapping]:
+    """
+    Returns all mappings to the given logical device, latest first.
+
+    If return_uids is True the pd and ld fields of the mappings are the device uids rather than the
+    devices, which saves reading the device rows.
+    """
     conn = None
     try:
-        mappings = []
         with _get_connection() as conn, conn.cursor() as cursor:
             l_uid = ld.uid if isinstance(ld, LogicalDevice) else ld
-            cursor.execute('select physical_uid, logical_uid, start_time, end_time, is_active from physical_logical_map where logical_uid = %s order by start_time desc', (l_uid, ))
-            for p_uid, l_uid, start_time, end_time, is_active in cursor:
-                pd = _get_physical_device(conn, p_uid)
-                ld = _get_logical_device(conn, l_uid)
-                mapping = PhysicalToLogicalMapping(pd=pd, ld=ld, start_time=start_time, end_time=end_time, is_active=is_active)
-                mappings.append(mapping)
-
-        return mappings
+            select = _mapping_select_uids if return_uids else _mapping_select_with_devices
+            cursor.execute(f'{select} where m.logical_uid = %s order by m.start_time desc', (l_uid, ))
+            return _mappings_from_rows(cursor, return_uids)
     except Exception as err:
         raise err if isinstance(err, DAOException) else DAOException('get_logical_device_mappings failed.', err)
     finally:
@@ -935,21 +1082,20 @@ def get_logical_device_mappings(ld: Union[LogicalDevice, int]) -> List[PhysicalT
             free_conn(conn)
 
 
-def get_physical_device_mappings(pd: Union[PhysicalDevice, int]) -> List[PhysicalToLogicalMapping]:
+def get_physical_device_mappings(pd: Union[PhysicalDevice, int], return_uids: bool = False) -> List[PhysicalToLogicalMapping]:
+    """
+    Returns all mappings from the given physical device, latest first.
+
+    If return_uids is True the pd and ld fields of the mappings are the device uids rather than the
+    devices, which saves reading the device rows.
+    """
     conn = None
     try:
-        mappings = []
         with _get_connection() as conn, conn.cursor() as cursor:
             p_uid = pd.uid if isinstance(pd, PhysicalDevice) else pd
-            cursor.execute('select physical_uid, logical_uid, start_time, end_time, is_active from physical_logical_map where physical_uid = %s order by start_time desc', (p_uid, ))
-
-            for p_uid, l_uid, start_time, end_time, is_active in cursor:
-                pd = _get_physical_device(conn, p_uid)
-                ld = _get_logical_device(conn, l_uid)
-                mapping = PhysicalToLogicalMapping(pd=pd, ld=ld, start_time=start_time, end_time=end_time, is_active=is_active)
-                mappings.append(mapping)
-
-        return mappings
+            select = _mapping_select_uids if return_uids else _mapping_select_with_devices
+            cursor.execute(f'{select} where m.physical_uid = %s order by m.start_time desc', (p_uid, ))
+            return _mappings_from_rows(cursor, return_uids)
     except Exception as err:
         raise err if isinstance(err, DAOException) else DAOException('get_physical_logical_mappings failed.', err)
     finally:
@@ -959,20 +1105,10 @@ def get_physical_device_mappings(pd: Union[PhysicalDevice, int]) -> List[Physica
 def get_all_current_mappings(return_uids: bool = True) -> List[PhysicalToLogicalMapping]:
     conn = None
     try:
-        mappings = []
         with _get_connection() as conn, conn.cursor() as cursor:
-            cursor.execute('select physical_uid, logical_uid, start_time, end_time, is_active from physical_logical_map where end_time is null order by logical_uid asc')
-            for p_uid, l_uid, start_time, end_time, is_active in cursor:
-                if return_uids:
-                    pd = p_uid
-                    ld = l_uid
-                else:
-                    pd = _get_physical_device(conn, p_uid)
-                    ld = _get_logical_device(conn, l_uid)
-                mapping = PhysicalToLogicalMapping(pd=pd, ld=ld, start_time=start_time, end_time=end_time, is_active=is_active)
-                mappings.append(mapping)
-
-        return mappings
+            select = _mapping_select_uids if return_uids else _mapping_select_with_devices
+            cursor.execute(f'{select} where m.end_time is null order by m.logical_uid asc')
+            return _mappings_from_rows(cursor, return_uids)
     except Exception as err:
         raise err if isinstance(err, DAOException) else DAOException('get_all_current_mappings failed.', err)
     finally:
@@ -1010,18 +1146,348 @@ def insert_physical_timeseries_message(msg: Dict[str, Any]) -> None:
             free_conn(conn)
 
 
-def get_physical_timeseries_message(start: datetime | None = None, end: datetime | None = None, count: int | None = None, only_timestamp: bool = False, include_received_at: bool = False, p_uid: int = None, l_uid: int = None) -> List[Dict]:
+def insert_physical_timeseries_messages(msgs: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert a batch of messages into physical_timeseries using COPY, in a single transaction.
+
+    The uids for the new rows are allocated from the table's identity sequence before the COPY
+    so they can be returned to the caller. The returned list is in the same order as msgs.
+    """
+    if len(msgs) < 1:
+        return []
+
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("select nextval(pg_get_serial_sequence('physical_timeseries', 'uid')) from generate_series(1, %s)", (len(msgs), ))
+            uids = [row[0] for row in cursor.fetchall()]
+
+            buf = io.StringIO()
+            for uid, msg in zip(uids, msgs):
+                p_uid = msg[BrokerConstants.PHYSICAL_DEVICE_UID_KEY]
+                l_uid = msg.get(BrokerConstants.LOGICAL_DEVICE_UID_KEY)
+                ts = msg[BrokerConstants.TIMESTAMP_KEY]
+
+                # json.dumps escapes control characters, so the only character that needs
+                # escaping for the COPY text format is the backslash.
+                json_msg = json.dumps(msg).replace('\\', '\\\\')
+                l_uid_col = '\\N' if l_uid is None else str(l_uid)
+                buf.write(f'{uid}\t{p_uid}\t{ts}\t{l_uid_col}\t{json_msg}\n')
+
+            buf.seek(0)
+            cursor.copy_from(buf, 'physical_timeseries', columns=('uid', 'physical_uid', 'ts', 'logical_uid', 'json_msg'))
+
+        return uids
+    except Exception as err:
+        raise DAOException('insert_physical_timeseries_messages failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+class MappedMessage(NamedTuple):
+    """
+    The result of map_and_record_physical_timeseries_messages for one message.
+
+    uid: the uid of the new physical_timeseries row.
+    l_uid: the logical device the message's physical device is currently mapped to, or None if
+           it is not mapped.
+    is_active: whether the mapping is active, or None if the physical device is not mapped.
+    """
+    uid: int
+    l_uid: Optional[int]
+    is_active: Optional[bool]
+
+
+def map_and_record_physical_timeseries_messages(msgs: List[Dict[str, Any]], max_future: timedelta = timedelta(hours=1)) -> List[MappedMessage]:
+    """
+    Resolve the current mapping of each message's physical device, insert the messages into
+    physical_timeseries and update the last_seen column and last_msg property of the logical
+    devices, all in one statement.
+
+    Messages from devices with an active mapping are stored with the logical device uid in the
+    logical_uid column and in the message, and the logical device uid is also added to the msg
+    dicts passed in. Messages from unmapped devices or paused mappings are stored without one.
+
+    A logical device is updated from the last of its messages in msgs with a timestamp no more
+    than max_future ahead of now. last_seen is set to the message timestamp, or now if that is
+    in the future. Only last_seen and last_msg are written, so the rest of the device is not
+    read or rewritten.
+
+    The returned list is in the same order as msgs.
+    """
+    if len(msgs) < 1:
+        return []
+
+    sql = """
+        with batch as materialized (
+            select nextval(pg_get_serial_sequence('physical_timeseries', 'uid')) as uid, b.ord, b.physical_uid, b.ts,
+                   m.logical_uid, m.is_active,
+                   case when m.is_active then b.json_msg || jsonb_build_object(%(l_uid_key)s, m.logical_uid) else b.json_msg end as json_msg
+            from unnest(%(p_uids)s::integer[], %(timestamps)s::timestamptz[], %(json_msgs)s::jsonb[]) with ordinality as b(physical_uid, ts, json_msg, ord)
+            left join lateral (
+                select pl.logical_uid, pl.is_active from physical_logical_map pl
+                where pl.physical_uid = b.physical_uid and pl.end_time is null
+                order by pl.start_time desc limit 1) m on true
+        ), inserted as (
+            insert into physical_timeseries (uid, physical_uid, ts, logical_uid, json_msg) overriding system value
+            select uid, physical_uid, ts, case when is_active then logical_uid end, json_msg from batch
+        ), seen as (
+            update logical_devices ld set last_seen = s.last_seen, properties = jsonb_set(ld.properties, %(last_msg_path)s, s.json_msg)
+            from (
+                select distinct on (logical_uid) logical_uid, least(ts, now()) as last_seen, json_msg from batch
+                where is_active and ts <= now() + %(max_future)s
+                order by logical_uid, ord desc) s
+            where ld.uid = s.logical_uid
+        )
+        select uid, logical_uid, is_active from batch order by ord
+    """
+
+    conn = None
+    try:
+        args = {
+            'l_uid_key': BrokerConstants.LOGICAL_DEVICE_UID_KEY,
+            'last_msg_path': [BrokerConstants.LAST_MSG],
+            'max_future': max_future,
+            'p_uids': [msg[BrokerConstants.PHYSICAL_DEVICE_UID_KEY] for msg in msgs],
+            'timestamps': [msg[BrokerConstants.TIMESTAMP_KEY] for msg in msgs],
+            'json_msgs': [json.dumps(msg) for msg in msgs],
+        }
+
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, args)
+            results = [MappedMessage(*row) for row in cursor.fetchall()]
+
+        for msg, result in zip(msgs, results):
+            if result.is_active:
+                msg[BrokerConstants.LOGICAL_DEVICE_UID_KEY] = result.l_uid
+
+        return results
+    except Exception as err:
+        raise DAOException('map_and_record_physical_timeseries_messages failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+class PhysicalTimeseriesBatchWriter:
+    """
+    Buffers physical_timeseries messages and writes them to the database in bulk.
+
+    A batch is written when max_rows messages are waiting, or max_wait seconds after the
+    first message of the batch was added, whichever comes first. Batches are written by a
+    background thread so add() never blocks on the database.
+
+    Each message is added with an on_flushed callback which is called from the writer thread
+    once the batch containing the message has been committed or has failed. It is called as
+    on_flushed(msg, uid, err) where uid is the uid of the new physical_timeseries row and err is
+    None on success, or uid is None and err is the DAOException raised by the write.
+
+    One invalid message fails the whole batch, so when a batch fails for any reason other than
+    the database being unavailable its halves are written separately, until the messages that
+    cannot be written are found. For those is_unavailable(err) is False, and writing them again
+    will fail again.
+
+    Callers that must not acknowledge a message until it is durable, such as the logical mapper,
+    should do that acknowledgement from the callback.
+
+    If map_devices is True the batches are written by map_and_record_physical_timeseries_messages,
+    so messages from devices with an active mapping have the logical device uid added to them
+    before on_flushed is called, and the logical devices' last_seen and last_msg are updated
+    from messages no more than max_future ahead of now.
+    """
+
+    def __init__(self, max_rows: int = 250, max_wait: float = 0.2, map_devices: bool = False, max_future: timedelta = timedelta(hours=1)) -> None:
+        self.max_rows = max(1, max_rows)
+        self.max_wait = max(0.0, max_wait)
+        self.map_devices = map_devices
+        self.max_future = max_future
+
+        self._pending: List[Tuple[Dict[str, Any], Callable]] = []
+        self._first_added = 0.0
+        self._stopping = False
+        self._cond = Condition()
+
+        self._thread = Thread(target=self._flush_thread_proc, name='timeseries_writer', daemon=True)
+        self._thread.start()
+
+    def add(self, msg: Dict[str, Any], on_flushed: Callable[[Dict[str, Any], Optional[int], Optional[DAOException]], None]) -> None:
+        with self._cond:
+            if self._stopping:
+                raise DAOException('PhysicalTimeseriesBatchWriter has been stopped.')
+
+            if len(self._pending) < 1:
+                self._first_added = time.monotonic()
+
+            self._pending.append((msg, on_flushed))
+
+            # Wake the writer thread when the first message of a batch arrives so it can
+            # start timing the batch, and when the batch is full.
+            if len(self._pending) == 1 or len(self._pending) >= self.max_rows:
+                self._cond.notify()
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Write any buffered messages and stop the writer thread. Messages cannot be added after
+        this method is called.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        self._thread.join(timeout)
+
+    def _flush_thread_proc(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if len(self._pending) < 1:
+                        if self._stopping:
+                            return
+
+                        self._cond.wait()
+                        continue
+
+                    remaining = self._first_added + self.max_wait - time.monotonic()
+                    if self._stopping or len(self._pending) >= self.max_rows or remaining <= 0:
+                        break
+
+                    self._cond.wait(remaining)
+
+                batch = self._pending[:self.max_rows]
+                del self._pending[:self.max_rows]
+                if len(self._pending) > 0:
+                    self._first_added = time.monotonic()
+
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Tuple[Dict[str, Any], Callable]]) -> None:
+        uids = None
+        error = None
+        try:
+            if self.map_devices:
+                uids = [result.uid for result in map_and_record_physical_timeseries_messages([msg for msg, _ in batch], self.max_future)]
+            else:
+                uids = insert_physical_timeseries_messages([msg for msg, _ in batch])
+        except Exception as err:
+            # Any error must be reported to the callbacks rather than end the flush thread,
+            # otherwise the messages waiting to be written are never settled.
+            error = err if isinstance(err, DAOException) else DAOException('Failed to write physical_timeseries batch.', err)
+            if len(batch) > 1 and not is_unavailable(error):
+                logging.warning(f'Failed to write batch of {len(batch)} physical_timeseries messages, writing it in halves: {error}')
+                half = len(batch) // 2
+                self._write_batch(batch[:half])
+                self._write_batch(batch[half:])
+                return
+
+            logging.exception(f'Failed to write batch of {len(batch)} physical_timeseries messages.')
+
+        for i, (msg, on_flushed) in enumerate(batch):
+            try:
+                on_flushed(msg, uids[i] if uids is not None else None, error)
+            except Exception:
+                logging.exception('physical_timeseries on_flushed callback failed.')
+
+
+def create_physical_timeseries_partitions(months_ahead: int = 3) -> int:
+    """
+    Ensure the monthly physical_timeseries partitions exist from the current month until
+    months_ahead months in the future. Returns the number of partitions created.
+    """
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("select create_physical_timeseries_partitions(now(), now() + make_interval(months => %s))", (months_ahead, ))
+            created = cursor.fetchone()[0]
+            if created > 0:
+                logging.info(f'Created {created} physical_timeseries partitions.')
+
+            return created
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('create_physical_timeseries_partitions failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def get_physical_timeseries_message(start: datetime | None = None, end: datetime | None = None, count: int | None = None, only_timestamp: bool = False, include_received_at: bool = False, p_uid: int = None, l_uid: int = None, ascending: bool = False) -> List[Dict]:
     conn = None
 
-    if start is None:
-        start = dateutil.parser.isoparse('1970-01-01T00:00:00Z')
-    if end is None:
-        end = datetime.now(timezone.utc)
     if count is None or count > 65536:
         count = 65536 * 2
     if count < 1:
         count = 1
 
+    qry, args = _physical_timeseries_query(start, end, count, only_timestamp, include_received_at, p_uid, l_uid, ascending)
+
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(qry, args)
+            return [_msg_tuple_to_obj(cursor.description, row) for row in cursor.fetchall()]
+
+    except Exception as err:
+        raise DAOException('get_physical_timeseries_message failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def stream_physical_timeseries_message(start: datetime | None = None, end: datetime | None = None, count: int | None = None, only_timestamp: bool = False, include_received_at: bool = False, p_uid: int = None, l_uid: int = None, ascending: bool = False, itersize: int | None = None) -> Iterator[Dict]:
+    """
+    Like get_physical_timeseries_message, but returns a generator that reads the messages
+    from a server-side cursor, itersize rows at a time, so any number of messages can be
+    read in constant memory. count is not capped, and None means every message in the range.
+
+    The arguments are checked when this function is called, but the query does not run
+    until the first message is requested. The generator holds a connection of its own, not
+    one from the pool, until it is exhausted or closed, so callers that stop early should
+    close it. If STREAM_MAX_CONNECTIONS streams are already open, DAOBusy is raised when the
+    first message is requested.
+    """
+    if count is not None and count < 1:
+        count = 1
+
+    qry, args = _physical_timeseries_query(start, end, count, only_timestamp, include_received_at, p_uid, l_uid, ascending)
+    return _stream_physical_timeseries_message(qry, args, itersize if itersize is not None else STREAM_ITERSIZE)
+
+
+def _stream_physical_timeseries_message(qry: str, args: Tuple, itersize: int) -> Iterator[Dict]:
+    if not _stream_slots.acquire(blocking=False):
+        raise DAOBusy(f'All {STREAM_MAX_CONNECTIONS} streaming connections are in use.')
+
+    conn = None
+    try:
+        # The connection settings come from the libpq environment variables, as for the pool.
+        conn = psycopg2.connect()
+        with conn, conn.cursor(name='stream_physical_timeseries') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(qry, args)
+            for row in cursor:
+                yield _msg_tuple_to_obj(cursor.description, row)
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('stream_physical_timeseries_message failed.', err)
+    finally:
+        if conn is not None:
+            conn.close()
+
+        _stream_slots.release()
+
+
+def _physical_timeseries_query(start: datetime | None, end: datetime | None, count: int | None, only_timestamp: bool, include_received_at: bool, p_uid: int | None, l_uid: int | None, ascending: bool) -> Tuple[str, Tuple]:
+    """
+    Check the arguments of the physical_timeseries message queries, and return the query
+    and its arguments.
+    """
+    if start is None:
+        start = dateutil.parser.isoparse('1970-01-01T00:00:00Z')
+    if end is None:
+        end = datetime.now(timezone.utc)
+
     if p_uid is None and l_uid is None:
         raise ValueError('p_uid or l_uid must be supplied.')
 
@@ -1055,28 +1521,22 @@ def get_physical_timeseries_message(start: datetime | None = None, end: datetime
 
     column_names = ', '.join(column_names)
 
-    try:
-        # Order messages by descending timestamp. If a caller asks for one message, they probably want the latest
-        # message.
-        with _get_connection() as conn, conn.cursor() as cursor:
-            qry = f"""
-                select {column_names} from physical_timeseries
-                 where {uid_col_name} = %s
-                 and ts > %s
-                 and ts <= %s
-                 order by ts desc
-                 limit %s
-                """
+    # Order messages by descending timestamp by default. If a caller asks for one message, they probably want
+    # the latest message.
+    qry = f"""
+        select {column_names} from physical_timeseries
+         where {uid_col_name} = %s
+         and ts > %s
+         and ts <= %s
+         order by ts {'asc' if ascending else 'desc'}
+        """
 
-            args = (uid, start, end, count)
-            cursor.execute(qry, args)
-            return [_msg_tuple_to_obj(cursor.description, row) for row in cursor.fetchall()]
+    args = (uid, start, end)
+    if count is not None:
+        qry += ' limit %s'
+        args += (count, )
 
-    except Exception as err:
-        raise DAOException('get_physical_timeseries_message failed.', err)
-    finally:
-        if conn is not None:
-            free_conn(conn)
+    return qry, args
 
 
 def _msg_tuple_to_obj(cursor_description, values) -> dict:
@@ -1092,6 +1552,159 @@ def _msg_tuple_to_obj(cursor_description, values) -> dict:
     return msg_dict
 
 
+def update_timeseries_rollups(max_uids: int = 100000) -> int:
+    """
+    Add up to max_uids of the physical_timeseries rows inserted since the last call to the
+    hourly and daily rollup tables. Rows only become eligible one call after they are
+    inserted, so this should be called periodically.
+
+    Returns the number of physical_timeseries uids covered, so a value of max_uids means
+    there may be more rows to add.
+    """
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('select update_timeseries_rollups(%s)', (max_uids, ))
+            return cursor.fetchone()[0]
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('update_timeseries_rollups failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def get_timeseries_rollups(l_uid: int, interval: str = 'hour', start: datetime | None = None, end: datetime | None = None, names: List[str] | None = None) -> List[Dict]:
+    """
+    Return the hourly or daily aggregates of a logical device's timeseries values, ordered by
+    name and then bucket. interval must be 'hour' or 'day'. Buckets starting at or after start
+    and before end are returned, optionally only for the value names in names.
+
+    Each aggregate is a dict with the keys name, bucket, count, min, max and avg.
+    """
+    if interval == 'hour':
+        table = 'timeseries_rollup_hourly'
+    elif interval == 'day':
+        table = 'timeseries_rollup_daily'
+    else:
+        raise ValueError(f'interval must be hour or day, not {interval}.')
+
+    if not isinstance(l_uid, int):
+        raise TypeError
+
+    qry = f'select name, bucket, count, min, max, sum / count as avg from {table} where logical_uid = %s'
+    args = [l_uid]
+    if start is not None:
+        qry += ' and bucket >= %s'
+        args.append(start)
+    if end is not None:
+        qry += ' and bucket < %s'
+        args.append(end)
+    if names is not None:
+        qry += ' and name = any(%s)'
+        args.append(list(names))
+
+    qry += ' order by name, bucket'
+
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(qry, args)
+            return [{'name': name, 'bucket': bucket.astimezone(timezone.utc).isoformat(), 'count': count, 'min': min_val, 'max': max_val, 'avg': avg}
+                    for name, bucket, count, min_val, max_val, avg in cursor.fetchall()]
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('get_timeseries_rollups failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def backfill_timeseries_values(max_uids: int = 50000) -> int:
+    """
+    Add the values of up to max_uids messages stored before the timeseries_values table
+    existed to that table, newest first. Returns the number of physical_timeseries uids
+    covered, which is 0 once the backfill is complete.
+    """
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('select backfill_timeseries_values(%s)', (max_uids, ))
+            return cursor.fetchone()[0]
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('backfill_timeseries_values failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def get_timeseries_variables() -> List[str]:
+    """
+    Return the names of all the values that have appeared in message timeseries arrays.
+    """
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('select name from timeseries_variables order by name')
+            return [row[0] for row in cursor.fetchall()]
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('get_timeseries_variables failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
+def get_timeseries_variable(name: str, l_uids: List[int] | None = None, p_uids: List[int] | None = None, start: datetime | None = None, end: datetime | None = None) -> List[Dict]:
+    """
+    Return the values of one timeseries variable for the given logical or physical devices,
+    with timestamps after start and up to and including end, ordered by device and then
+    timestamp. Only one of l_uids and p_uids may be given.
+
+    Each value is a dict with the keys l_uid or p_uid, ts and value.
+    """
+    if (l_uids is None) == (p_uids is None):
+        raise ValueError('Give one of l_uids or p_uids.')
+
+    if l_uids is not None:
+        uid_col_name, key, uids = 'logical_uid', BrokerConstants.LOGICAL_DEVICE_UID_KEY, l_uids
+    else:
+        uid_col_name, key, uids = 'physical_uid', BrokerConstants.PHYSICAL_DEVICE_UID_KEY, p_uids
+
+    if start is None:
+        start = dateutil.parser.isoparse('1970-01-01T00:00:00Z')
+    if end is None:
+        end = datetime.now(timezone.utc)
+
+    # The variable uid is looked up first so the planner sees a constant, and uses the
+    # (variable_uid, device uid, ts) index for every device.
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('select uid from timeseries_variables where name = %s', (name, ))
+            row = cursor.fetchone()
+            if row is None:
+                return []
+
+            cursor.execute(f"""
+                select {uid_col_name}, ts, value from timeseries_values
+                 where variable_uid = %s
+                 and {uid_col_name} = any(%s)
+                 and ts > %s
+                 and ts <= %s
+                 order by {uid_col_name}, ts
+                """, (row[0], list(uids), start, end))
+
+            return [{key: uid, 'ts': ts.astimezone(timezone.utc).isoformat(), 'value': value} for uid, ts, value in cursor.fetchall()]
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('get_timeseries_variable failed.', err)
+    finally:
+        if conn is not None:
+            free_conn(conn)
+
+
 def add_raw_text_message(source_name: str, ts: datetime, correlation_uuid: str, msg, uid: int=None):
     conn = None
     try:
@@ -1110,11 +1723,19 @@ def add_raw_text_message(source_name: str, ts: datetime, correlation_uuid: str,
 """
 User and authentication CRUD methods
 """
+def _hash_password(password: str, salt: str) -> str:
+    """
+    Returns the scrypt hash of the password. This deliberately takes tens of milliseconds
+    of CPU time, so avoid calling it while holding a pooled connection.
+    """
+    return hashlib.scrypt(password=password.encode(), salt=salt.encode(), n=2**14, r=8, p=1, maxmem=0, dklen=64).hex()
+
+
 def user_add(uname: str, passwd: str, disabled: bool) -> None:
 
     #Generate salted password
     salt=os.urandom(64).hex()
-    pass_hash=hashlib.scrypt(password=passwd.encode(), salt=salt.encode(), n=2**14, r=8, p=1, maxmem=0, dklen=64).hex()
+    pass_hash=_hash_password(passwd, salt)
 
     #Auth token to be used on other endpoints
     auth_token=os.urandom(64).hex()
@@ -1203,17 +1824,6 @@ def user_get_token(username, password) -> str | None:
         with _get_connection() as conn, conn.cursor() as cursor:
             cursor.execute("select salt, password, auth_token from users where username=%s",(username,))
             result = cursor.fetchone()
-            if result is None:
-                return None
-
-            db_salt, db_password, auth_token=result
-            input_pw_hash=hashlib.scrypt(password=password.encode(), salt=db_salt.encode(), n=2**14, r=8, p=1, maxmem=0, dklen=64).hex()
-
-            if input_pw_hash != db_password:
-                #Incorrect password supplied
-                return None
-
-            return auth_token
 
     except Exception as err:
         raise err if isinstance(err, DAOException) else DAOException('get_user_token failed.', err)
@@ -1221,6 +1831,19 @@ def user_get_token(username, password) -> str | None:
         if conn is not None:
             free_conn(conn)
 
+    if result is None:
+        return None
+
+    # The connection has been returned to the pool before hashing because scrypt is slow.
+    db_salt, db_password, auth_token=result
+    input_pw_hash=_hash_password(password, db_salt)
+
+    if not hmac.compare_digest(input_pw_hash, db_password):
+        #Incorrect password supplied
+        return None
+
+    return auth_token
+
 
 def token_is_valid(user_token) -> bool:
     '''
@@ -1260,7 +1883,7 @@ def token_refresh(uname) -> None:
 
 def user_change_password(username: str, new_passwd: str) -> None:
     salt = os.urandom(64).hex()
-    pass_hash = hashlib.scrypt(password=new_passwd.encode(), salt=salt.encode(), n=2**14, r=8, p=1, maxmem=0, dklen=64).hex()
+    pass_hash = _hash_password(new_passwd, salt)
 
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
@@ -1279,7 +1902,7 @@ def user_change_password_and_token(new_passwd: str, prev_token: str) -> str:
     """
     #Generate salted password
     salt = os.urandom(64).hex()
-    pass_hash = hashlib.scrypt(password=new_passwd.encode(), salt=salt.encode(), n=2**14, r=8, p=1, maxmem=0, dklen=64).hex()
+    pass_hash = _hash_password(new_passwd, salt)
 
     #Auth token to be used on other endpoints
     auth_token = os.urandom(64).hex()
@@ -1333,14 +1956,49 @@ def _get_delivery_table_id(name: str) -> str:
     #return sql.Identifier(f'{name}_delivery_q')
     return f'{name}_delivery_q'
 
+def get_delivery_channel(name: str) -> str:
+    """
+    Returns the notification channel on which a notification is sent whenever messages
+    become available in the delivery table for a service.
+    """
+    return f'{name}_delivery'
+
 def create_delivery_table(name: str) -> None:
+    """
+    Create the delivery table for a service if it does not exist, and add any columns
+    missing from tables created by earlier versions.
+
+    A row is claimed by a delivery worker while claimed_by is set and lease_expires_at
+    is in the future. Rows whose lease has expired, because the worker holding them
+    died, can be claimed by any worker. Rows that are waiting to be retried are not
+    claimed until next_attempt_at.
+
+    A row holds either a copy of the message in json_msg, or a reference to the
+    physical_timeseries row holding the message in pts_uid and pts_ts, in which case
+    json_msg is null and logical_uid is the message's logical device uid.
+    """
     logging.info(f'Creating message delivery table for service {name}')
 
+    conn = None
     try:
-        qry = f"""create table if not exists {_get_delivery_table_id(name)} (
+        table = _get_delivery_table_id(name)
+        qry = f"""create table if not exists {table} (
                     uid integer generated always as identity primary key,
-                    json_msg jsonb not null,
-                    retry_count integer not null default 0)"""
+                    json_msg jsonb,
+                    retry_count integer not null default 0,
+                    claimed_by text,
+                    lease_expires_at timestamptz,
+                    next_attempt_at timestamptz,
+                    pts_uid integer,
+                    pts_ts timestamptz,
+                    logical_uid integer);
+                  alter table {table} add column if not exists claimed_by text;
+                  alter table {table} add column if not exists lease_expires_at timestamptz;
+                  alter table {table} add column if not exists next_attempt_at timestamptz;
+                  alter table {table} add column if not exists pts_uid integer;
+                  alter table {table} add column if not exists pts_ts timestamptz;
+                  alter table {table} add column if not exists logical_uid integer;
+                  alter table {table} alter column json_msg drop not null"""
 
         with _get_connection() as conn, conn.cursor() as cursor:
             cursor.execute(qry)
@@ -1353,6 +2011,7 @@ def create_delivery_table(name: str) -> None:
             free_conn(conn)
 
 def get_delivery_msg_count(name: str) -> int:
+    conn = None
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
             cursor.execute(f'select count(uid) from {_get_delivery_table_id(name)}')
@@ -1365,27 +2024,38 @@ def get_delivery_msg_count(name: str) -> int:
             conn.commit()
             free_conn(conn)
 
-def get_delivery_msg_batch(name: str, from_uid: int = 0, batch_size: int = 10) -> List[Tuple[int, list[dict[Any]]]]:
+def get_delivery_wait(name: str) -> float | None:
+    """
+    Returns the number of seconds until the next message in the delivery table for a service
+    can be claimed, 0 if a message can be claimed now, or None if the table is empty.
+    """
+    conn = None
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
-            # Using order by asc in case time series databases need values inserted in timestamp order.
-            cursor.execute(f'select uid, json_msg, retry_count from {_get_delivery_table_id(name)} where uid > %s order by uid asc limit %s', (from_uid, batch_size))
-            if cursor.rowcount < 1:
-                return 0, []
-
-            return cursor.fetchall()
+            # A message with neither time set can be claimed now. Using now() rather than
+            # '-infinity' for the missing times avoids subtracting infinite timestamps.
+            cursor.execute(f"""select extract(epoch from min(greatest(coalesce(lease_expires_at, now()), coalesce(next_attempt_at, now()))) - now())
+                                 from {_get_delivery_table_id(name)}""")
+            wait = cursor.fetchone()[0]
+            return None if wait is None else max(0.0, float(wait))
 
     except Exception as err:
-        raise err if isinstance(err, DAOException) else DAOException('get_delivery_msg_batch failed.', err)
+        raise err if isinstance(err, DAOException) else DAOException('get_delivery_wait failed.', err)
     finally:
         if conn is not None:
             conn.commit()
             free_conn(conn)
 
 def add_delivery_msg(name: str, msg: dict[Any]) -> None:
+    """
+    Add a message to the delivery table for a service, and notify the service's delivery
+    workers in every process that it is available.
+    """
+    conn = None
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
             cursor.execute(f'insert into {_get_delivery_table_id(name)} (json_msg) values (%s)', (Json(msg), ))
+            cursor.execute("select pg_notify(%s, '')", (get_delivery_channel(name), ))
 
     except Exception as err:
         raise err if isinstance(err, DAOException) else DAOException('add_delivery_msg failed.', err)
@@ -1394,30 +2064,155 @@ def add_delivery_msg(name: str, msg: dict[Any]) -> None:
             conn.commit()
             free_conn(conn)
 
-def remove_delivery_msg(name: str, uid: int) -> None:
+def add_delivery_msgs(name: str, msgs: List[Dict[str, Any]], pts_uids: List[int | None] | None = None) -> None:
+    """
+    Add a batch of messages to the delivery table for a service in a single transaction, in
+    the order given, and notify the service's delivery workers once.
+
+    If pts_uids is given it must have an entry for each message. A message with a pts_uid is
+    already in physical_timeseries, so only a reference to that row is stored and the message
+    is read from physical_timeseries when it is claimed. Messages with a pts_uid of None are
+    copied into the delivery table.
+    """
+    if len(msgs) < 1:
+        return
+
+    if pts_uids is None:
+        pts_uids = [None] * len(msgs)
+
+    rows = []
+    for msg, pts_uid in zip(msgs, pts_uids):
+        if pts_uid is None:
+            rows.append((Json(msg), None, None, None))
+        else:
+            rows.append((None, pts_uid, msg[BrokerConstants.TIMESTAMP_KEY], msg.get(BrokerConstants.LOGICAL_DEVICE_UID_KEY)))
+
+    conn = None
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
-            cursor.execute(f'delete from {_get_delivery_table_id(name)} where uid = %s', (uid, ))
+            execute_values(cursor, f'insert into {_get_delivery_table_id(name)} (json_msg, pts_uid, pts_ts, logical_uid) values %s',
+                           rows, template='(%s::jsonb, %s::integer, %s::timestamptz, %s::integer)', page_size=len(rows))
+            cursor.execute("select pg_notify(%s, '')", (get_delivery_channel(name), ))
 
     except Exception as err:
-        raise err if isinstance(err, DAOException) else DAOException('remove_delivery_msg failed.', err)
+        raise err if isinstance(err, DAOException) else DAOException('add_delivery_msgs failed.', err)
     finally:
         if conn is not None:
             conn.commit()
             free_conn(conn)
 
-def retry_delivery_msg(name: str, uid: int) -> None:
+def claim_delivery_msgs(name: str, claimant: str, batch_size: int = 10, lease_seconds: float = 300, exclude_l_uids: Optional[List[int]] = None) -> List[Tuple[int, Dict[str, Any], int]]:
+    """
+    Atomically claim up to batch_size unclaimed messages that are due for delivery, oldest
+    first, for the delivery worker identified by claimant. The claim lasts lease_seconds,
+    after which the messages may be claimed by another worker if they have not been finished.
+    Messages for the logical devices in exclude_l_uids are not claimed.
+
+    Rows being claimed by a concurrent caller are skipped rather than waited for, so any
+    number of workers in any number of processes can drain a table without delivering the
+    same message twice.
+
+    Messages stored as references are read from physical_timeseries in the same query. If the
+    physical_timeseries row no longer exists the message is returned as None.
+
+    Returns a list of (uid, message, retry_count) tuples in uid order.
+    """
+    if exclude_l_uids is None:
+        exclude_l_uids = []
+
+    table = _get_delivery_table_id(name)
+    exclude_clause = ''
+    args = [claimant, lease_seconds]
+    if len(exclude_l_uids) > 0:
+        exclude_clause = 'and coalesce(logical_uid, (json_msg->>%s)::integer) <> all(%s)'
+        args += [BrokerConstants.LOGICAL_DEVICE_UID_KEY, list(exclude_l_uids)]
+
+    args.append(batch_size)
+
+    conn = None
     try:
         with _get_connection() as conn, conn.cursor() as cursor:
-            cursor.execute(f'select retry_count from {_get_delivery_table_id(name)} where uid = %s', (uid, ))
-            if cursor.rowcount < 1:
-                return
+            cursor.execute(f"""
+                with claimed as (
+                    update {table} q set claimed_by = %s, lease_expires_at = now() + make_interval(secs => %s)
+                     where uid in (
+                        select uid from {table}
+                         where (lease_expires_at is null or lease_expires_at < now())
+                           and (next_attempt_at is null or next_attempt_at <= now())
+                           {exclude_clause}
+                         order by uid
+                         limit %s
+                         for update skip locked)
+                    returning q.uid, q.json_msg, q.retry_count, q.pts_uid, q.pts_ts)
+                select c.uid, coalesce(c.json_msg, pt.json_msg), c.retry_count
+                  from claimed c
+                  left join physical_timeseries pt on c.json_msg is null and pt.uid = c.pts_uid and pt.ts = c.pts_ts""", args)
+
+            return sorted(cursor.fetchall())
+
+    except Exception as err:
+        raise err if isinstance(err, DAOException) else DAOException('claim_delivery_msgs failed.', err)
+    finally:
+        if conn is not None:
+            conn.commit()
+            free_conn(conn)
+
+def finish_delivery_msgs(name: str, claimant: str, remove: Optional[List[int]] = None, retry: Optional[List[int]] = None, release: Optional[List[int]] = None,
+                         backoff_base: float = 0.0, backoff_factor: float = 2.0, backoff_max: float = 3600.0, backoff_jitter: float = 0.0,
+                         defer: Optional[List[int]] = None, defer_seconds: float = 0.0) -> None:
+    """
+    Settle the messages claimed by claimant in a single transaction. Messages in remove are
+    deleted, messages in retry have their retry_count incremented and are released, and
+    messages in release are released unchanged so they can be claimed again.
+
+    Messages in defer are released with their retry_count unchanged, but are not claimed again
+    for defer_seconds. This is for messages that could not be delivered because the destination
+    is unavailable, which should not count against them.
+
+    Messages in retry are not claimed again until a delay of backoff_base * backoff_factor ^ retry_count
+    seconds has passed. retry_count is the value before it is incremented, so the first retry waits
+    backoff_base seconds. backoff_jitter is the fraction by which each delay is randomly varied, so
+    messages that failed together are not all retried at the same moment. The varied delay is
+    limited to backoff_max.
+
+    Messages no longer claimed by claimant, because the lease expired and another worker
+    claimed them, are left alone.
+    """
+    remove = remove if remove is not None else []
+    retry = retry if retry is not None else []
+    release = release if release is not None else []
+    defer = defer if defer is not None else []
 
-            retry_count = cursor.fetchone()[0] + 1
-            cursor.execute(f'update {_get_delivery_table_id(name)} set retry_count = %s where uid = %s', (retry_count, uid))
+    if len(remove) < 1 and len(retry) < 1 and len(release) < 1 and len(defer) < 1:
+        return
+
+    table = _get_delivery_table_id(name)
+    conn = None
+    try:
+        with _get_connection() as conn, conn.cursor() as cursor:
+            if len(remove) > 0:
+                cursor.execute(f'delete from {table} where uid = any(%s) and claimed_by = %s', (list(remove), claimant))
+
+            if len(retry) > 0:
+                cursor.execute(f"""update {table}
+                                      set retry_count = retry_count + 1, claimed_by = null, lease_expires_at = null,
+                                          next_attempt_at = now() + make_interval(secs =>
+                                            least(%s, %s * power(%s, least(retry_count, 64)) * (1.0 + %s * (2.0 * random() - 1.0))))
+                                    where uid = any(%s) and claimed_by = %s""",
+                               (backoff_max, backoff_base, backoff_factor, backoff_jitter, list(retry), claimant))
+
+            if len(defer) > 0:
+                cursor.execute(f"""update {table}
+                                      set claimed_by = null, lease_expires_at = null, next_attempt_at = now() + make_interval(secs => %s)
+                                    where uid = any(%s) and claimed_by = %s""", (defer_seconds, list(defer), claimant))
+
+            if len(release) > 0:
+                cursor.execute(f"""update {table} set claimed_by = null, lease_expires_at = null
+                                    where uid = any(%s) and claimed_by = %s""", (list(release), claimant))
+                cursor.execute("select pg_notify(%s, '')", (get_delivery_channel(name), ))
 
     except Exception as err:
-        raise err if isinstance(err, DAOException) else DAOException('retry_delivery_msg failed.', err)
+        raise err if isinstance(err, DAOException) else DAOException('finish_delivery_msgs failed.', err)
     finally:
         if conn is not None:
             conn.commit()
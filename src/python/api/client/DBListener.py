@@ -0,0 +1,98 @@
+"""
+A thread that LISTENs on Postgres notification channels and passes the
+notifications to a callback.
+
+The listener uses its own connection rather than one from the DAO connection
+pool because the connection must stay open and idle for as long as the
+listener is running. The connection parameters come from the usual PG*
+environment variables.
+
+If the connection is lost the listener reconnects after a pause. Notifications
+sent while the listener was disconnected are lost, so callers that cache data
+should discard their caches when on_connect is called.
+"""
+
+import logging, select, time
+from threading import Event, Thread
+from typing import Callable, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+
+class Listener:
+    def __init__(self, channels: List[str], on_notify: Callable[[str, str], None], on_connect: Optional[Callable[[], None]] = None, on_disconnect: Optional[Callable[[], None]] = None, reconnect_delay: float = 5.0) -> None:
+        """
+        channels: the notification channels to LISTEN on.
+        on_notify: called as on_notify(channel, payload) from the listener thread for each notification.
+        on_connect: called from the listener thread each time the LISTENs are established.
+        on_disconnect: called from the listener thread when the connection is lost.
+        """
+        self.channels = list(channels)
+        self.on_notify = on_notify
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.reconnect_delay = reconnect_delay
+
+        self.connected = False
+        self._stop_evt = Event()
+        self._thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self._stop_evt.clear()
+        self._thread = Thread(target=self._listen_thread_proc, name='db_listener', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_evt.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _listen_thread_proc(self) -> None:
+        while not self._stop_evt.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect('')
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    for channel in self.channels:
+                        cursor.execute(f'listen {channel}')
+
+                logging.info(f'Listening for notifications on {self.channels}')
+                self.connected = True
+                if self.on_connect is not None:
+                    self.on_connect()
+
+                while not self._stop_evt.is_set():
+                    # Wake up periodically to check whether the listener has been stopped.
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        try:
+                            self.on_notify(n.channel, n.payload)
+                        except Exception:
+                            logging.exception(f'Notification callback failed for {n.channel}: {n.payload}')
+
+            except (psycopg2.Error, OSError) as err:
+                logging.warning(f'Notification listener connection failed: {err}')
+
+            finally:
+                if self.connected:
+                    self.connected = False
+                    if self.on_disconnect is not None:
+                        self.on_disconnect()
+
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+            self._stop_evt.wait(self.reconnect_delay)
@@ -0,0 +1,191 @@
+"""
+A read-through, in-process cache of physical devices, logical devices and the
+current physical to logical device mappings.
+
+The logical mapper and the delivery services look up the same few devices and
+mappings for every message they handle, so this cache saves several database
+round trips per message.
+
+Entries are invalidated by notifications sent on the device_changes channel
+by triggers on the physical_devices, logical_devices and physical_logical_map
+tables, so changes made by any process, such as the REST API, take effect
+almost immediately. The triggers do not send notifications for changes to
+only the last_seen column or the last_msg logical device property because
+those change with every message, so cached devices may have stale values
+for those fields.
+
+The cache is bypassed whenever the notification listener is not connected,
+because invalidations could be missed during that time. As a safety net,
+entries also expire after DEVICE_CACHE_TTL seconds.
+
+Callers are given copies of the cached objects so they can modify them freely.
+"""
+
+import json, logging, os, time
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import api.client.DAO as dao
+from api.client.DBListener import Listener
+from pdmodels.Models import LogicalDevice, PhysicalDevice, PhysicalToLogicalMapping
+
+NOTIFY_CHANNEL = 'device_changes'
+
+_ttl = float(os.getenv('DEVICE_CACHE_TTL', '300'))
+
+_lock = Lock()
+
+# Incremented on every invalidation. A value read from the database is only added to
+# the cache if no invalidation happened while it was being read, otherwise the cache
+# could be left holding a value that was already stale when it arrived.
+_generation = 0
+
+_physical_devices: Dict[int, Tuple[float, Optional[PhysicalDevice]]] = {}
+_logical_devices: Dict[int, Tuple[float, Optional[LogicalDevice]]] = {}
+
+# Keyed by physical device uid. None values record that the physical device has no
+# current mapping.
+_mappings: Dict[int, Tuple[float, Optional[PhysicalToLogicalMapping]]] = {}
+
+_listener: Optional[Listener] = None
+
+
+def start() -> None:
+    """
+    Start listening for invalidation notifications. The cache is not used until the
+    listener has connected.
+    """
+    global _listener
+
+    with _lock:
+        if _listener is None:
+            _listener = Listener([NOTIFY_CHANNEL], _on_notify, on_connect=invalidate_all, on_disconnect=invalidate_all)
+            _listener.start()
+
+
+def stop() -> None:
+    global _listener
+
+    with _lock:
+        listener = _listener
+        _listener = None
+
+    if listener is not None:
+        listener.stop()
+
+    invalidate_all()
+
+
+def is_active() -> bool:
+    listener = _listener
+    return listener is not None and listener.connected
+
+
+def invalidate_all() -> None:
+    global _generation
+
+    with _lock:
+        _generation += 1
+        _physical_devices.clear()
+        _logical_devices.clear()
+        _mappings.clear()
+
+
+def get_physical_device(uid: int) -> Optional[PhysicalDevice]:
+    return _copy(_read_through(_physical_devices, uid, dao.get_physical_device))
+
+
+def get_logical_device(uid: int) -> Optional[LogicalDevice]:
+    return _copy(_read_through(_logical_devices, uid, dao.get_logical_device))
+
+
+def get_current_device_mapping(p_uid: int) -> Optional[PhysicalToLogicalMapping]:
+    """
+    Returns the current mapping for the physical device with the given uid, or None if
+    the physical device is not mapped.
+    """
+    return _copy(_read_through(_mappings, p_uid, _load_mapping))
+
+
+def _load_mapping(p_uid: int) -> Optional[PhysicalToLogicalMapping]:
+    return dao.get_current_device_mapping(pd=p_uid)
+
+
+def _read_through(table: Dict[int, Tuple[float, Any]], key: int, loader: Callable[[int], Any]) -> Any:
+    now = time.monotonic()
+
+    with _lock:
+        use_cache = is_active()
+        if use_cache:
+            entry = table.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+        generation = _generation
+
+    value = loader(key)
+
+    if use_cache:
+        with _lock:
+            if generation == _generation:
+                table[key] = (now + _ttl, value)
+
+                # Loading a mapping also loads both devices, so remember them too.
+                if isinstance(value, PhysicalToLogicalMapping):
+                    if isinstance(value.pd, PhysicalDevice):
+                        _physical_devices[value.pd.uid] = (now + _ttl, value.pd)
+                    if isinstance(value.ld, LogicalDevice):
+                        _logical_devices[value.ld.uid] = (now + _ttl, value.ld)
+
+    return value
+
+
+def _copy(value: Any) -> Any:
+    return value.copy(deep=True) if value is not None else None
+
+
+def _mapping_l_uid(mapping: Optional[PhysicalToLogicalMapping]) -> Optional[int]:
+    if mapping is None:
+        return None
+
+    return mapping.ld.uid if isinstance(mapping.ld, LogicalDevice) else mapping.ld
+
+
+def _drop_mappings_to_logical_device(l_uid: int) -> None:
+    for p_uid in [k for k, (_, m) in _mappings.items() if _mapping_l_uid(m) == l_uid]:
+        del _mappings[p_uid]
+
+
+def _on_notify(channel: str, payload: str) -> None:
+    global _generation
+
+    try:
+        change = json.loads(payload)
+    except ValueError:
+        logging.warning(f'Invalid device change notification, clearing cache: {payload}')
+        invalidate_all()
+        return
+
+    table = change.get('table')
+
+    with _lock:
+        _generation += 1
+
+        if table == 'physical_devices':
+            _physical_devices.pop(change['uid'], None)
+            _mappings.pop(change['uid'], None)
+
+        elif table == 'logical_devices':
+            _logical_devices.pop(change['uid'], None)
+            _drop_mappings_to_logical_device(change['uid'])
+
+        elif table == 'physical_logical_map':
+            # Inserting a mapping for a logical device can end the logical device's
+            # previous mapping, so drop every mapping involving either device.
+            _mappings.pop(change['physical_uid'], None)
+            _drop_mappings_to_logical_device(change['logical_uid'])
+
+        else:
+            _physical_devices.clear()
+            _logical_devices.clear()
+            _mappings.clear()
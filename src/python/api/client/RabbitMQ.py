@@ -176,7 +176,7 @@ class TxChannel(object):
             asyncio.create_task(self._on_ready(self))
 
 
-    def publish_message(self, routing_key: str, message) -> int:
+    def publish_message(self, routing_key: str, message, headers: dict | None = None) -> int:
         """
         Publish a message to RabbitMQ.
 
@@ -187,6 +187,8 @@ class TxChannel(object):
         All messages are published persistently so they can survive a
         RabbitMQ server restart. The server is not meant to ack receipt
         of a message until it has been written to disk.
+
+        headers are sent as the AMQP message headers, if given.
         """
         if self._channel is None or not self._channel.is_open:
             return
@@ -194,7 +196,8 @@ class TxChannel(object):
         properties = pika.BasicProperties(
             app_id='broker',
             content_type='application/json',
-            delivery_mode = pika.spec.PERSISTENT_DELIVERY_MODE
+            delivery_mode = pika.spec.PERSISTENT_DELIVERY_MODE,
+            headers=headers
             )
 
         self._channel.basic_publish(self._exchange_name, routing_key,
@@ -0,0 +1,125 @@
+"""
+An in-process cache of the users that own authentication tokens, used by the
+REST API to authenticate requests without querying the database every time.
+
+Entries are invalidated by notifications sent on the user_changes channel by a
+trigger on the users table, so changes made by any process, such as disabling
+or refreshing a token with broker-cli, take effect almost immediately. Callers
+that change a token themselves can also invalidate it directly with
+invalidate_token().
+
+The cache is bypassed whenever the notification listener is not connected,
+because invalidations could be missed during that time. As a safety net,
+entries also expire after AUTH_CACHE_TTL seconds. Unknown tokens are not
+cached, so invalid tokens cannot fill the cache.
+"""
+
+import json, logging, os, time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import api.client.AsyncDAO as dao
+from api.client.DBListener import Listener
+from pdmodels.Models import User
+
+NOTIFY_CHANNEL = 'user_changes'
+
+_ttl = float(os.getenv('AUTH_CACHE_TTL', '60'))
+
+_lock = Lock()
+
+# Incremented on every invalidation, see DeviceCache.
+_generation = 0
+
+_users: Dict[str, Tuple[float, User]] = {}
+
+_listener: Optional[Listener] = None
+
+
+def start() -> None:
+    """
+    Start listening for invalidation notifications. The cache is not used until the
+    listener has connected.
+    """
+    global _listener
+
+    with _lock:
+        if _listener is None:
+            _listener = Listener([NOTIFY_CHANNEL], _on_notify, on_connect=invalidate_all, on_disconnect=invalidate_all)
+            _listener.start()
+
+
+def stop() -> None:
+    global _listener
+
+    with _lock:
+        listener = _listener
+        _listener = None
+
+    if listener is not None:
+        listener.stop()
+
+    invalidate_all()
+
+
+def is_active() -> bool:
+    listener = _listener
+    return listener is not None and listener.connected
+
+
+def invalidate_all() -> None:
+    global _generation
+
+    with _lock:
+        _generation += 1
+        _users.clear()
+
+
+def invalidate_token(token: str) -> None:
+    global _generation
+
+    with _lock:
+        _generation += 1
+        _users.pop(token, None)
+
+
+async def get_user(token: str) -> Optional[User]:
+    """
+    Returns the user with the given authentication token, whether or not the token is
+    valid, or None if no user has the token.
+    """
+    now = time.monotonic()
+
+    with _lock:
+        use_cache = is_active()
+        if use_cache:
+            entry = _users.get(token)
+            if entry is not None and entry[0] > now:
+                return entry[1].copy()
+
+        generation = _generation
+
+    user = await dao.get_user(auth_token=token)
+
+    if use_cache and user is not None:
+        with _lock:
+            if generation == _generation:
+                _users[token] = (now + _ttl, user)
+
+    return user.copy() if user is not None else None
+
+
+def _on_notify(channel: str, payload: str) -> None:
+    global _generation
+
+    try:
+        uid = json.loads(payload)['uid']
+    except (ValueError, KeyError, TypeError):
+        logging.warning(f'Invalid user change notification, clearing cache: {payload}')
+        invalidate_all()
+        return
+
+    with _lock:
+        _generation += 1
+        for token in [t for t, (_, u) in _users.items() if u.uid == uid]:
+            del _users[token]
@@ -1,7 +1,22 @@
-from typing import List
-import requests
-import requests.exceptions
-import datetime, json, logging, os, time
+"""
+A client for the Ubidots REST API.
+
+Requests are made over a pool of keep-alive connections, and are limited by a
+token bucket shared by every caller in the process, including the async
+versions of these functions in api.client.AsyncUbidots, so the process stays
+within the account's request quota without pausing before every call.
+
+Requests that time out, fail to connect, or receive a 429 or 5xx response are
+retried up to UBIDOTS_MAX_RETRIES times with exponential backoff and jitter,
+honouring any Retry-After header. stats() returns request counts, errors and
+latencies for each kind of call.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Dict, List, Optional
+import httpx
+import asyncio, datetime, logging, math, os, random, time
 
 from pdmodels.Models import Location, LogicalDevice
 
@@ -15,6 +30,67 @@ headers = {
     "X-Auth-Token": os.environ['UBIDOTS_API_TOKEN'],
 }
 
+# Ubidots limits the request rate per account token, so these should be set from the
+# account's plan. The defaults are conservative.
+RATE_LIMIT = float(os.getenv('UBIDOTS_RATE_LIMIT', '4'))
+RATE_BURST = float(os.getenv('UBIDOTS_RATE_BURST', '4'))
+
+MAX_RETRIES = int(os.getenv('UBIDOTS_MAX_RETRIES', '3'))
+TIMEOUT = float(os.getenv('UBIDOTS_TIMEOUT', '10'))
+POOL_SIZE = int(os.getenv('UBIDOTS_POOL_SIZE', '10'))
+
+# The first retry waits up to RETRY_BASE seconds, doubling for each retry up to RETRY_MAX.
+RETRY_BASE = 1.0
+RETRY_MAX = 30.0
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket allowing rate requests per second on average, with bursts of up
+    to capacity requests. Waiting callers are served in the order they asked for a token.
+    """
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token, returning how many seconds the caller must wait before using it.
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
+
+_metrics_lock = Lock()
+_metrics: Dict[str, Dict[str, Any]] = {}
+
+_client: Optional[httpx.Client] = None
+_client_lock = Lock()
+
 """
 Example Ubidots JSON device definition FROM THE 2.0 API! The field names are different between the 1.6 and 2.0 APIs.
 
@@ -82,43 +158,179 @@ def _dict_to_logical_device(ubidots_dict) -> LogicalDevice:
     return LogicalDevice(name=ubidots_dict['name'], last_seen=last_seen, location=location, properties={'ubidots': ubidots_dict})
 
 
-def get_all_devices() -> List[LogicalDevice]:
-    page = 1
-    devices = []
+def stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns, for each kind of call, the number of requests made, retries, errors by status
+    code or exception name, and the mean and maximum latency in seconds.
+    """
+    with _metrics_lock:
+        return {op: {
+                    'requests': m['requests'],
+                    'retries': m['retries'],
+                    'errors': dict(m['errors']),
+                    'mean_latency': m['total_latency'] / m['requests'] if m['requests'] > 0 else 0.0,
+                    'max_latency': m['max_latency'],
+                } for op, m in _metrics.items()}
+
+
+def _record(op: str, latency: float, error: Optional[str] = None, retry: bool = False) -> None:
+    with _metrics_lock:
+        m = _metrics.setdefault(op, {'requests': 0, 'retries': 0, 'errors': {}, 'total_latency': 0.0, 'max_latency': 0.0})
+        m['requests'] += 1
+        m['total_latency'] += latency
+        m['max_latency'] = max(m['max_latency'], latency)
+        if error is not None:
+            m['errors'][error] = m['errors'].get(error, 0) + 1
+        if retry:
+            m['retries'] += 1
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            return min(RETRY_MAX, float(response.headers['Retry-After']))
+        except ValueError:
+            pass
+
+    return random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt))
+
+
+def _should_retry(op: str, attempt: int, start: float, response: Optional[httpx.Response], err: Optional[Exception], logging_ctx: Optional[dict]) -> bool:
+    """
+    Record the outcome of a request and decide whether it should be retried.
+    """
+    latency = time.monotonic() - start
+    if err is not None:
+        error = type(err).__name__
+    elif response.status_code >= 400:
+        error = str(response.status_code)
+    else:
+        error = None
+
+    retry = attempt < MAX_RETRIES and (err is not None or response.status_code in _RETRY_STATUS)
+    _record(op, latency, error, retry)
+
+    if retry:
+        _log(logging.WARNING, f'{op} failed ({error}), retrying.', logging_ctx)
+
+    return retry
 
+
+def _log(level: int, msg: str, logging_ctx: Optional[dict]) -> None:
+    # The correlation id logger can only be used when there is a correlation id.
+    if logging_ctx is not None:
+        lu.cid_logger.log(level, msg, extra=logging_ctx)
+    else:
+        logging.log(level, msg)
+
+
+def _get_client() -> httpx.Client:
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                limits = httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+                _client = httpx.Client(headers=headers, timeout=TIMEOUT, limits=limits)
+
+    return _client
+
+
+def _request(op: str, method: str, url: str, logging_ctx: Optional[dict] = None, **kwargs) -> Optional[httpx.Response]:
+    """
+    Make a rate limited request, retrying temporary failures. Returns the final response, or
+    None if no response was received.
+    """
+    attempt = 0
     while True:
-        time.sleep(0.3)
-        url = f'{BASE_2_0}/devices/?page={page}'
-        r = requests.get(url, headers=headers)
-        if r.status_code != 200:
-            logging.warn(f'devices/ received response: {r.status_code}: {r.reason}')
-            logging.warn('Returning before all devices were retrieved.')
-            break
+        limiter.acquire()
+        response = None
+        err = None
+        start = time.monotonic()
+        try:
+            response = _get_client().request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            err = e
 
-        response_obj = json.loads(r.content)
-        logging.debug(f'Adding {len(response_obj["results"])} devices to array.')
+        if not _should_retry(op, attempt, start, response, err, logging_ctx):
+            if err is not None:
+                _log(logging.ERROR, f'{method} {url} failed: {err}', logging_ctx)
+            return response
 
-        for u in response_obj['results']:
-            devices.append(_dict_to_logical_device(u))
+        time.sleep(_retry_delay(attempt, response))
+        attempt += 1
+
+
+def close() -> None:
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
 
-        if response_obj['next'] is None:
+
+def _page_count(response_obj: dict) -> Optional[int]:
+    """
+    Returns the number of pages of results, calculated from the first page, or None if the
+    response does not say how many results there are.
+    """
+    if 'count' not in response_obj or len(response_obj['results']) < 1:
+        return None
+
+    return math.ceil(response_obj['count'] / len(response_obj['results']))
+
+
+def get_all_devices() -> List[LogicalDevice]:
+    """
+    Returns every device in the account. The first page of devices is used to find how many
+    pages there are, and the rest are fetched concurrently.
+    """
+    def get_page(page: int) -> Optional[dict]:
+        r = _request('get_all_devices', 'GET', f'{BASE_2_0}/devices/', params={'page': page})
+        if r is None or r.status_code != 200:
+            if r is not None:
+                logging.warning(f'devices/ page {page} received response: {r.status_code}: {r.reason_phrase}')
+            return None
+
+        return r.json()
+
+    first = get_page(1)
+    if first is None:
+        logging.warning('Returning before all devices were retrieved.')
+        return []
+
+    pages = [first]
+    page_count = _page_count(first)
+    if page_count is not None:
+        with ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='ubidots') as executor:
+            pages += executor.map(get_page, range(2, page_count + 1))
+    else:
+        while pages[-1] is not None and pages[-1]['next'] is not None:
+            pages.append(get_page(len(pages) + 1))
+
+    devices = []
+    for response_obj in pages:
+        if response_obj is None:
+            logging.warning('Returning before all devices were retrieved.')
             break
 
-        page += 1
+        logging.debug(f'Adding {len(response_obj["results"])} devices to array.')
+        for u in response_obj['results']:
+            devices.append(_dict_to_logical_device(u))
 
     return devices
 
 
 def get_device(label: str, logging_ctx: dict) -> LogicalDevice:
-        url = f'{BASE_2_0}/devices/~{label}'
-        time.sleep(0.3)
-        r = requests.get(url, headers=headers)
-        if r.status_code != 200:
-            lu.cid_logger.error(f'devices/~{label} received response: {r.status_code}: {r.reason}', extra=logging_ctx)
-            return None
+    url = f'{BASE_2_0}/devices/~{label}'
+    r = _request('get_device', 'GET', url, logging_ctx)
+    if r is None or r.status_code != 200:
+        if r is not None:
+            lu.cid_logger.error(f'devices/~{label} received response: {r.status_code}: {r.reason_phrase}', extra=logging_ctx)
+        return None
 
-        response_obj = json.loads(r.content)
-        return _dict_to_logical_device(response_obj)
+    return _dict_to_logical_device(r.json())
 
 
 def post_device_data(label: str, body: dict, logging_ctx: dict) -> bool:
@@ -133,23 +345,13 @@ def post_device_data(label: str, body: dict, logging_ctx: dict) -> bool:
         'temperature': {'value': 37.17, 'timestamp': 1643934748392}
         }
     """
-    time.sleep(0.3)
     url = f'{BASE_1_6}/devices/{label}'
-    hdrs = headers
-    hdrs['Content-Type'] = 'application/json'
-    body_str = json.dumps(body)
-    while True:
-        try:
-            r = requests.post(url, headers=hdrs, data=body_str, timeout=10)
-            break
-        except requests.exceptions.Timeout:
-            if cid is None:
-                logging.error('POST timed out.')
-            else:
-                logging.error(f'[{cid}] POST timed out.')
+    r = _request('post_device_data', 'POST', url, logging_ctx, json=body)
+    if r is None:
+        return False
 
     if r.status_code != 200:
-        lu.cid_logger.info(f'POST {url}: {r.status_code}: {r.reason}', extra=logging_ctx)
+        lu.cid_logger.info(f'POST {url}: {r.status_code}: {r.reason_phrase}', extra=logging_ctx)
         return False
 
     return True
@@ -157,10 +359,9 @@ def post_device_data(label: str, body: dict, logging_ctx: dict) -> bool:
 
 def update_device(label: str, patch_obj: dict, logging_ctx: dict) -> None:
     url = f'{BASE_2_0}/devices/~{label}'
-    time.sleep(0.3)
-    response = requests.patch(url, headers=headers, json=patch_obj)
-    if response.status_code != 200:
-        lu.cid_logger.error(f'PATCH response: {response.status_code}: {response.reason}', extra=logging_ctx)
+    r = _request('update_device', 'PATCH', url, logging_ctx, json=patch_obj)
+    if r is not None and r.status_code != 200:
+        lu.cid_logger.error(f'PATCH response: {r.status_code}: {r.reason_phrase}', extra=logging_ctx)
 
 
 def main():
@@ -164,6 +164,20 @@ user_pw_change_passer.add_argument('-p', help="New password for user", dest='pas
 # List users
 user_sub_parsers.add_parser('ls', help="List all users")
 
+# Database maintenance commands
+db_parser = main_sub_parsers.add_parser('db', help="database maintenance")
+db_sub_parsers = db_parser.add_subparsers(dest='cmd2')
+
+# Create physical_timeseries partitions
+db_parts_parser = db_sub_parsers.add_parser('partitions', help="Create the monthly physical_timeseries partitions ahead of time")
+db_parts_parser.add_argument('--months', type=int, help="How many months ahead to create partitions for", dest='months', default=3)
+
+# Update the timeseries rollups
+db_sub_parsers.add_parser('rollups', help="Add new physical_timeseries rows to the hourly and daily rollups")
+
+# Backfill timeseries_values
+db_sub_parsers.add_parser('backfill-values', help="Add the values of messages stored before timeseries_values existed to that table")
+
 args = main_parser.parse_args()
 
 def serialise_datetime(obj):
@@ -196,8 +210,9 @@ def get_last_seen(d: PhysicalDevice | LogicalDevice) -> str:
 
 
 def plain_pd_list(devs: List[PhysicalDevice]):
+    mappings = {m.pd.uid: m for m in dao.get_all_current_mappings(return_uids=False)}
     for d in devs:
-        m = dao.get_current_device_mapping(pd=d.uid)
+        m = mappings.get(d.uid)
         print(f'{d.uid: >5}   {d.name: <48}   {get_last_seen(d)}', end='')
         if m is not None:
             l = m.ld
@@ -371,7 +386,7 @@ def main() -> None:
                 print(pretty_print_json(new_list))
 
         elif args.cmd2 == 'toggle':
-            current_mapping = dao.get_current_device_mapping(pd=args.p_uid, ld=args.l_uid)
+            current_mapping = dao.get_current_device_mapping(pd=args.p_uid, ld=args.l_uid, return_uids=True)
             if current_mapping is None:
                 raise RuntimeError("No current mapping for the uid given")
 
@@ -402,6 +417,23 @@ def main() -> None:
         elif args.cmd2 == 'ls':
             print(dao.user_ls())
 
+    elif args.cmd1 == 'db':
+        if args.cmd2 == 'partitions':
+            print(dao.create_physical_timeseries_partitions(args.months))
+
+        elif args.cmd2 == 'rollups':
+            total = 0
+            max_uids = 100000
+            while (covered := dao.update_timeseries_rollups(max_uids)) >= max_uids:
+                total += covered
+            print(total + covered)
+
+        elif args.cmd2 == 'backfill-values':
+            total = 0
+            while (covered := dao.backfill_timeseries_values()) > 0:
+                total += covered
+            print(total)
+
 
 if __name__ == '__main__':
     main()
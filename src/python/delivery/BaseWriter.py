@@ -1,15 +1,20 @@
-from threading import Thread, Event
-from typing import Any
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, NamedTuple, Tuple
 
 from pdmodels.Models import LogicalDevice, PhysicalDevice
 
-import json, logging, os, signal, time
+import json, logging, os, signal, socket, time, uuid
 
 import BrokerConstants
 import pika, pika.channel, pika.spec
 from pika.exchange_type import ExchangeType
 
 import api.client.DAO as dao
+import api.client.DeviceCache as device_cache
+from api.client.DBListener import Listener
+from delivery.CircuitBreaker import CircuitBreaker, CLOSED
+from delivery.DeliveryLanes import DeliveryLanes
+from delivery.DeliveryPolicies import DeliveryPolicies
 import util.LoggingUtil as lu
 
 _user = os.environ['RABBITMQ_DEFAULT_USER']
@@ -19,176 +24,785 @@ _port = os.environ['RABBITMQ_PORT']
 
 _amqp_url_str = f'amqp://{_user}:{_passwd}@{_host}:{_port}/%2F'
 
+# Defaults for the number of delivery threads, the number of messages claimed from the
+# delivery table at once, and how long a claim lasts before the messages can be claimed by
+# another process, eg because the process holding them has died.
+_workers = int(os.getenv('DELIVERY_WORKERS', '1'))
+_batch_size = int(os.getenv('DELIVERY_BATCH_SIZE', '10'))
+_lease_seconds = float(os.getenv('DELIVERY_LEASE_SECONDS', '300'))
+
+# When there are several delivery threads, messages for a logical device are not claimed
+# while this many of its messages are already waiting or being delivered, so one busy
+# device cannot fill the delivery threads' queues.
+_max_per_device = int(os.getenv('DELIVERY_MAX_PER_DEVICE', '10'))
+
+# How often the writer's status is logged, in seconds.
+_status_interval = 60.0
+
+# Defaults for how many unacknowledged messages RabbitMQ sends at once, and how many messages
+# are added to the delivery table in each transaction, or how many milliseconds to wait for
+# that many to arrive.
+_prefetch = int(os.getenv('DELIVERY_PREFETCH', '100'))
+_intake_batch_size = int(os.getenv('DELIVERY_INTAKE_BATCH_SIZE', '50'))
+_intake_max_wait_ms = float(os.getenv('DELIVERY_INTAKE_MAX_WAIT_MS', '100'))
+
+# How long to wait before trying again to add messages to the delivery table when it failed.
+_intake_retry_seconds = 1.0
+
+# The default for whether messages already stored in physical_timeseries are added to the
+# delivery table as references to their rows rather than as copies.
+_reference_mode = os.getenv('DELIVERY_REFERENCE_MODE', 'false').lower() in ('1', 'true', 'yes')
+
+# Retry backoff policy overrides, see BaseWriter.
+_retry_base = os.getenv('DELIVERY_RETRY_BASE')
+_retry_factor = os.getenv('DELIVERY_RETRY_FACTOR')
+_retry_max = os.getenv('DELIVERY_RETRY_MAX')
+_retry_jitter = os.getenv('DELIVERY_RETRY_JITTER')
+
+# Batching rule overrides for writers that implement on_batch, see BaseWriter.
+_batch_max_items = os.getenv('DELIVERY_BATCH_MAX_ITEMS')
+_batch_max_bytes = os.getenv('DELIVERY_BATCH_MAX_BYTES')
+_batch_max_wait_ms = os.getenv('DELIVERY_BATCH_MAX_WAIT_MS')
+_batch_by_logical_device = os.getenv('DELIVERY_BATCH_BY_LOGICAL_DEVICE')
+
+# Circuit breaker overrides, see BaseWriter.
+_breaker_threshold = os.getenv('DELIVERY_BREAKER_THRESHOLD')
+_breaker_open_seconds = os.getenv('DELIVERY_BREAKER_OPEN_SECONDS')
+_breaker_max_open_seconds = os.getenv('DELIVERY_BREAKER_MAX_OPEN_SECONDS')
+
+# Idle delivery threads are woken by a notification when messages are added to the delivery
+# table by any process, or when a message being retried becomes due. These are the longest
+# they wait before checking the delivery table anyway, for when notifications are working
+# and when they are not.
+_max_idle_seconds = 60.0
+_idle_poll_seconds = 10.0
+
+
+class DeliveryItem(NamedTuple):
+    """
+    A message passed to BaseWriter.on_batch, with the same values on_message is called with.
+    """
+    pd: PhysicalDevice
+    ld: LogicalDevice
+    msg: Dict[str, Any]
+    retry_count: int
+
 
 class BaseWriter:
     MSG_OK = 0
     MSG_RETRY = 1
     MSG_FAIL = 2
 
-    def __init__(self, name) -> None:
+    # The default retry backoff policy. A message is retried RETRY_BASE * RETRY_FACTOR ^ n
+    # seconds after on_message returns MSG_RETRY for the nth time, counting from 0, up to
+    # RETRY_MAX seconds. Each delay is randomly varied by up to the fraction RETRY_JITTER.
+    # Subclasses can override these to suit their destination, and they can be overridden
+    # for a deployment with $DELIVERY_RETRY_BASE, $DELIVERY_RETRY_FACTOR, $DELIVERY_RETRY_MAX
+    # and $DELIVERY_RETRY_JITTER.
+    RETRY_BASE = 5.0
+    RETRY_FACTOR = 2.0
+    RETRY_MAX = 600.0
+    RETRY_JITTER = 0.1
+
+    # The batching rules used when a subclass implements on_batch. Each call is given at most
+    # BATCH_MAX_ITEMS messages, and at most BATCH_MAX_BYTES of message JSON unless a single
+    # message is larger than that. A delivery thread that claims fewer than BATCH_MAX_ITEMS
+    # messages waits up to BATCH_MAX_WAIT_MS for more before delivering them. If
+    # BATCH_BY_LOGICAL_DEVICE is True, each call is given messages for only one logical device.
+    # They can be overridden for a deployment with $DELIVERY_BATCH_MAX_ITEMS,
+    # $DELIVERY_BATCH_MAX_BYTES, $DELIVERY_BATCH_MAX_WAIT_MS and $DELIVERY_BATCH_BY_LOGICAL_DEVICE.
+    BATCH_MAX_ITEMS = 100
+    BATCH_MAX_BYTES = 1024 * 1024
+    BATCH_MAX_WAIT_MS = 0.0
+    BATCH_BY_LOGICAL_DEVICE = False
+
+    # The circuit breaker settings. Delivery stops for BREAKER_OPEN_SECONDS after BREAKER_THRESHOLD
+    # consecutive deliveries fail with MSG_RETRY, then a single message is delivered to probe the
+    # destination. Each failed probe doubles the time until the next, up to BREAKER_MAX_OPEN_SECONDS,
+    # and a successful probe resumes delivery. A BREAKER_THRESHOLD of 0 disables the breaker.
+    # They can be overridden for a deployment with $DELIVERY_BREAKER_THRESHOLD,
+    # $DELIVERY_BREAKER_OPEN_SECONDS and $DELIVERY_BREAKER_MAX_OPEN_SECONDS.
+    BREAKER_THRESHOLD = 5
+    BREAKER_OPEN_SECONDS = 30.0
+    BREAKER_MAX_OPEN_SECONDS = 600.0
+
+    def __init__(self, name, workers: int | None = None, batch_size: int | None = None, lease_seconds: float | None = None,
+                 prefetch: int | None = None, intake_batch_size: int | None = None, intake_max_wait_ms: float | None = None,
+                 reference_mode: bool | None = None) -> None:
+        """
+        name: The name of the service, used to name its delivery table and message queue.
+        workers: The number of threads delivering messages, defaults to $DELIVERY_WORKERS.
+        batch_size: The number of messages claimed at once, defaults to $DELIVERY_BATCH_SIZE.
+        lease_seconds: How long a claim on a batch of messages lasts, defaults to $DELIVERY_LEASE_SECONDS.
+                       This must be longer than it takes to deliver a batch.
+        prefetch: The RabbitMQ prefetch count, defaults to $DELIVERY_PREFETCH.
+        intake_batch_size: The most messages added to the delivery table per transaction, defaults
+                           to $DELIVERY_INTAKE_BATCH_SIZE. It is limited to prefetch.
+        intake_max_wait_ms: How long to wait for a batch to fill before adding it to the delivery table,
+                            defaults to $DELIVERY_INTAKE_MAX_WAIT_MS.
+        reference_mode: If True, messages that have been stored in physical_timeseries are added to the
+                        delivery table as references to their physical_timeseries rows, and read from
+                        there when they are claimed. Defaults to $DELIVERY_REFERENCE_MODE.
+        """
         self.name: str = name
-        self.connection = None
+        self.workers: int = max(1, workers if workers is not None else _workers)
+        self.batch_size: int = max(1, batch_size if batch_size is not None else _batch_size)
+        self.lease_seconds: float = lease_seconds if lease_seconds is not None else _lease_seconds
+        self.prefetch: int = max(1, prefetch if prefetch is not None else _prefetch)
+        self.intake_batch_size: int = min(self.prefetch, max(1, intake_batch_size if intake_batch_size is not None else _intake_batch_size))
+        self.intake_max_wait: float = max(0.0, intake_max_wait_ms if intake_max_wait_ms is not None else _intake_max_wait_ms) / 1000.0
+        self.reference_mode: bool = reference_mode if reference_mode is not None else _reference_mode
+        self.retry_base: float = float(_retry_base) if _retry_base is not None else self.RETRY_BASE
+        self.retry_factor: float = float(_retry_factor) if _retry_factor is not None else self.RETRY_FACTOR
+        self.retry_max: float = float(_retry_max) if _retry_max is not None else self.RETRY_MAX
+        self.retry_jitter: float = float(_retry_jitter) if _retry_jitter is not None else self.RETRY_JITTER
+        self.batch_max_items: int = max(1, int(_batch_max_items) if _batch_max_items is not None else self.BATCH_MAX_ITEMS)
+        self.batch_max_bytes: int = int(_batch_max_bytes) if _batch_max_bytes is not None else self.BATCH_MAX_BYTES
+        self.batch_max_wait: float = (float(_batch_max_wait_ms) if _batch_max_wait_ms is not None else self.BATCH_MAX_WAIT_MS) / 1000.0
+        self.batch_by_logical_device: bool = _batch_by_logical_device.lower() in ('1', 'true', 'yes') if _batch_by_logical_device is not None else self.BATCH_BY_LOGICAL_DEVICE
+
+        # on_batch is used in place of on_message if a subclass implements it.
+        self.uses_on_batch: bool = type(self).on_batch is not BaseWriter.on_batch
+        if self.uses_on_batch:
+            self.batch_size = max(self.batch_size, self.batch_max_items)
         self.channel = None
         self.keep_running = True
-
-        # The Event is used to signal the delivery thread that a new message has arrived or
-        # that it should stop.
+        self._delivery_thread: Thread | None = None
+
+        # Messages received from RabbitMQ waiting to be added to the delivery table, as
+        # (delivery tag, message, physical_timeseries uid).
+        self._intake: List[Tuple[int, dict[Any], int | None]] = []
+        self._intake_started = 0.0
+        # When the intake batch could not be added to the delivery table, it is not tried again
+        # until this time.
+        self._intake_retry_at = 0.0
+
+        # While the destination is unavailable the breaker stops messages being claimed, so they
+        # wait in the delivery table without using up their retries.
+        self.breaker = CircuitBreaker(name,
+            int(_breaker_threshold) if _breaker_threshold is not None else self.BREAKER_THRESHOLD,
+            float(_breaker_open_seconds) if _breaker_open_seconds is not None else self.BREAKER_OPEN_SECONDS,
+            float(_breaker_max_open_seconds) if _breaker_max_open_seconds is not None else self.BREAKER_MAX_OPEN_SECONDS,
+            on_change=self._on_breaker_change)
+
+        # Messages a logical device's delivery policy says the destination does not need are
+        # removed without being delivered, see delivery.DeliveryPolicies.
+        self.policies = DeliveryPolicies(name)
+
+        # Identifies this process's claims on messages in the delivery table.
+        self.claimant = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+        # With more than one worker, messages are claimed by a dispatch thread and delivered by
+        # one thread per lane. The delivery threads put the results here for the dispatch thread
+        # to write to the delivery table, as (remove, retry, release, defer) lists of message uids.
+        self.lanes: DeliveryLanes | None = DeliveryLanes(self.workers) if self.workers > 1 else None
+        self.max_per_device: int = max(1, _max_per_device)
+        self.max_in_flight: int = self.workers * self.batch_size * 2
+        self._results_lock = Lock()
+        self._results: Tuple[List[int], List[int], List[int], List[int]] = ([], [], [], [])
+
+        # The uid of the message claimed to probe the destination while the breaker is half-open,
+        # so the lane thread that takes it can tell it from the messages queued before.
+        self._probe_uid: int | None = None
+
+        # The Event is used to signal the delivery threads that a new message has arrived or
+        # that they should stop. It is set by the main loop when it adds a message, and by
+        # the listener when a message is added by another process. The listener is shared by
+        # the writers in a process and is set by run_writers.
         self.evt = Event()
-
-        signal.signal(signal.SIGTERM, self.sigterm_handler)
+        self.listener: Listener | None = None
 
     def run(self) -> None:
         """
         This method runs the blocking MQTT loop, waiting for messages from upstream
-        and writing them to the backing table. A separate thread reads them from
-        the backing table and attempts to deliver them.
+        and writing them to the backing table. Separate threads claim them from
+        the backing table and attempt to deliver them.
+
+        With one worker, a single thread claims and delivers messages in the order
+        they were received. With more, messages are delivered concurrently by one
+        thread per lane, but in order for each logical device. Delivery is in order
+        only within a process, and messages being retried are delivered after later
+        messages from the same device.
+
+        Messages are not delivered while the circuit breaker is open, so during an
+        outage of the destination they are kept in the backing table, which is
+        reported as the backlog by status().
+
+        See run_writers to run several writers in one process.
+        """
+        run_writers([self])
+
+    def start(self) -> None:
+        """
+        Create the backing table and start the delivery threads. Called by run_writers before
+        any messages are received. Subclasses that need threads of their own can extend this
+        method and join().
         """
         logging.info('===============================================================')
         logging.info(f'               STARTING {self.name.upper()} WRITER')
         logging.info('===============================================================')
 
-        delivery_thread = None
+        dao.create_delivery_table(self.name)
+
+        self.evt.clear()
+        if self.lanes is None:
+            self._delivery_thread = Thread(target=self.delivery_thread_proc, args=(self.claimant, ), name=f'{self.name}_delivery_thread')
+        else:
+            self._delivery_thread = Thread(target=self.dispatch_thread_proc, args=(self.claimant, ), name=f'{self.name}_dispatch_thread')
+
+        self._delivery_thread.start()
+
+    def stop(self) -> None:
+        """
+        Tell the main loop and delivery threads to stop.
+        """
+        self.keep_running = False
+        self.evt.set()
+
+    def join(self) -> None:
+        """
+        Wait for the delivery threads to finish, after stop() has been called.
+        """
+        logging.info(f'Waiting for {self.name} delivery threads')
+        if self._delivery_thread is not None:
+            self._delivery_thread.join()
+
+    def open_channel(self, connection: pika.BlockingConnection) -> None:
+        """
+        Open a channel of this writer's own on connection, declare the writer's queue and start
+        consuming from it. Messages received before the channel was opened and not yet added to
+        the backing table are dropped from the intake batch, because RabbitMQ redelivers them.
+        """
+        logging.info(f'Opening {self.name} channel')
+        self._intake.clear()
+        self.channel = connection.channel()
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        logging.info('Declaring exchange')
+        self.channel.exchange_declare(
+                exchange=BrokerConstants.LOGICAL_TIMESERIES_EXCHANGE_NAME,
+                exchange_type=ExchangeType.fanout,
+                durable=True)
+        logging.info('Declaring queue')
+        self.channel.queue_declare(queue=f'{self.name}_logical_msg_queue', durable=True)
+        self.channel.queue_bind(f'{self.name}_logical_msg_queue', BrokerConstants.LOGICAL_TIMESERIES_EXCHANGE_NAME, 'logical_timeseries')
+        self.channel.basic_consume(f'{self.name}_logical_msg_queue', self._on_intake)
+
+    def _on_intake(self, channel: pika.adapters.blocking_connection.BlockingChannel, method: pika.spec.Basic.Deliver, properties: pika.spec.BasicProperties, body: bytes) -> None:
+        """
+        Called by pika for each message received from RabbitMQ. Messages are added to the delivery
+        table in batches. A batch is written when it is full, or when it has waited intake_max_wait
+        seconds, see flush_intake.
+        """
+        delivery_tag = method.delivery_tag
+
+        # If the finish flag is set, reject the message so RabbitMQ will re-queue it.
+        if not self.keep_running:
+            logging.info(f'NACK delivery tag {delivery_tag}, keep_running is False')
+            channel.basic_reject(delivery_tag)
+            return
+
         try:
-            dao.create_delivery_table(self.name)
+            msg = json.loads(body)
+        except ValueError:
+            logging.exception(f'Dropping message that is not valid JSON: {body}')
+            channel.basic_reject(delivery_tag, requeue=False)
+            return
+
+        lu.cid_logger.info('Adding message to delivery table', extra=msg)
+        if len(self._intake) < 1:
+            self._intake_started = time.monotonic()
+
+        # The logical mapper sends the uid of the message's physical_timeseries row.
+        pts_uid = None
+        if self.reference_mode and properties.headers is not None:
+            pts_uid = properties.headers.get(BrokerConstants.PHYSICAL_TIMESERIES_UID_HEADER)
+
+        self._intake.append((delivery_tag, msg, pts_uid))
+        if len(self._intake) >= self.intake_batch_size and time.monotonic() >= self._intake_retry_at:
+            self._add_intake_batch(self._intake)
+
+    def intake_wait(self) -> float | None:
+        """
+        Returns how long until the intake batch must be written, or None if it is empty.
+        """
+        if len(self._intake) < 1:
+            return None
 
-            self.evt.clear()
-            delivery_thread = Thread(target=self.delivery_thread_proc, name='delivery_thread')
-            delivery_thread.start()
-        except dao.DAOException as err:
-            logging.exception('Failed to find or create service table')
-            exit(1)
+        now = time.monotonic()
+        return max(0.0, self._intake_started + self.intake_max_wait - now, self._intake_retry_at - now)
+
+    def flush_intake(self, force: bool = False) -> None:
+        """
+        Write the intake batch to the backing table if it has waited intake_max_wait seconds,
+        or if force is True. When force is True a batch that cannot be written is returned to
+        the RabbitMQ queue.
+        """
+        wait = self.intake_wait()
+        if wait is not None and (force or wait <= 0):
+            self._add_intake_batch(self._intake, requeue_on_failure=force)
+
+    def _add_intake_batch(self, batch: List[Tuple[int, dict[Any], int | None]], requeue_on_failure: bool = False) -> None:
+        """
+        Add a batch of messages received from RabbitMQ to the delivery table in one transaction,
+        then acknowledge them all at once. If the messages cannot be added they are kept in the
+        batch and tried again after a pause, see intake_wait, or returned to the RabbitMQ queue
+        if requeue_on_failure is True. The pause is per writer, so it does not hold up the other
+        writers sharing the RabbitMQ connection.
+
+        Messages with a physical_timeseries uid are added as references to their rows.
+        """
+        if len(batch) < 1:
+            return
 
+        last_tag = batch[-1][0]
+        try:
+            dao.add_delivery_msgs(self.name, [msg for _, msg, _ in batch], [pts_uid for _, _, pts_uid in batch])
+        except dao.DAOException:
+            if requeue_on_failure:
+                logging.exception(f'Failed to add {len(batch)} messages to the delivery table, returning them to the queue.')
+                self.channel.basic_nack(last_tag, multiple=True, requeue=True)
+                batch.clear()
+            else:
+                logging.exception(f'Failed to add {len(batch)} messages to the delivery table, trying again in {_intake_retry_seconds} seconds.')
+                self._intake_retry_at = time.monotonic() + _intake_retry_seconds
+            return
+
+        self._intake_retry_at = 0.0
+        self.channel.basic_ack(last_tag, multiple=True)
+        batch.clear()
+        self.evt.set()
+
+    def delivery_thread_proc(self, claimant: str) -> None:
+        """
+        This method runs in a separate thread when the writer has one worker, claiming batches of
+        messages from the backing table and calling the on_batch or on_message handler for them.
+        Claims are made with SKIP LOCKED so no two processes are given the same message.
+
+        When a batch has been processed, messages for which the handler returned MSG_OK or MSG_FAIL
+        are removed from the backing table, the retry_count attribute is incremented for messages
+        for which it returned MSG_RETRY, and any messages not processed are released so they can
+        be claimed again. Messages to be retried are not claimed again until their backoff delay
+        has passed, so they do not hold up the messages behind them.
+
+        While the circuit breaker is open no messages are claimed, and when it is half-open a
+        single message is claimed to probe the destination.
+        """
+        logging.info(f'Delivery thread {claimant} started')
+        last_status = time.monotonic()
         while self.keep_running:
+            # Cleared before claiming so a message added while the batch is being
+            # processed wakes this thread immediately afterwards.
+            self.evt.clear()
+
+            if time.monotonic() - last_status >= _status_interval:
+                self._log_status()
+                last_status = time.monotonic()
+
+            if not self.breaker.allow():
+                self.evt.wait(min(max(self.breaker.wait_time(), 0.1), _status_interval))
+                continue
+
+            probing = self.breaker.probing()
             try:
-                logging.info('Opening connection')
-                self.connection = None
-                connection = pika.BlockingConnection(pika.URLParameters(_amqp_url_str))
-
-                logging.info('Opening channel')
-                self.channel = connection.channel()
-                self.channel.basic_qos(prefetch_count=1)
-                logging.info('Declaring exchange')
-                self.channel.exchange_declare(
-                        exchange=BrokerConstants.LOGICAL_TIMESERIES_EXCHANGE_NAME,
-                        exchange_type=ExchangeType.fanout,
-                        durable=True)
-                logging.info('Declaring queue')
-                self.channel.queue_declare(queue=f'{self.name}_logical_msg_queue', durable=True)
-                self.channel.queue_bind(f'{self.name}_logical_msg_queue', BrokerConstants.LOGICAL_TIMESERIES_EXCHANGE_NAME, 'logical_timeseries')
-
-                logging.info('Waiting for messages.')
-                # This loops until _channel.cancel is called in the signal handler.
-                for method, properties, body in self.channel.consume(f'{self.name}_logical_msg_queue'):
-                    delivery_tag = method.delivery_tag
-
-                    # If the finish flag is set, reject the message so RabbitMQ will re-queue it
-                    # and return early.
-                    if not self.keep_running:
-                        lu.cid_logger.info(f'NACK delivery tag {delivery_tag}, keep_running is False', extra=msg)
-                        self.channel.basic_reject(delivery_tag)
-                        continue    # This will break from loop without running all the logic within the loop below here.
-
-                    msg = json.loads(body)
-                    lu.cid_logger.info('Adding message to delivery table', extra=msg)
-                    dao.add_delivery_msg(self.name, msg)
-                    self.channel.basic_ack(delivery_tag)
-                    self.evt.set()
-
-            except pika.exceptions.ConnectionClosedByBroker:
-                    logging.info('Connection closed by server.')
-                    break
-
-            except pika.exceptions.AMQPChannelError as err:
-                logging.exception(err)
-                break
+                msg_rows = dao.claim_delivery_msgs(self.name, claimant, 1 if probing else self.batch_size, self.lease_seconds)
+            except dao.DAOException:
+                self.breaker.no_result()
+                logging.exception('Failed to claim messages, retrying after a pause.')
+                self.evt.wait(_idle_poll_seconds)
+                continue
 
-            except pika.exceptions.AMQPConnectionError as err:
-                logging.exception(err)
-                logging.warning('Connection was closed, retrying after a pause.')
-                time.sleep(10)
+            if len(msg_rows) < 1:
+                self.breaker.no_result()
+                self.evt.wait(self._idle_timeout())
                 continue
 
-        # Tell the delivery thread to stop if the main thread got an error.
-        self.keep_running = False
-        self.evt.set()
-        if self.connection is not None:
-            logging.info('Closing connection')
-            self.connection.close()
+            if self.uses_on_batch and not probing and len(msg_rows) < self.batch_max_items and self.batch_max_wait > 0:
+                msg_rows += self._claim_more(claimant, len(msg_rows))
 
-        logging.info('Waiting for delivery thread')
-        delivery_thread.join()
+            logging.info(f'Processing {len(msg_rows)} messages')
+            remove: List[int] = []
+            retry: List[int] = []
+            release: List[int] = []
+            defer: List[int] = []
+            try:
+                self._process_rows(msg_rows, remove, retry, release, defer, msg_rows[0][0] if probing else None)
+            except Exception:
+                logging.exception(f'Failed to deliver {len(msg_rows)} messages, retrying them.')
+                settled = set(remove + retry + release + defer)
+                retry.extend([msg_uid for msg_uid, _, _ in msg_rows if msg_uid not in settled])
 
-    def delivery_thread_proc(self) -> None:
+            self._finish(claimant, remove, retry, release, defer)
+
+            # Allows another probe if this one was not delivered, eg because its device was not found.
+            self.breaker.no_result()
+
+        logging.info(f'Delivery thread {claimant} stopped.')
+
+    def dispatch_thread_proc(self, claimant: str) -> None:
         """
-        This method runs in a separate thread and reads messages from the backing table,
-        calling the on_message handler for each one. It also removes messages from the
-        backing table when on_message returns MSG_OK or MSG_FAIL, and maintains the retry_count
-        attribute on MSG_RETRY returns.
+        This method runs in a separate thread when the writer has more than one worker. It claims
+        messages from the backing table and queues them in the delivery lanes, where the lane
+        threads deliver them, and writes the results of delivery to the backing table in batches.
+
+        Claims are limited so that at most max_in_flight messages are queued or being delivered,
+        and messages are not claimed for logical devices that already have max_per_device. As in
+        delivery_thread_proc, claims stop while the circuit breaker is open.
         """
-        logging.info('Delivery thread started')
+        logging.info(f'Dispatch thread {claimant} started, {self.workers} delivery lanes')
+        lane_threads = [Thread(target=self.lane_thread_proc, args=(i, ), name=f'{self.name}_delivery_lane_{i}') for i in range(self.workers)]
+        for t in lane_threads:
+            t.start()
+
+        last_status = time.monotonic()
         while self.keep_running:
-            count = dao.get_delivery_msg_count(self.name)
-            if count < 1:
-                self.evt.wait()
-                self.evt.clear()
+            # Lane threads set the event as they finish messages, so their results are written
+            # promptly and more messages are claimed as capacity becomes free.
+            self.evt.clear()
+            self._finish_results(claimant)
 
-                if not self.keep_running:
-                    break
+            if time.monotonic() - last_status >= _status_interval:
+                self._log_status()
+                last_status = time.monotonic()
 
-                count = dao.get_delivery_msg_count(self.name)
-                if count < 1:
-                    continue
+            capacity = self.max_in_flight - self.lanes.in_flight()
+            if capacity < 1:
+                self.evt.wait(_idle_poll_seconds)
+                continue
+
+            # The lane thread delivering a probe sets the event when it finishes.
+            if not self.breaker.allow():
+                self.evt.wait(min(max(self.breaker.wait_time(), 0.1), _status_interval))
+                continue
+
+            busy_devices = self.lanes.busy_devices(self.max_per_device)
+            probing = self.breaker.probing()
+            try:
+                msg_rows = dao.claim_delivery_msgs(self.name, claimant, 1 if probing else min(self.batch_size, capacity), self.lease_seconds, busy_devices)
+            except dao.DAOException:
+                self.breaker.no_result()
+                logging.exception('Failed to claim messages, retrying after a pause.')
+                self.evt.wait(_idle_poll_seconds)
+                continue
 
-            if not self.keep_running:
+            if probing:
+                self._probe_uid = msg_rows[0][0] if len(msg_rows) > 0 else None
+
+            if len(msg_rows) < 1:
+                self.breaker.no_result()
+                # If messages were skipped because their devices are busy, wait for the lane
+                # threads rather than for new messages.
+                self.evt.wait(_idle_poll_seconds if len(busy_devices) > 0 else self._idle_timeout())
+                continue
+
+            for row in msg_rows:
+                self.lanes.put(row[1].get(BrokerConstants.LOGICAL_DEVICE_UID_KEY) if row[1] is not None else None, row)
+
+        # Messages still queued are released so they can be claimed again straight away.
+        queued = self.lanes.close()
+        for t in lane_threads:
+            t.join()
+
+        with self._results_lock:
+            self._results[2].extend([msg_uid for msg_uid, _, _ in queued])
+
+        self._finish_results(claimant)
+        self._log_status()
+        logging.info(f'Dispatch thread {claimant} stopped.')
+
+    def lane_thread_proc(self, lane: int) -> None:
+        """
+        This method runs in a separate thread for each delivery lane, delivering the messages
+        queued in that lane. It takes messages from each logical device in the lane in turn, one at
+        a time or, for writers that implement on_batch, up to batch_max_items at a time.
+        """
+        max_items = self.batch_max_items if self.uses_on_batch else 1
+        while True:
+            taken = self.lanes.take(lane, max_items)
+            if taken is None:
                 break
 
-            logging.info(f'Processing {count} messages')
-            msg_rows = dao.get_delivery_msg_batch(self.name)
-            for msg_uid, msg, retry_count in msg_rows:
-                lu.cid_logger.info(f'msg from table {msg_uid}, {retry_count}', extra=msg)
-                if not self.keep_running:
-                    break
-
-                p_uid = msg[BrokerConstants.PHYSICAL_DEVICE_UID_KEY]
-                l_uid = msg[BrokerConstants.LOGICAL_DEVICE_UID_KEY]
-                lu.cid_logger.info(f'Accepted message from physical / logical device ids {p_uid} / {l_uid}', extra=msg)
-
-                pd = dao.get_physical_device(p_uid)
-                if pd is None:
-                    lu.cid_logger.error(f'Could not find physical device, dropping message: {msg}', extra=msg)
-                    dao.remove_delivery_msg(self.name, msg_uid)
-                    continue
+            l_uid, msg_rows = taken
+            start = time.monotonic()
+            remove: List[int] = []
+            retry: List[int] = []
+            release: List[int] = []
+            defer: List[int] = []
+            probe_uid = self._probe_uid
+            try:
+                self._process_rows(msg_rows, remove, retry, release, defer, probe_uid)
+            except Exception:
+                logging.exception(f'Failed to deliver messages for logical device {l_uid}, retrying them.')
+                settled = set(remove + retry + release + defer)
+                retry.extend([msg_uid for msg_uid, _, _ in msg_rows if msg_uid not in settled])
+
+            if probe_uid is not None and any(msg_uid == probe_uid for msg_uid, _, _ in msg_rows):
+                self._probe_uid = None
+
+            # Allows another probe if this one was not delivered, eg because its device was not found.
+            self.breaker.no_result()
+
+            with self._results_lock:
+                self._results[0].extend(remove)
+                self._results[1].extend(retry)
+                self._results[2].extend(release)
+                self._results[3].extend(defer)
+
+            self.lanes.done(l_uid, len(msg_rows), time.monotonic() - start)
+            self.evt.set()
+
+    def _finish_results(self, claimant: str) -> None:
+        """
+        Write the results collected from the lane threads to the backing table.
+        """
+        with self._results_lock:
+            remove, retry, release, defer = self._results
+            self._results = ([], [], [], [])
+
+        self._finish(claimant, remove, retry, release, defer)
+
+    def _finish(self, claimant: str, remove: List[int], retry: List[int], release: List[int], defer: List[int]) -> None:
+        try:
+            dao.finish_delivery_msgs(self.name, claimant, remove, retry, release,
+                                     self.retry_base, self.retry_factor, self.retry_max, self.retry_jitter,
+                                     defer, self.breaker.open_for)
+        except dao.DAOException:
+            # The messages stay claimed until the lease expires, and will then be
+            # delivered again.
+            logging.exception(f'Failed to update delivery table for messages {remove + retry + release + defer}')
+
+    def _process_rows(self, msg_rows: List[Tuple[int, Dict[str, Any], int]], remove: List[int], retry: List[int], release: List[int], defer: List[int],
+                      probe_uid: int | None = None) -> None:
+        """
+        Deliver claimed messages with on_batch or on_message, adding each message's uid to the
+        remove, retry, release or defer list according to the result.
+
+        Messages are released without being delivered if the circuit breaker is open, or half-open
+        and they are not the probe message with uid probe_uid, eg because the breaker opened while
+        they were waiting in a delivery lane. Messages their logical device's delivery policy
+        suppresses are removed without being delivered.
+        """
+        items: List[Tuple[int, DeliveryItem]] = []
+        for msg_uid, msg, retry_count in msg_rows:
+            if self._held([msg_uid], probe_uid):
+                release.append(msg_uid)
+                continue
+
+            if msg is None:
+                logging.error(f'Message {msg_uid} refers to a physical_timeseries row that no longer exists, dropping message.')
+                remove.append(msg_uid)
+                continue
+
+            lu.cid_logger.info(f'msg from table {msg_uid}, {retry_count}', extra=msg)
 
-                ld = dao.get_logical_device(l_uid)
-                if ld is None:
-                    lu.cid_logger.error(f'Could not find logical device, dropping message: {msg}', extra=msg)
-                    dao.remove_delivery_msg(self.name, msg_uid)
+            p_uid = msg[BrokerConstants.PHYSICAL_DEVICE_UID_KEY]
+            l_uid = msg[BrokerConstants.LOGICAL_DEVICE_UID_KEY]
+            lu.cid_logger.info(f'Accepted message from physical / logical device ids {p_uid} / {l_uid}', extra=msg)
+
+            pd = device_cache.get_physical_device(p_uid)
+            if pd is None:
+                lu.cid_logger.error(f'Could not find physical device, dropping message: {msg}', extra=msg)
+                remove.append(msg_uid)
+                continue
+
+            ld = device_cache.get_logical_device(l_uid)
+            if ld is None:
+                lu.cid_logger.error(f'Could not find logical device, dropping message: {msg}', extra=msg)
+                remove.append(msg_uid)
+                continue
+
+            lu.cid_logger.info(f'{pd.name} / {ld.name}', extra=msg)
+            items.append((msg_uid, DeliveryItem(pd, ld, msg, retry_count)))
+
+        items = self._apply_policies(items, remove)
+
+        if not self.uses_on_batch:
+            for msg_uid, item in items:
+                if self._held([msg_uid], probe_uid):
+                    release.append(msg_uid)
                     continue
 
-                lu.cid_logger.info(f'{pd.name} / {ld.name}', extra=msg)
-
-                rc = self.on_message(pd, ld, msg, retry_count)
-                if rc == BaseWriter.MSG_OK:
-                    lu.cid_logger.info('Message processed ok.', extra=msg)
-                    dao.remove_delivery_msg(self.name, msg_uid)
-                elif rc == BaseWriter.MSG_RETRY:
-                    # This is where the message should be published to a different exchange,
-                    # private to the delivery service in question, so it can be retried later
-                    # but not stuck at the head of the queue and immediately redelivered to
-                    # here, possibly causing an endless loop.
-                    #
-                    # Alternatively, the retry count can be used to initially select new messages, then
-                    # messages that have failed at least once.
-                    lu.cid_logger.warning('Message processing failed, retrying message.', extra=msg)
-                    dao.retry_delivery_msg(self.name, msg_uid)
-                elif rc == BaseWriter.MSG_FAIL:
-                    lu.cid_logger.error('Message processing failed, dropping message.', extra=msg)
-                    dao.remove_delivery_msg(self.name, msg_uid)
-                else:
-                    lu.cid_logger.error(f'Invalid message processing return value: {rc}', extra=msg)
-
-        dao.stop()
-        logging.info('Delivery thread stopped.')
+                rc = self.on_message(item.pd, item.ld, item.msg, item.retry_count)
+                self._update_breaker([rc])
+                self._record_result(msg_uid, item, rc, remove, retry, release, defer)
+
+            return
+
+        for batch in self._split_batches(items):
+            if self._held([msg_uid for msg_uid, _ in batch], probe_uid):
+                release.extend([msg_uid for msg_uid, _ in batch])
+                continue
+
+            try:
+                rcs = self.on_batch([item for _, item in batch])
+            except Exception:
+                logging.exception(f'on_batch failed, retrying {len(batch)} messages.')
+                rcs = [BaseWriter.MSG_RETRY] * len(batch)
+
+            if rcs is None or len(rcs) != len(batch):
+                logging.error(f'on_batch returned {len(rcs) if rcs is not None else None} results for {len(batch)} messages, releasing them.')
+                self.breaker.no_result()
+                release.extend([msg_uid for msg_uid, _ in batch])
+                continue
+
+            self._update_breaker(rcs)
+            for (msg_uid, item), rc in zip(batch, rcs):
+                self._record_result(msg_uid, item, rc, remove, retry, release, defer)
+
+    def _held(self, msg_uids: List[int], probe_uid: int | None) -> bool:
+        """
+        Returns True if the messages must be released rather than delivered, because the writer is
+        stopping, the breaker is open, or the breaker is half-open and they are not the probe.
+        """
+        if not self.keep_running or self.breaker.is_open():
+            return True
+
+        return self.breaker.probing() and probe_uid not in msg_uids
+
+    def _apply_policies(self, items: List[Tuple[int, DeliveryItem]], remove: List[int]) -> List[Tuple[int, DeliveryItem]]:
+        """
+        Returns the messages the delivery policies of their logical devices say should be sent,
+        adding the others to the remove list.
+        """
+        send, suppressed = self.policies.filter([(i, item.ld.uid, item.ld.properties, item.msg) for i, (_, item) in enumerate(items)])
+        for i, reason in suppressed:
+            msg_uid, item = items[i]
+            lu.cid_logger.info(f'Message not sent because of the delivery policy ({reason}).', extra=item.msg)
+            remove.append(msg_uid)
+
+        return [items[i] for i in send]
+
+    def _claim_more(self, claimant: str, claimed: int) -> List[Tuple[int, Dict[str, Any], int]]:
+        """
+        Claim more messages as they arrive, until batch_max_items messages have been claimed in
+        total or batch_max_wait seconds have passed.
+        """
+        msg_rows = []
+        deadline = time.monotonic() + self.batch_max_wait
+        while self.keep_running and claimed + len(msg_rows) < self.batch_max_items:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            self.evt.clear()
+            self.evt.wait(remaining)
+            try:
+                msg_rows += dao.claim_delivery_msgs(self.name, claimant, self.batch_max_items - claimed - len(msg_rows), self.lease_seconds)
+            except dao.DAOException:
+                logging.exception('Failed to claim more messages, delivering those already claimed.')
+                break
+
+        return msg_rows
+
+    def _split_batches(self, items: List[Tuple[int, DeliveryItem]]) -> List[List[Tuple[int, DeliveryItem]]]:
+        """
+        Split claimed messages into batches for on_batch according to the batching rules,
+        keeping the messages for each logical device in order.
+        """
+        groups: Dict[int, List[Tuple[int, DeliveryItem]]] = {}
+        for msg_uid, item in items:
+            key = item.ld.uid if self.batch_by_logical_device else 0
+            groups.setdefault(key, []).append((msg_uid, item))
+
+        batches = []
+        for group in groups.values():
+            batch = []
+            batch_bytes = 0
+            for msg_uid, item in group:
+                msg_bytes = len(json.dumps(item.msg))
+                if len(batch) > 0 and (len(batch) >= self.batch_max_items or batch_bytes + msg_bytes > self.batch_max_bytes):
+                    batches.append(batch)
+                    batch = []
+                    batch_bytes = 0
+
+                batch.append((msg_uid, item))
+                batch_bytes += msg_bytes
+
+            if len(batch) > 0:
+                batches.append(batch)
+
+        return batches
+
+    def _update_breaker(self, rcs: List[int]) -> None:
+        """
+        Tell the circuit breaker the result of a call to on_message or on_batch. A call counts as
+        a success if any message was delivered, and as a failure if every message is to be retried.
+        """
+        if BaseWriter.MSG_OK in rcs:
+            self.breaker.success()
+        elif len(rcs) > 0 and all(rc == BaseWriter.MSG_RETRY for rc in rcs):
+            self.breaker.failure()
+        else:
+            self.breaker.no_result()
+
+    def _on_breaker_change(self, state: str) -> None:
+        # Wake the delivery threads so they resume claiming full batches straight away.
+        if state == CLOSED:
+            self.evt.set()
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Returns the state of the circuit breaker, the number of messages in the backing table
+        waiting to be delivered, the number of messages not sent because of delivery policies,
+        and the delivery lane metrics if there is more than one worker.
+        """
+        try:
+            backlog = dao.get_delivery_msg_count(self.name)
+        except dao.DAOException:
+            logging.exception('Failed to count messages in delivery table.')
+            backlog = None
+
+        status = {'breaker': self.breaker.stats(), 'backlog': backlog, 'policies': self.policies.stats()}
+        if self.lanes is not None:
+            status['lanes'] = self.lanes.stats()
+
+        return status
+
+    def _log_status(self) -> None:
+        status = self.status()
+        if self.breaker.state == CLOSED:
+            logging.info(f'Delivery status: {status}')
+        else:
+            logging.warning(f'Delivery paused, status: {status}')
+
+    def _record_result(self, msg_uid: int, item: DeliveryItem, rc: int, remove: List[int], retry: List[int], release: List[int], defer: List[int]) -> None:
+        msg = item.msg
+        if rc == BaseWriter.MSG_OK:
+            lu.cid_logger.info('Message processed ok.', extra=msg)
+            self.policies.delivered(item.ld.uid, msg)
+            remove.append(msg_uid)
+        elif rc == BaseWriter.MSG_RETRY and self.breaker.state != CLOSED:
+            # The destination is unavailable, so the failure does not count against the message.
+            # It is not claimed again until the breaker would next allow a probe, so a probe that
+            # fails because of the message itself does not block the messages behind it.
+            lu.cid_logger.warning('Message processing failed, deferring message while delivery is paused.', extra=msg)
+            defer.append(msg_uid)
+        elif rc == BaseWriter.MSG_RETRY:
+            # The message is skipped by claims until its backoff delay has passed.
+            # The retry count lets the handler decide when to give up.
+            lu.cid_logger.warning('Message processing failed, retrying message.', extra=msg)
+            retry.append(msg_uid)
+        elif rc == BaseWriter.MSG_FAIL:
+            lu.cid_logger.error('Message processing failed, dropping message.', extra=msg)
+            remove.append(msg_uid)
+        else:
+            lu.cid_logger.error(f'Invalid message processing return value: {rc}', extra=msg)
+            release.append(msg_uid)
+
+    def _idle_timeout(self) -> float:
+        """
+        Returns how long a delivery thread that found nothing to claim should wait before
+        trying again if it is not woken first.
+        """
+        max_wait = _max_idle_seconds if self.listener is not None and self.listener.connected else _idle_poll_seconds
+        try:
+            wait = dao.get_delivery_wait(self.name)
+        except dao.DAOException:
+            logging.exception('Failed to check delivery table.')
+            return _idle_poll_seconds
+
+        # A message that can be claimed now is locked by another thread's claim, so give
+        # that a moment to finish.
+        return max_wait if wait is None else min(max(wait, 0.1), max_wait)
 
     def on_message(self, pd: PhysicalDevice, ld: LogicalDevice, msg: dict[Any], retry_count: int) -> int:
         """
@@ -198,6 +812,10 @@ class BaseWriter:
         Implementations must decide what constitutes a temporary failure that can be retried, how
         many times it is reasonable to retry, and when a message is undeliverable.
 
+        This method is called concurrently from several threads when the writer has more than
+        one worker, so implementations must then be thread-safe. Calls for the same logical
+        device are never concurrent.
+
         pd: The PhysicalDevice that sent the message.
         ld: The LogicalDevice to deliver the message to.
         msg: The message content, in IoTa format.
@@ -210,17 +828,132 @@ class BaseWriter:
         lu.cid_logger.info(f'{pd.name} / {ld.name} / {retry_count}: {msg}', extra=msg)
         return BaseWriter.MSG_OK
 
+    def on_batch(self, items: List[DeliveryItem]) -> List[int]:
+        """
+        Subclasses delivering to destinations that accept many messages at once can override this
+        method, and it is then called instead of on_message. It is given a batch of messages formed
+        according to the BATCH_* rules, in the order they were received, and must deliver them all.
+
+        The same rules apply as for on_message, including thread-safety, and the retry count of
+        each message is in its DeliveryItem. If this method raises an exception, every message in
+        the batch is retried.
+
+        return a list with one of BaseWriter.MSG_OK, MSG_RETRY or MSG_FAIL for each item, in the
+               same order as items.
+        """
+        return [self.on_message(item.pd, item.ld, item.msg, item.retry_count) for item in items]
+
     def sigterm_handler(self, sig_no, stack_frame) -> None:
         """
-        Handle SIGTERM from docker by closing the mq and db connections and setting a
-        flag to tell the main loop to exit.
+        Handle SIGTERM from docker by setting a flag to tell the main loop and delivery
+        threads to exit. The db connections are closed by run_writers once the delivery
+        threads have finished with them.
         """
-        logging.info(f'{signal.strsignal(sig_no)}, setting keep_running to False')
-        self.keep_running = False
-        dao.stop()
+        logging.info(f'{signal.strsignal(sig_no)}, setting {self.name} keep_running to False')
+        self.stop()
+
+
+def run_writers(writers: List[BaseWriter]) -> None:
+    """
+    Run one or more writers in this process until SIGTERM is received.
+
+    The writers share a RabbitMQ connection, the DAO connection pool, the device cache and
+    a listener for delivery table notifications. Each writer has its own RabbitMQ channel and
+    queue, delivery table, delivery threads and circuit breaker, so a writer whose destination
+    or channel fails does not hold up the others.
+    """
+    by_channel = {dao.get_delivery_channel(w.name): w for w in writers}
+
+    def on_connect() -> None:
+        for w in writers:
+            w.evt.set()
+
+    listener = Listener(list(by_channel), lambda channel, payload: by_channel[channel].evt.set(), on_connect=on_connect)
+    for w in writers:
+        w.listener = listener
+
+    def sigterm_handler(sig_no, stack_frame) -> None:
+        for w in writers:
+            w.sigterm_handler(sig_no, stack_frame)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    try:
+        device_cache.start()
+        listener.start()
+        for w in writers:
+            w.start()
+    except dao.DAOException as err:
+        logging.exception('Failed to find or create service table')
+        exit(1)
+
+    # When a writer's channel is closed by an error, eg while acknowledging messages, it is
+    # reopened after a pause without disturbing the other writers.
+    reopen_at = {w.name: 0.0 for w in writers}
+
+    connection = None
+    while all(w.keep_running for w in writers):
+        try:
+            logging.info('Opening connection')
+            connection = None
+            connection = pika.BlockingConnection(pika.URLParameters(_amqp_url_str))
+            for w in writers:
+                try:
+                    w.open_channel(connection)
+                except pika.exceptions.AMQPChannelError:
+                    logging.exception(f'Failed to open {w.name} channel.')
+                    reopen_at[w.name] = time.monotonic() + 10
+
+            logging.info('Waiting for messages.')
+            while all(w.keep_running for w in writers):
+                # Returns as soon as messages arrive, or when the first intake batch is due
+                # to be written.
+                waits = [wait for wait in (w.intake_wait() for w in writers) if wait is not None]
+                try:
+                    connection.process_data_events(time_limit=max(min(waits, default=1.0), 0.001))
+                except pika.exceptions.AMQPChannelError:
+                    logging.exception('Channel failed while handling messages.')
+
+                for w in writers:
+                    try:
+                        if w.channel is not None and w.channel.is_open:
+                            w.flush_intake()
+                        elif time.monotonic() >= reopen_at[w.name]:
+                            logging.warning(f'{w.name} channel is closed, reopening it.')
+                            reopen_at[w.name] = time.monotonic() + 10
+                            w.open_channel(connection)
+                    except pika.exceptions.AMQPChannelError:
+                        logging.exception(f'{w.name} channel failed.')
+
+            # Messages received before the loop ended are still unacknowledged.
+            for w in writers:
+                if w.channel is not None and w.channel.is_open:
+                    w.flush_intake(force=True)
+
+        except pika.exceptions.ConnectionClosedByBroker:
+                logging.info('Connection closed by server.')
+                break
+
+        except pika.exceptions.AMQPConnectionError as err:
+            logging.exception(err)
+            logging.warning('Connection was closed, retrying after a pause.')
+            time.sleep(10)
+            continue
+
+    # Tell the delivery threads to stop if the main thread got an error.
+    for w in writers:
+        w.stop()
+
+    if connection is not None and connection.is_open:
+        logging.info('Closing connection')
+        connection.close()
+
+    for w in writers:
+        w.join()
 
-        # This breaks the endless loop in main.
-        self.channel.cancel()
+    listener.stop()
+    device_cache.stop()
+    dao.stop()
 
 
 if __name__ == '__main__':
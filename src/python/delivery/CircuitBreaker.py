@@ -0,0 +1,141 @@
+"""
+A circuit breaker used by BaseWriter to stop delivering messages while the
+destination is unavailable.
+
+The breaker starts closed. It opens after a number of consecutive delivery
+failures, and while it is open no messages are delivered. Once the open period
+has passed it becomes half-open and allows a single probe delivery. If the
+probe succeeds the breaker closes and delivery resumes at full speed, otherwise
+it opens again for twice as long, up to a maximum.
+"""
+
+import logging, time
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int, open_seconds: float, max_open_seconds: float, on_change: Optional[Callable[[str], None]] = None) -> None:
+        """
+        name: used in log messages.
+        threshold: the number of consecutive failures that opens the breaker, or 0 to never open it.
+        open_seconds: how long the breaker stays open the first time it opens.
+        max_open_seconds: the longest the breaker stays open after repeated failed probes.
+        on_change: called as on_change(state) whenever the state changes.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max(open_seconds, max_open_seconds)
+        self.on_change = on_change
+
+        self._lock = Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._open_for = open_seconds
+        self._open_until = 0.0
+        self._probing = False
+        self._opened_count = 0
+        self._last_change = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def open_for(self) -> float:
+        """
+        How long the breaker stays open the next time it opens, or stays open now if it is open.
+        """
+        return self._open_for
+
+    def is_open(self) -> bool:
+        return self._state == OPEN
+
+    def allow(self) -> bool:
+        """
+        Returns True if messages may be delivered now. When the breaker is half-open this returns
+        True only for the caller that is to deliver the probe, which must then deliver a single
+        message and call success(), failure() or no_result().
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN:
+                if time.monotonic() < self._open_until:
+                    return False
+
+                self._set_state(HALF_OPEN)
+
+            if self._probing:
+                return False
+
+            self._probing = True
+            return True
+
+    def probing(self) -> bool:
+        return self._state == HALF_OPEN
+
+    def wait_time(self) -> float:
+        """
+        Returns how long until allow() may next return True, or 0 if the breaker is closed.
+        """
+        with self._lock:
+            if self._state == OPEN:
+                return max(0.0, self._open_until - time.monotonic())
+
+            return 0.0 if self._state == CLOSED else 1.0
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._open_for = self.open_seconds
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN:
+                self._open_for = min(self._open_for * 2, self.max_open_seconds)
+                self._open()
+            elif self._state == CLOSED and self.threshold > 0 and self._failures >= self.threshold:
+                self._open()
+
+    def no_result(self) -> None:
+        """
+        Called when a delivery neither succeeded nor failed because of the destination, eg the
+        message was invalid or there was nothing to deliver, so another probe can be made.
+        """
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'times_opened': self._opened_count,
+                'seconds_in_state': round(time.monotonic() - self._last_change, 1),
+                'open_for': self._open_for,
+                'open_remaining': round(max(0.0, self._open_until - time.monotonic()), 1) if self._state == OPEN else 0.0,
+            }
+
+    def _open(self) -> None:
+        self._open_until = time.monotonic() + self._open_for
+        self._opened_count += 1
+        self._set_state(OPEN)
+
+    def _set_state(self, state: str) -> None:
+        logging.warning(f'{self.name} circuit breaker {self._state} -> {state}, consecutive failures: {self._failures}')
+        self._state = state
+        self._last_change = time.monotonic()
+        if self.on_change is not None:
+            self.on_change(state)
@@ -0,0 +1,67 @@
+"""
+This program runs several delivery services in one process, for small
+deployments where a container per delivery service costs too much memory and
+too many connections.
+
+The writers to run are given by class name, either on the command line or in
+the DELIVERY_HOST_WRITERS environment variable, separated by commas, eg
+
+    python -m delivery.DeliveryHost delivery.UbidotsWriter.UbidotsWriter delivery.FRRED.DataboltWriter
+
+The writers share one RabbitMQ connection, one database connection pool and one
+device cache. Each keeps its own RabbitMQ queue, delivery table, delivery
+threads and circuit breaker, so they can be moved between this process and
+their own containers without losing messages.
+"""
+
+import importlib, logging, os, sys
+from typing import List
+
+from delivery.BaseWriter import BaseWriter, run_writers
+
+
+def load_writer(class_name: str) -> BaseWriter:
+    """
+    Create a writer from the fully qualified name of its class, which must be a subclass of
+    BaseWriter that can be created with no arguments.
+    """
+    module_name, _, name = class_name.strip().rpartition('.')
+    if len(module_name) < 1:
+        raise ValueError(f'Writer class name must include its module: {class_name}')
+
+    cls = getattr(importlib.import_module(module_name), name)
+    if not isinstance(cls, type) or not issubclass(cls, BaseWriter):
+        raise ValueError(f'{class_name} is not a BaseWriter')
+
+    return cls()
+
+
+def load_writers(class_names: List[str]) -> List[BaseWriter]:
+    writers = [load_writer(class_name) for class_name in class_names if len(class_name.strip()) > 0]
+
+    # Each writer's name is used for its delivery table and queue.
+    names = [w.name for w in writers]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Writer names must be unique: {names}')
+
+    return writers
+
+
+if __name__ == '__main__':
+    class_names = sys.argv[1:] if len(sys.argv) > 1 else os.getenv('DELIVERY_HOST_WRITERS', '').split(',')
+
+    try:
+        writers = load_writers(class_names)
+    except Exception:
+        logging.exception('Failed to load writers.')
+        sys.exit(1)
+
+    if len(writers) < 1:
+        logging.error('No writers given, set DELIVERY_HOST_WRITERS or give writer class names as arguments.')
+        sys.exit(1)
+
+    logging.info(f'Running writers {[w.name for w in writers]}')
+
+    # Does not return until SIGTERM is received.
+    run_writers(writers)
+    logging.info('Exiting.')
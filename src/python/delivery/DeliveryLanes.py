@@ -0,0 +1,133 @@
+"""
+Queues of claimed delivery messages waiting for delivery threads, used by
+BaseWriter when it has more than one worker.
+
+Messages are assigned to lanes by hashing their logical device uid, and each
+lane is served by a single thread. The messages for a logical device are
+therefore delivered one at a time and in order, while messages for devices in
+different lanes are delivered concurrently.
+
+Within a lane, each logical device has its own queue and the lane's thread
+takes messages from the devices in turn, so a device with many messages waiting
+does not hold up the other devices sharing its lane.
+"""
+
+import time
+from collections import OrderedDict, deque
+from threading import Condition
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+
+class DeliveryLanes:
+    def __init__(self, lanes: int) -> None:
+        self.lanes = max(1, lanes)
+
+        self._cond = Condition()
+        self._closed = False
+
+        # For each lane, the queued messages of each logical device, in the order the
+        # devices will be served.
+        self._queues: List[OrderedDict[int, Deque[Any]]] = [OrderedDict() for _ in range(self.lanes)]
+
+        # The number of messages queued or being delivered, by lane and by logical device.
+        self._lane_depth = [0] * self.lanes
+        self._device_depth: Dict[int, int] = {}
+
+        self._max_lane_depth = [0] * self.lanes
+        self._delivered = [0] * self.lanes
+        self._busy_time = [0.0] * self.lanes
+        self._started = time.monotonic()
+
+    def lane_of(self, l_uid: int) -> int:
+        return hash(l_uid) % self.lanes
+
+    def put(self, l_uid: int, item: Any) -> None:
+        lane = self.lane_of(l_uid)
+        with self._cond:
+            self._queues[lane].setdefault(l_uid, deque()).append(item)
+            self._lane_depth[lane] += 1
+            self._max_lane_depth[lane] = max(self._max_lane_depth[lane], self._lane_depth[lane])
+            self._device_depth[l_uid] = self._device_depth.get(l_uid, 0) + 1
+            self._cond.notify_all()
+
+    def take(self, lane: int, max_items: int) -> Optional[Tuple[int, List[Any]]]:
+        """
+        Wait for messages in the given lane, and return up to max_items of them from the next
+        logical device due to be served, as (l_uid, items). The device is then moved to the back
+        of the lane. Returns None once the lanes have been closed.
+
+        done() must be called when the items have been delivered.
+        """
+        with self._cond:
+            while not self._closed and len(self._queues[lane]) < 1:
+                self._cond.wait()
+
+            if self._closed:
+                return None
+
+            queues = self._queues[lane]
+            l_uid, queue = next(iter(queues.items()))
+            items = [queue.popleft() for _ in range(min(max_items, len(queue)))]
+            if len(queue) > 0:
+                queues.move_to_end(l_uid)
+            else:
+                del queues[l_uid]
+
+            return l_uid, items
+
+    def done(self, l_uid: int, count: int, busy_time: float = 0.0) -> None:
+        lane = self.lane_of(l_uid)
+        with self._cond:
+            self._lane_depth[lane] -= count
+            self._delivered[lane] += count
+            self._busy_time[lane] += busy_time
+            depth = self._device_depth.get(l_uid, 0) - count
+            if depth > 0:
+                self._device_depth[l_uid] = depth
+            else:
+                self._device_depth.pop(l_uid, None)
+
+            self._cond.notify_all()
+
+    def in_flight(self) -> int:
+        with self._cond:
+            return sum(self._lane_depth)
+
+    def busy_devices(self, max_per_device: int) -> List[int]:
+        """
+        Returns the logical devices with at least max_per_device messages queued or being delivered.
+        """
+        with self._cond:
+            return [l_uid for l_uid, depth in self._device_depth.items() if depth >= max_per_device]
+
+    def close(self) -> List[Any]:
+        """
+        Stop the lanes, causing take() to return None, and return the items that were still queued.
+        """
+        with self._cond:
+            self._closed = True
+            items = [item for queues in self._queues for queue in queues.values() for item in queue]
+            for queues in self._queues:
+                queues.clear()
+
+            self._cond.notify_all()
+            return items
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the current and maximum depth of each lane, the number of devices waiting in each
+        lane, the number of messages delivered by each lane, and the fraction of the time each
+        lane's thread has spent delivering, since the lanes were created.
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        with self._cond:
+            return {
+                'lanes': self.lanes,
+                'in_flight': sum(self._lane_depth),
+                'depth': list(self._lane_depth),
+                'max_depth': list(self._max_lane_depth),
+                'devices': [len(queues) for queues in self._queues],
+                'delivered': list(self._delivered),
+                'utilisation': [round(t / elapsed, 3) for t in self._busy_time],
+                'deepest_device': max(self._device_depth.values(), default=0),
+            }
@@ -0,0 +1,224 @@
+"""
+Per logical device delivery policies, used by BaseWriter to avoid sending
+messages a destination does not need.
+
+A logical device's policy is set in its properties, under the delivery_policy
+key, for example:
+
+    "delivery_policy": {
+        "min_interval": 900,
+        "deadband": {"temperature": 0.5, "*": 1},
+        "coalesce": true,
+        "ubidots": {"min_interval": 300}
+    }
+
+min_interval: the least time in seconds, by message timestamp, between messages
+              sent for the device.
+deadband: how much a value must change from the value last sent to be sent
+          again. Either a number for every value, or an object of numbers by
+          value name, where "*" is used for names not listed. Values that are
+          not numbers are sent when they change.
+coalesce: if true, only the latest of the messages for the device that are
+          delivered together is considered for sending.
+
+A message is sent if there is no min_interval and no deadband, or min_interval
+has passed since the last message sent, or a value has moved outside its
+deadband. The settings in an object named after a writer replace those above
+it for that writer.
+
+The last message sent for each device is remembered in memory, so the first
+message for each device after a writer starts is always sent, and each process
+sharing a delivery table keeps its own record.
+"""
+
+import dateutil.parser, json, numbers
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import BrokerConstants
+
+# The reasons messages are not sent, as reported by stats().
+INTERVAL = 'interval'
+DEADBAND = 'deadband'
+COALESCED = 'coalesced'
+
+
+class DeliveryPolicy(NamedTuple):
+    min_interval: float
+    deadband: Optional[Dict[str, float]]
+    coalesce: bool
+
+
+class _Sent(NamedTuple):
+    ts: datetime
+    values: Dict[str, Any]
+
+
+class DeliveryPolicies:
+    def __init__(self, name: str) -> None:
+        """
+        name: the writer's name, used to find settings for this writer in a policy.
+        """
+        self.name = name
+
+        self._lock = Lock()
+        self._sent: Dict[int, _Sent] = {}
+        self._delivered = 0
+        self._suppressed = {INTERVAL: 0, DEADBAND: 0, COALESCED: 0}
+        self._bytes_saved = 0
+
+    def policy_for(self, properties: Dict[str, Any]) -> Optional[DeliveryPolicy]:
+        """
+        Returns the policy in a logical device's properties, or None if it has no policy or the
+        policy is not valid.
+        """
+        settings = properties.get(BrokerConstants.DELIVERY_POLICY_KEY)
+        if not isinstance(settings, dict):
+            return None
+
+        overrides = settings.get(self.name)
+        if isinstance(overrides, dict):
+            settings = {**settings, **overrides}
+
+        try:
+            deadband = settings.get('deadband')
+            if isinstance(deadband, numbers.Number):
+                deadband = {'*': float(deadband)}
+            elif isinstance(deadband, dict):
+                deadband = {k: float(v) for k, v in deadband.items()}
+            else:
+                deadband = None
+
+            policy = DeliveryPolicy(float(settings.get('min_interval', 0)), deadband, bool(settings.get('coalesce', False)))
+        except (TypeError, ValueError):
+            return None
+
+        if policy.min_interval <= 0 and policy.deadband is None and not policy.coalesce:
+            return None
+
+        return policy
+
+    def filter(self, items: List[Tuple[Any, int, Dict[str, Any], Dict[str, Any]]]) -> Tuple[List[Any], List[Tuple[Any, str]]]:
+        """
+        Decide which of a list of messages to send, in order. Each entry is (key, l_uid,
+        properties, msg) where key identifies the message to the caller, properties are the
+        logical device properties, and msg is the message.
+
+        The messages are compared with the last message sent for their devices, and with the
+        messages before them in the list that are to be sent. delivered() must be called for
+        each message that is successfully sent.
+
+        Returns the keys of the messages to send, and (key, reason) for the messages that are
+        not to be sent. Messages without a valid timestamp are always sent.
+        """
+        policies: Dict[int, Optional[DeliveryPolicy]] = {}
+        timestamps = [_timestamp(msg) for _, _, _, msg in items]
+        latest: Dict[int, int] = {}
+        for i, (_, l_uid, properties, msg) in enumerate(items):
+            if l_uid not in policies:
+                policies[l_uid] = self.policy_for(properties)
+
+            if policies[l_uid] is not None and policies[l_uid].coalesce and timestamps[i] is not None:
+                j = latest.get(l_uid)
+                if j is None or timestamps[i] >= timestamps[j]:
+                    latest[l_uid] = i
+
+        send = []
+        suppressed = []
+        with self._lock:
+            pending: Dict[int, _Sent] = {}
+            for i, (key, l_uid, _, msg) in enumerate(items):
+                policy = policies[l_uid]
+                if policy is None or timestamps[i] is None:
+                    send.append(key)
+                    continue
+
+                if policy.coalesce and latest[l_uid] != i:
+                    reason = COALESCED
+                else:
+                    last = pending.get(l_uid, self._sent.get(l_uid))
+                    reason = _check(policy, last, timestamps[i], msg)
+
+                if reason is None:
+                    send.append(key)
+                    pending[l_uid] = _Sent(timestamps[i], _values(msg))
+                else:
+                    suppressed.append((key, reason))
+                    self._suppressed[reason] += 1
+                    self._bytes_saved += len(json.dumps(msg))
+
+        return send, suppressed
+
+    def delivered(self, l_uid: int, msg: Dict[str, Any]) -> None:
+        """
+        Record that msg was sent for the logical device l_uid.
+        """
+        ts = _timestamp(msg)
+        with self._lock:
+            self._delivered += 1
+            last = self._sent.get(l_uid)
+            if ts is not None and (last is None or ts >= last.ts):
+                self._sent[l_uid] = _Sent(ts, _values(msg))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the number of messages sent, the number not sent for each reason, and the total
+        size of the messages not sent.
+        """
+        with self._lock:
+            return {
+                'delivered': self._delivered,
+                'suppressed': dict(self._suppressed),
+                'bytes_saved': self._bytes_saved,
+            }
+
+
+def _check(policy: DeliveryPolicy, last: Optional[_Sent], ts: datetime, msg: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns None if msg, with timestamp ts, should be sent, or the reason it should not be.
+    """
+    if last is None:
+        return None
+
+    if policy.min_interval > 0 and (ts - last.ts).total_seconds() >= policy.min_interval:
+        return None
+
+    if policy.deadband is not None and _changed(policy.deadband, last.values, _values(msg)):
+        return None
+
+    if policy.min_interval > 0:
+        return INTERVAL
+
+    if policy.deadband is not None:
+        return DEADBAND
+
+    return None
+
+
+def _changed(deadband: Dict[str, float], last: Dict[str, Any], values: Dict[str, Any]) -> bool:
+    for name, value in values.items():
+        if name not in last:
+            return True
+
+        prev = last[name]
+        if isinstance(value, numbers.Number) and isinstance(prev, numbers.Number) and not isinstance(value, bool):
+            if abs(value - prev) > deadband.get(name, deadband.get('*', 0.0)):
+                return True
+        elif value != prev:
+            return True
+
+    return False
+
+
+def _values(msg: Dict[str, Any]) -> Dict[str, Any]:
+    return {v.get('name'): v.get('value') for v in msg.get(BrokerConstants.TIMESERIES_KEY, []) if isinstance(v, dict)}
+
+
+def _timestamp(msg: Dict[str, Any]) -> Optional[datetime]:
+    try:
+        ts = dateutil.parser.isoparse(msg[BrokerConstants.TIMESTAMP_KEY])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    return ts if ts.tzinfo is not None else ts.replace(tzinfo=timezone.utc)
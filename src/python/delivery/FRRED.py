@@ -8,68 +8,319 @@ the logical mapper.
 Intersect wants both the physical and logical device ids.
 
 This code expects a volume shared with the DataBolt container to be mounted and
-writable at /raw_data. DataBolt expects only directories under its raw_data
-directory, and then a set of files with each of those directories. Each
-directory is processed as a batch and a completion file written when the
-batch has been successfully processed.
+writable, with DataBolt's raw_data directory at $DATABOLT_RAW_DATA_DIR. DataBolt
+expects only directories under its raw_data directory, and then a set of files
+with each of those directories. Each directory is processed as a batch and a
+completion file written when the batch has been successfully processed.
+
+By default each message is written to its own directory. In batch mode the
+messages are appended to a rolling batch file, one JSON object per line, in a
+directory under $DATABOLT_STAGING_DIR. The directory is sealed when the batch
+has enough messages, is large enough or old enough: a batch.sealed marker file
+is written into it and it is moved into the raw_data directory with an atomic
+rename, so DataBolt only ever sees complete batches. The staging directory must
+be outside the raw_data directory, so DataBolt does not see open batches, but
+on the same mounted volume, so the rename works.
+
+More than one writer may share the staging directory, so each holds an exclusive
+lock on its open batch file until the batch is sealed. When a writer starts it
+seals the batches left open by writers that have stopped, whose files are no
+longer locked.
 """
 
-from typing import Any
+from threading import Event, Lock, Thread
+from typing import Any, BinaryIO, List, Optional
 
-import json, logging, os, sys, time
+import datetime, fcntl, json, logging, os, sys, time, uuid
 
 import BrokerConstants
 
 import util.LoggingUtil as lu
 
-from delivery.BaseWriter import BaseWriter
+from delivery.BaseWriter import BaseWriter, DeliveryItem
 from pdmodels.Models import LogicalDevice, PhysicalDevice
 
 
-_raw_data_name = '/raw_data'
+_raw_data_name = os.getenv('DATABOLT_RAW_DATA_DIR', '/databolt/nectar_raw_data')
+
+# Open batches are kept here until they are sealed. It must be on the same mounted volume as
+# _raw_data_name for the rename to be atomic, but not inside it.
+_staging_name = os.getenv('DATABOLT_STAGING_DIR', '/databolt/nectar_staging')
+
+# Written into a batch directory when it is sealed.
+_sealed_marker = 'batch.sealed'
+
+# Batch mode is off unless $DATABOLT_BATCH_MODE is set. A batch is sealed once it holds
+# $DATABOLT_BATCH_MAX_MESSAGES messages or $DATABOLT_BATCH_MAX_BYTES bytes, or it was opened
+# $DATABOLT_BATCH_MAX_AGE_SECONDS ago.
+_batch_mode = os.getenv('DATABOLT_BATCH_MODE', 'false').lower() in ('1', 'true', 'yes')
+_batch_max_messages = int(os.getenv('DATABOLT_BATCH_MAX_MESSAGES', '1000'))
+_batch_max_bytes = int(os.getenv('DATABOLT_BATCH_MAX_BYTES', str(16 * 1024 * 1024)))
+_batch_max_age = float(os.getenv('DATABOLT_BATCH_MAX_AGE_SECONDS', '300'))
 
 
 class DataboltWriter(BaseWriter):
-    def __init__(self) -> None:
+    def __init__(self, batch_mode: bool | None = None) -> None:
         super().__init__('databolt')
 
-    def on_message(self, pd: PhysicalDevice, ld: LogicalDevice, msg: dict[Any], retry_count: int) -> int:
-        try:
+        self.batch_mode: bool = batch_mode if batch_mode is not None else _batch_mode
+        self.batch_max_messages: int = max(1, _batch_max_messages)
+        self.batch_max_bytes: int = max(1, _batch_max_bytes)
+        self.batch_max_age: float = max(1.0, _batch_max_age)
+
+        # The open batch, guarded by _batch_lock because messages are written from the delivery
+        # threads and batches are sealed by age from the seal thread.
+        self._batch_lock = Lock()
+        self._batch_id: Optional[str] = None
+        self._batch_file: Optional[BinaryIO] = None
+        self._batch_count = 0
+        self._batch_bytes = 0
+        self._batch_opened = 0.0
+        self._seal_stop = Event()
+        self._seal_thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        # Set a permissive umask to try and avoid problems with user-based file permissions between
+        # different containers and the host system. The umask is process wide, so it is set once
+        # here rather than around every write, and also applies to the files written by any other
+        # writers run in the same process by delivery.DeliveryHost.
+        os.umask(0)
+
+        if self.batch_mode:
+            logging.info(f'Batch mode, sealing batches at {self.batch_max_messages} messages, {self.batch_max_bytes} bytes or {self.batch_max_age} seconds')
+            os.makedirs(_staging_name, exist_ok=True)
+            self._seal_abandoned_batches()
+
+            self._seal_thread = Thread(target=self.seal_thread_proc, name='seal_thread')
+            self._seal_thread.start()
+
+        super().start()
+
+    def join(self) -> None:
+        super().join()
+        if self._seal_thread is not None:
+            self._seal_stop.set()
+            self._seal_thread.join()
+            with self._batch_lock:
+                self._seal_batch()
+
+    def seal_thread_proc(self) -> None:
+        """
+        Seals the open batch when it reaches the maximum age, so messages do not wait in a
+        partial batch while few are arriving.
+        """
+        while not self._seal_stop.wait(min(1.0, self.batch_max_age)):
+            with self._batch_lock:
+                if self._batch_file is not None and time.monotonic() - self._batch_opened >= self.batch_max_age:
+                    try:
+                        self._seal_batch()
+                    except Exception:
+                        logging.exception(f'Failed to seal batch {self._batch_id}.')
+
+    def on_batch(self, items: List[DeliveryItem]) -> List[int]:
+        rcs = [DataboltWriter.MSG_OK] * len(items)
+        accepted = []
+        for i, item in enumerate(items):
             # Only messages from Wombat or Axistech nodes should be processed for SCMN.
-            if pd.source_name not in [BrokerConstants.WOMBAT, BrokerConstants.AXISTECH]:
-                lu.cid_logger.info(f'Rejecting message from source {pd.source_name}', extra=msg)
-                return DataboltWriter.MSG_OK
+            if item.pd.source_name not in [BrokerConstants.WOMBAT, BrokerConstants.AXISTECH]:
+                lu.cid_logger.info(f'Rejecting message from source {item.pd.source_name}', extra=item.msg)
+            else:
+                accepted.append(i)
+
+        if len(accepted) < 1:
+            return rcs
+
+        if not os.path.isdir(_raw_data_name):
+            # Retried rather than failed, so the circuit breaker opens until the volume is mounted.
+            lu.cid_logger.error(f'DataBolt {_raw_data_name} directory not found. This should be a mounted volume shared with the DataBolt container.', extra=items[accepted[0]].msg)
+            return [DataboltWriter.MSG_RETRY if i in accepted else rc for i, rc in enumerate(rcs)]
+
+        if not self.batch_mode:
+            for i in accepted:
+                rcs[i] = self._write_directory(items[i].msg)
 
-            # May as well use the message context id for the DataBolt directory and file name.
-            if not os.path.isdir(_raw_data_name):
-                lu.cid_logger.error(f'DataBolt {_raw_data_name} directory not found. This should be a mounted volume shared with the DataBolt container.', extra=msg)
-                sys.exit(1)
+            return rcs
 
-            msg_uuid = msg[BrokerConstants.CORRELATION_ID_KEY]
+        with self._batch_lock:
+            for i in accepted:
+                rcs[i] = self._append_to_batch(items[i].msg)
 
-            # Set a permissive umask to try and avoid problems with user-based file permissions between
-            # different containers and the host system.
-            old_umask = os.umask(0)
             try:
-                os.mkdir(f'{_raw_data_name}/{msg_uuid}')
-                with open(f'{_raw_data_name}/{msg_uuid}/{msg_uuid}.json', 'w') as f:
-                    # The body argument is bytes, not a string. Using json.dump is a
-                    # simple way to get a string written to the file.
-                    json.dump(msg, f)
+                if self._batch_file is not None:
+                    self._batch_file.flush()
+                    os.fsync(self._batch_file.fileno())
+            except Exception:
+                logging.exception(f'Failed to sync batch {self._batch_id}.')
+                rcs = [DataboltWriter.MSG_FAIL if i in accepted else rc for i, rc in enumerate(rcs)]
+
+        return rcs
+
+    def on_message(self, pd: PhysicalDevice, ld: LogicalDevice, msg: dict[Any], retry_count: int) -> int:
+        return self.on_batch([DeliveryItem(pd, ld, msg, retry_count)])[0]
 
-            except:
-                lu.cid_logger.exception('Failed to write message to DataBolt directory.', extra=msg)
-                return DataboltWriter.MSG_FAIL
+    def _write_directory(self, msg: dict[Any]) -> int:
+        """
+        Write a message to a directory of its own, named with the message's correlation id.
+        """
+        # May as well use the message context id for the DataBolt directory and file name.
+        msg_uuid = msg[BrokerConstants.CORRELATION_ID_KEY]
+        try:
+            os.mkdir(f'{_raw_data_name}/{msg_uuid}')
+            with open(f'{_raw_data_name}/{msg_uuid}/{msg_uuid}.json', 'w') as f:
+                json.dump(msg, f)
+
+        except:
+            lu.cid_logger.exception('Failed to write message to DataBolt directory.', extra=msg)
+            return DataboltWriter.MSG_FAIL
 
-            # Put the old umask back in case some other file operations are done in the base class.
-            os.umask(old_umask)
+        return DataboltWriter.MSG_OK
 
-            return DataboltWriter.MSG_OK
+    def _append_to_batch(self, msg: dict[Any]) -> int:
+        """
+        Append a message to the open batch, opening a new batch if there is none, and seal the
+        batch if it is full. Must be called with _batch_lock held.
+        """
+        line = (json.dumps(msg) + '\n').encode()
+        try:
+            if self._batch_file is None:
+                self._open_batch()
 
-        except BaseException:
-            lu.cid_logger.exception('Error while processing message.', extra=msg)
+            self._batch_file.write(line)
+            self._batch_count += 1
+            self._batch_bytes += len(line)
+
+        except:
+            lu.cid_logger.exception(f'Failed to write message to DataBolt batch {self._batch_id}.', extra=msg)
+            # Remove anything written of the message so the batch file holds only whole lines.
+            try:
+                if self._batch_file is not None:
+                    self._batch_file.truncate(self._batch_bytes)
+            except Exception:
+                logging.exception(f'Failed to truncate batch {self._batch_id}.')
             return DataboltWriter.MSG_FAIL
 
+        if self._batch_count >= self.batch_max_messages or self._batch_bytes >= self.batch_max_bytes:
+            try:
+                self._seal_batch()
+            except Exception:
+                # The message is in the batch file, so it will be delivered when the batch is
+                # sealed by age, or when the writer next starts.
+                logging.exception(f'Failed to seal batch {self._batch_id}.')
+
+        return DataboltWriter.MSG_OK
+
+    def _open_batch(self) -> None:
+        """
+        Open a new batch and lock its file, so another writer starting up does not take it for an
+        abandoned batch.
+        """
+        while True:
+            self._batch_id = str(uuid.uuid4())
+            path = f'{_staging_name}/{self._batch_id}/{self._batch_id}.jsonl'
+            os.mkdir(f'{_staging_name}/{self._batch_id}')
+            batch_file = open(path, 'ab')
+            fcntl.flock(batch_file.fileno(), fcntl.LOCK_EX)
+
+            # Another writer may have removed the empty batch before it was locked.
+            if _is_same_file(batch_file, path):
+                break
+
+            batch_file.close()
+
+        self._batch_file = batch_file
+        self._batch_count = 0
+        self._batch_bytes = 0
+        self._batch_opened = time.monotonic()
+
+    def _seal_batch(self) -> None:
+        """
+        Seal the open batch, if there is one, by writing the marker file and moving the batch
+        directory into the DataBolt directory. Must be called with _batch_lock held.
+        """
+        if self._batch_file is None:
+            return
+
+        batch_file = self._batch_file
+        self._batch_file = None
+
+        # The file stays locked until the batch has been moved out of the staging directory.
+        try:
+            batch_file.flush()
+            os.fsync(batch_file.fileno())
+
+            if self._batch_count < 1:
+                _remove_directory(self._batch_id)
+                return
+
+            _seal_directory(self._batch_id, self._batch_count, self._batch_bytes)
+        finally:
+            batch_file.close()
+
+        logging.info(f'Sealed batch {self._batch_id}, {self._batch_count} messages, {self._batch_bytes} bytes, after {time.monotonic() - self._batch_opened:.1f} seconds')
+
+    def _seal_abandoned_batches(self) -> None:
+        """
+        Seal the batches left open by writers that have stopped. The messages in them have already
+        been removed from the delivery table. Batches whose files are locked are open in a running
+        writer and are left alone.
+        """
+        for batch_id in os.listdir(_staging_name):
+            path = f'{_staging_name}/{batch_id}/{batch_id}.jsonl'
+            try:
+                if not os.path.isfile(path):
+                    logging.warning(f'Ignoring unexpected entry {batch_id} in {_staging_name}')
+                    continue
+
+                with open(path, 'rb+') as f:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+
+                    # The batch may have been sealed or removed by its writer before it was locked.
+                    if not _is_same_file(f, path):
+                        continue
+
+                    # Drop a partial line written when the writer stopped.
+                    data = f.read()
+                    size = data.rfind(b'\n') + 1
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+
+                    if size < 1:
+                        _remove_directory(batch_id)
+                        continue
+
+                    _seal_directory(batch_id, data[:size].count(b'\n'), size)
+                    logging.info(f'Sealed abandoned batch {batch_id}')
+            except Exception:
+                logging.exception(f'Failed to seal abandoned batch {batch_id}.')
+
+
+def _seal_directory(batch_id: str, count: int, size: int) -> None:
+    staging_dir = f'{_staging_name}/{batch_id}'
+    with open(f'{staging_dir}/{_sealed_marker}', 'w') as f:
+        json.dump({'messages': count, 'bytes': size, 'sealed_at': datetime.datetime.now(datetime.timezone.utc).isoformat()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(staging_dir, f'{_raw_data_name}/{batch_id}')
+
+
+def _is_same_file(f: BinaryIO, path: str) -> bool:
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _remove_directory(batch_id: str) -> None:
+    staging_dir = f'{_staging_name}/{batch_id}'
+    for name in os.listdir(staging_dir):
+        os.remove(f'{staging_dir}/{name}')
+
+    os.rmdir(staging_dir)
+
 
 if __name__ == '__main__':
     if not os.path.isdir(_raw_data_name):
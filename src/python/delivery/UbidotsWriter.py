@@ -1,10 +1,21 @@
 """
 This program receives logical device timeseries messages and forwards them
 on to Ubidots.
+
+Ubidots creates a device the first time data is posted to a new label, so a
+logical device without an Ubidots label is given one and its data is posted
+straight away. The label is saved in the logical device properties before the
+first post, so a restart or another writer process cannot give the device a
+second label and create a second Ubidots device. The new Ubidots device is then
+configured, and its details saved in the logical device properties, by a
+separate provisioning thread so the data path never waits for those calls. The
+new labels are also cached so messages for the device do not wait for the
+device cache to see the saved label.
 """
 
-import time
-from typing import Any
+from queue import Queue
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Set, Tuple
 import dateutil.parser
 
 import logging, math, uuid
@@ -14,14 +25,221 @@ import BrokerConstants
 import api.client.Ubidots as ubidots
 
 import api.client.DAO as dao
-from delivery.BaseWriter import BaseWriter
+from delivery.BaseWriter import BaseWriter, DeliveryItem
 from pdmodels.Models import LogicalDevice, PhysicalDevice
 import util.LoggingUtil as lu
 
 class UbidotsWriter(BaseWriter):
+    # Back off for longer than the default in case Ubidots is flooded.
+    RETRY_BASE = 15.0
+    RETRY_MAX = 900.0
+
+    # Messages for the same device are posted to Ubidots together, see on_batch.
+    BATCH_MAX_ITEMS = 50
+    BATCH_BY_LOGICAL_DEVICE = True
+
     def __init__(self) -> None:
         super().__init__('ubidots')
 
+        # Labels given to logical devices that did not have one in their properties, by logical
+        # device uid, and the devices waiting to be provisioned or already provisioned. The labels
+        # are kept after provisioning in case a cached copy of the logical device without the
+        # label is used before the device cache is refreshed.
+        self._labels_lock = Lock()
+        self._new_labels: Dict[int, str] = {}
+        self._provisioning: Set[int] = set()
+        self._provisioned: Set[int] = set()
+        self._provision_q: Queue[Optional[Tuple[PhysicalDevice, LogicalDevice, str, Dict[str, Any]]]] = Queue()
+        self._provision_thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        super().start()
+        self._provision_thread = Thread(target=self.provision_thread_proc, name='provision_thread')
+        self._provision_thread.start()
+
+    def join(self) -> None:
+        super().join()
+        if self._provision_thread is not None:
+            self._provision_q.put(None)
+            self._provision_thread.join()
+
+    def _get_label(self, pd: PhysicalDevice, ld: LogicalDevice, msg: Dict[str, Any]) -> Optional[str]:
+        """
+        Returns the Ubidots label for a logical device, giving it a new label if it has none, or
+        None if a new label could not be saved in the logical device properties.
+        """
+        if 'ubidots' in ld.properties and 'label' in ld.properties['ubidots']:
+            return ld.properties['ubidots']['label']
+
+        with self._labels_lock:
+            label = self._new_labels.get(ld.uid)
+            if label is not None:
+                return label
+
+            lu.cid_logger.info('No Ubidots label found in logical device.', extra=msg)
+
+            #
+            # TODO: Add some way to abstract the source-specific details of creating the Ubidots device.
+            # Anywhere this code has something like 'if pd.source_name...' it should be handled better.
+            #
+            # One idea is that once the broker is live (and if Ubidots supports this) we can stop the
+            # logical mapper for a short while and do a bulk relabel of all Ubidots devices to some
+            # scheme that does not require source-specific information, change this code, and restart
+            # the logical mapper.
+            #
+            # TODO: Remove the device source specific code here and always use a random
+            # UUID for the Ubidots label.
+            if pd.source_name == BrokerConstants.GREENBRAIN:
+                lu.cid_logger.info('Using system-station-sensor-group ids as label', extra=msg)
+                system_id = pd.source_ids['system_id']
+                station_id = pd.source_ids['station_id']
+                sensor_group_id = pd.source_ids['sensor_group_id']
+                label = f'{system_id}-{station_id}-{sensor_group_id}'
+            else:
+                label = str(uuid.uuid4())
+
+            # Save the label before anything is posted to it. If another process saved a label
+            # first, that one is used instead.
+            try:
+                saved = dao.init_logical_device_property(ld.uid, ['ubidots', 'label'], label)
+            except dao.DAOException:
+                lu.cid_logger.exception('Failed to save Ubidots label in logical device.', extra=msg)
+                return None
+
+            if saved is not None:
+                label = saved
+
+            self._new_labels[ld.uid] = label
+            return label
+
+    def _provision(self, pd: PhysicalDevice, ld: LogicalDevice, label: str, msg: Dict[str, Any]) -> None:
+        """
+        Queue a logical device for provisioning if it has been given a new label and is not
+        already queued. Called once data has been posted, so the Ubidots device exists.
+        """
+        with self._labels_lock:
+            if ld.uid not in self._new_labels or ld.uid in self._provisioning or ld.uid in self._provisioned:
+                return
+
+            self._provisioning.add(ld.uid)
+
+        self._provision_q.put((pd, ld, label, msg))
+
+    def provision_thread_proc(self) -> None:
+        while True:
+            item = self._provision_q.get()
+            if item is None:
+                break
+
+            pd, ld, label, msg = item
+            try:
+                done = self._provision_device(pd, ld, label, msg)
+            except Exception:
+                lu.cid_logger.exception('Failed to provision Ubidots device.', extra=msg)
+                done = False
+
+            with self._labels_lock:
+                self._provisioning.discard(ld.uid)
+                if done:
+                    self._provisioned.add(ld.uid)
+
+    def _provision_device(self, pd: PhysicalDevice, ld: LogicalDevice, label: str, msg: Dict[str, Any]) -> bool:
+        """
+        Configure a new Ubidots device and save its details in the logical device properties.
+        Returns False if that could not be done, so it will be tried again with the next message.
+        """
+        logging_ctx = {BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]}
+
+        # Update the Ubidots device with info from the source device and/or the
+        # broker.
+        lu.cid_logger.info('Updating Ubidots device with information from source device.', extra=msg)
+        patch_obj = {'name': ld.name}
+        patch_obj['properties'] = {}
+
+        # Prefer the logical device location, fall back to the mapped physical device
+        # location, if any.
+        loc = ld.location if ld.location is not None else pd.location
+        if loc is not None:
+            patch_obj['properties'] |= {'_location_type': 'manual', '_location_fixed': {'lat': loc.lat, 'lng': loc.long}}
+
+        # We could include the correlation id of the message that caused the device to be created
+        # in the same format as the QR code id below, but I'm not sure that's useful and it might clutter
+        # up the Ubidots UI.
+
+        if pd.source_name == BrokerConstants.TTN:
+            if BrokerConstants.TTN in pd.properties:
+                ttn_props = pd.properties[BrokerConstants.TTN]
+                if 'description' in ttn_props:
+                    patch_obj['description'] = ttn_props['description']
+
+                if 'attributes' in ttn_props and 'uid' in ttn_props['attributes']:
+                    cfg = {'dpi-uid': {'text': 'DPI UID', 'type': 'text', 'description': 'The uid from the DPI QR code used to activate the device.'}}
+                    patch_obj['properties'] |= {'_config': cfg, 'dpi-uid': ttn_props['attributes']['uid']}
+
+            # TODO: What about Green Brain devices?
+
+        ubidots.update_device(label, patch_obj, logging_ctx)
+
+        # Update the logical device properties with the information returned from Ubidots, but
+        # nothing else. The logical device is read again rather than using the copy from the
+        # message because the logical mapper updates last_seen with every message.
+        lu.cid_logger.info('Updating logical device properties from Ubidots.', extra=msg)
+        ud = ubidots.get_device(label, logging_ctx)
+        if ud is None:
+            return False
+
+        current = dao.get_logical_device(ld.uid)
+        if current is None:
+            return True
+
+        current.properties['ubidots'] = ud.properties['ubidots']
+        dao.update_logical_device(current)
+        return True
+
+    def _ubidots_payload(self, msg: Dict[str, Any]) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Convert a message to the Ubidots format shown in on_message, or return None if the
+        message timestamp cannot be parsed.
+        """
+        ts = 0.0
+        try:
+            ts_float = dateutil.parser.isoparse(msg[BrokerConstants.TIMESTAMP_KEY]).timestamp()
+            # datetime.timestamp() returns a float where the ms are to the right of the
+            # decimal point. This should get us an integer value in ms.
+            ts = math.floor(ts_float * 1000)
+        except:
+            lu.cid_logger.error(f'Failed to parse timestamp from message: {msg[BrokerConstants.TIMESTAMP_KEY]}', extra=msg)
+            return None
+
+        ubidots_payload = {}
+        for v in msg[BrokerConstants.TIMESERIES_KEY]:
+            dot_ts = ts
+
+            # Override the default message timestamp if one of the dot entries has its
+            # own timestamp.
+            if BrokerConstants.TIMESTAMP_KEY in v:
+                try:
+                    dot_ts_float = dateutil.parser.isoparse(v[BrokerConstants.TIMESTAMP_KEY]).timestamp()
+                    dot_ts = math.floor(dot_ts_float * 1000)
+                except:
+                    # dot_ts has already been set to msg timestamp above as a default value.
+                    pass
+
+            try:
+                value = float(v['value'])
+                ubidots_payload[v['name']] = {
+                    'value': value,
+                    'timestamp': dot_ts,
+                    'context': {
+                        BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]
+                    }
+                }
+            except (ValueError, TypeError):
+                # Ubidots will not accept values that are not floats, so skip this value.
+                pass
+
+        return ubidots_payload
+
     def on_message(self, pd: PhysicalDevice, ld: LogicalDevice, msg: dict[Any], retry_count: int) -> int:
         """
         This function is called when a message arrives from RabbitMQ.
@@ -50,130 +268,24 @@ class UbidotsWriter(BaseWriter):
         """
 
         try:
-            ts = 0.0
-            try:
-                ts_float = dateutil.parser.isoparse(msg[BrokerConstants.TIMESTAMP_KEY]).timestamp()
-                # datetime.timestamp() returns a float where the ms are to the right of the
-                # decimal point. This should get us an integer value in ms.
-                ts = math.floor(ts_float * 1000)
-            except:
-                lu.cid_logger.error(f'Failed to parse timestamp from message: {msg[BrokerConstants.TIMESTAMP_KEY]}', extra=msg)
+            ubidots_payload = self._ubidots_payload(msg)
+            if ubidots_payload is None:
                 return self.MSG_FAIL
 
-            ubidots_payload = {}
-            for v in msg[BrokerConstants.TIMESERIES_KEY]:
-                dot_ts = ts
-
-                # Override the default message timestamp if one of the dot entries has its
-                # own timestamp.
-                if BrokerConstants.TIMESTAMP_KEY in v:
-                    try:
-                        dot_ts_float = dateutil.parser.isoparse(v[BrokerConstants.TIMESTAMP_KEY]).timestamp()
-                        dot_ts = math.floor(dot_ts_float * 1000)
-                    except:
-                        # dot_ts has already been set to msg timestamp above as a default value.
-                        pass
-
-                try:
-                    value = float(v['value'])
-                    ubidots_payload[v['name']] = {
-                        'value': value,
-                        'timestamp': dot_ts,
-                        'context': {
-                            BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]
-                        }
-                    }
-                except (ValueError, TypeError):
-                    # Ubidots will not accept values that are not floats, so skip this value.
-                    pass
-
-            #
-            # TODO: Add some way to abstract the source-specific details of creating the Ubidots device.
-            # Anywhere this code has something like 'if pd.source_name...' it should be handled better.
-            #
-            # One idea is that once the broker is live (and if Ubidots supports this) we can stop the
-            # logical mapper for a short while and do a bulk relabel of all Ubidots devices to some
-            # scheme that does not require source-specific information, change this code, and restart
-            # the logical mapper.
-            #
-            new_device = False
-            if not 'ubidots' in ld.properties or not 'label' in ld.properties['ubidots']:
-                # If the Ubidots label is not in the logical device properties, the device
-                # may no exist in Ubidots yet so  we must remember to read the Ubidots
-                # device back after writing the timeseries data so the device info can be
-                # stored in the logical device properties.
-                lu.cid_logger.info('No Ubidots label found in logical device.', extra=msg)
-
-                new_device = True
-                ld.properties['ubidots'] = {}
-                # TODO: Remove the device source specific code here and always use a random
-                # UUID for the Ubidots label.
-                if pd.source_name == BrokerConstants.GREENBRAIN:
-                    lu.cid_logger.info('Using system-station-sensor-group ids as label', extra=msg)
-                    system_id = pd.source_ids['system_id']
-                    station_id = pd.source_ids['station_id']
-                    sensor_group_id = pd.source_ids['sensor_group_id']
-                    ubi_label = f'{system_id}-{station_id}-{sensor_group_id}'
-                    ld.properties['ubidots']['label'] = ubi_label
-                else:
-                    ld.properties['ubidots']['label'] = uuid.uuid4()
-
             #
             # So it doesn't get lost in all the surrounding code, here is where the
             # data is posted to Ubidots.
             #
-            ubidots_dev_label = ld.properties['ubidots']['label']
+            ubidots_dev_label = self._get_label(pd, ld, msg)
+            if ubidots_dev_label is None:
+                return self._failed(DeliveryItem(pd, ld, msg, retry_count))
+
             if not ubidots.post_device_data(ubidots_dev_label, ubidots_payload, {BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]}):
                 # The write to Ubidots failed.
                 lu.cid_logger.error('Delivery to Ubidots failed at API call.', extra=msg)
-                if retry_count > 4:
-                    lu.cid_logger.error(f'Retried message 5 times, giving up.', extra=msg)
-                    return BaseWriter.MSG_FAIL
-                else:
-                    time.sleep(5) # Pause in case Ubidtos is flooded.
-                    return BaseWriter.MSG_RETRY
-
-            if new_device:
-                # Update the Ubidots device with info from the source device and/or the
-                # broker.
-                lu.cid_logger.info('Updating Ubidots device with information from source device.', extra=msg)
-                patch_obj = {'name': ld.name}
-                patch_obj['properties'] = {}
-
-                # Prefer the logical device location, fall back to the mapped physical device
-                # location, if any.
-                loc = ld.location if ld.location is not None else pd.location
-                if loc is not None:
-                    patch_obj['properties'] |= {'_location_type': 'manual', '_location_fixed': {'lat': loc.lat, 'lng': loc.long}}
-
-                # We could include the correlation id of the message that caused the device to be created
-                # in the same format as the QR code id below, but I'm not sure that's useful and it might clutter
-                # up the Ubidots UI.
-
-                if pd.source_name == BrokerConstants.TTN:
-                    if BrokerConstants.TTN in pd.properties:
-                        ttn_props = pd.properties[BrokerConstants.TTN]
-                        if 'description' in ttn_props:
-                            patch_obj['description'] = ttn_props['description']
-
-                        if 'attributes' in ttn_props and 'uid' in ttn_props['attributes']:
-                            cfg = {'dpi-uid': {'text': 'DPI UID', 'type': 'text', 'description': 'The uid from the DPI QR code used to activate the device.'}}
-                            patch_obj['properties'] |= {'_config': cfg, 'dpi-uid': ttn_props['attributes']['uid']}
-
-                    # TODO: What about Green Brain devices?
-
-                ubidots.update_device(ubidots_dev_label, patch_obj, {BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]})
-
-                # Update the newly created logical device properties with the information
-                # returned from Ubidots, but nothing else. We don't want to overwite the
-                # last_seen value because that should be set to the timestamp from the
-                # message, which was done in the mapper process.
-                lu.cid_logger.info('Updating logical device properties from Ubidots.', extra=msg)
-                ud = ubidots.get_device(ubidots_dev_label, {BrokerConstants.CORRELATION_ID_KEY: msg[BrokerConstants.CORRELATION_ID_KEY]})
-                if ud is not None:
-                    ld.properties['ubidots'] = ud.properties['ubidots']
-                    dao.update_logical_device(ld)
+                return self._failed(DeliveryItem(pd, ld, msg, retry_count))
 
+            self._provision(pd, ld, ubidots_dev_label, msg)
             return self.MSG_OK
 
         except BaseException:
@@ -181,6 +293,74 @@ class UbidotsWriter(BaseWriter):
             return self.MSG_FAIL
 
 
+    def on_batch(self, items: List[DeliveryItem]) -> List[int]:
+        """
+        Deliver a batch of messages for one logical device with a single POST, which Ubidots
+        accepts as a list of dots for each variable:
+
+        {
+            'battery': [{'value': 3.6, 'timestamp': 1643934748392}, {'value': 3.5, 'timestamp': 1643938348392}],
+            'humidity': [{'value': 37.17, 'timestamp': 1643934748392}, {'value': 38.2, 'timestamp': 1643938348392}]
+        }
+
+        Each dot keeps the correlation id of the message it came from in its context.
+        """
+        results: List[int] = [None] * len(items)
+        groups: Dict[int, List[int]] = {}
+        for i, item in enumerate(items):
+            groups.setdefault(item.ld.uid, []).append(i)
+
+        for indexes in groups.values():
+            self._deliver_device_batch(items, indexes, results)
+
+        return results
+
+    def _deliver_device_batch(self, items: List[DeliveryItem], indexes: List[int], results: List[int]) -> None:
+        first = items[indexes[0]]
+        ubidots_dev_label = self._get_label(first.pd, first.ld, first.msg)
+        if ubidots_dev_label is None:
+            for i in indexes:
+                results[i] = self._failed(items[i])
+
+            return
+
+        payload: Dict[str, List[Dict[str, Any]]] = {}
+        included: List[int] = []
+        for i in indexes:
+            dots = self._ubidots_payload(items[i].msg)
+            if dots is None:
+                results[i] = self.MSG_FAIL
+                continue
+
+            for name, dot in dots.items():
+                payload.setdefault(name, []).append(dot)
+
+            included.append(i)
+
+        if len(included) < 1:
+            return
+
+        first_msg = items[included[0]].msg
+        logging_ctx = {BrokerConstants.CORRELATION_ID_KEY: first_msg[BrokerConstants.CORRELATION_ID_KEY]}
+        ok = ubidots.post_device_data(ubidots_dev_label, payload, logging_ctx)
+        if ok:
+            self._provision(first.pd, first.ld, ubidots_dev_label, first_msg)
+
+        for i in included:
+            if ok:
+                lu.cid_logger.info(f'Delivered to Ubidots in a batch of {len(included)} messages.', extra=items[i].msg)
+                results[i] = self.MSG_OK
+            else:
+                lu.cid_logger.error(f'Delivery to Ubidots failed at API call, in a batch of {len(included)} messages.', extra=items[i].msg)
+                results[i] = self._failed(items[i])
+
+    def _failed(self, item: DeliveryItem) -> int:
+        if item.retry_count > 4:
+            lu.cid_logger.error(f'Retried message 5 times, giving up.', extra=item.msg)
+            return BaseWriter.MSG_FAIL
+
+        return BaseWriter.MSG_RETRY
+
 if __name__ == '__main__':
     UbidotsWriter().run()
     logging.info('Exiting.')
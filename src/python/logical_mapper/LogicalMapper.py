@@ -17,7 +17,7 @@ information to the logical device properties object allowing the logical
 device to be associated with the IoT platform device.
 """
 
-import asyncio, json, logging, signal
+import asyncio, json, logging, os, signal
 import datetime
 
 import dateutil.parser
@@ -26,27 +26,43 @@ import BrokerConstants
 from pika.exchange_type import ExchangeType
 import api.client.RabbitMQ as mq
 import api.client.DAO as dao
+import api.client.DeviceCache as device_cache
 import util.LoggingUtil as lu
 
 _rx_channel = None
 _tx_channel = None
 _mq_client = None
+_ts_writer: dao.PhysicalTimeseriesBatchWriter = None
+_loop: asyncio.AbstractEventLoop = None
 _finish = False
 
+# physical_timeseries rows are written in batches. A batch is written when this many
+# messages are waiting, or the oldest message has waited this many seconds.
+_ts_batch_size = int(os.getenv('LM_TIMESERIES_BATCH_SIZE', '250'))
+_ts_batch_max_wait = float(os.getenv('LM_TIMESERIES_BATCH_MAX_WAIT', '0.2'))
+
+# How often to check the physical_timeseries partitions exist for the coming months.
+_partition_check_interval = datetime.timedelta(hours=12)
+_partition_months_ahead = 3
+
+# How often to add new physical_timeseries rows to the hourly and daily rollup tables.
+_rollup_interval = datetime.timedelta(seconds=float(os.getenv('LM_ROLLUP_INTERVAL', '60')))
+
+# The most physical_timeseries rows added to the rollups in one step.
+_rollup_max_uids = 100000
+
 _max_delta = datetime.timedelta(hours=-1)
 
 
 def sigterm_handler(sig_no, stack_frame) -> None:
     """
-    Handle SIGTERM from docker by closing the mq and db connections and setting a
-    flag to tell the main loop to exit.
+    Handle SIGTERM from docker by setting a flag to tell the main loop to exit. The main
+    loop writes any buffered messages before closing the mq and db connections.
     """
-    global _finish, _mq_client
+    global _finish
 
     logging.info(f'{signal.strsignal(sig_no)}, setting _finish to True')
     _finish = True
-    dao.stop()
-    _mq_client.stop()
 
 
 async def main():
@@ -58,12 +74,18 @@ async def main():
 
     It would be good to find a better way to do nothing than the current loop.
     """
-    global _mq_client, _rx_channel, _tx_channel, _finish
+    global _mq_client, _rx_channel, _tx_channel, _ts_writer, _loop, _finish
 
     logging.info('===============================================================')
     logging.info('               STARTING LOGICAL MAPPER')
     logging.info('===============================================================')
 
+    _loop = asyncio.get_running_loop()
+    device_cache.start()
+    # The writer also resolves each message's logical device and updates the device's last_seen
+    # and last_msg in the same statement that writes the batch.
+    _ts_writer = dao.PhysicalTimeseriesBatchWriter(max_rows=_ts_batch_size, max_wait=_ts_batch_max_wait, map_devices=True, max_future=-_max_delta)
+
     _rx_channel = mq.RxChannel(exchange_name=BrokerConstants.PHYSICAL_TIMESERIES_EXCHANGE_NAME, exchange_type=ExchangeType.fanout, queue_name='lm_physical_timeseries', on_message=on_message)
     _tx_channel = mq.TxChannel(exchange_name=BrokerConstants.LOGICAL_TIMESERIES_EXCHANGE_NAME, exchange_type=ExchangeType.fanout)
     _mq_client = mq.RabbitMQConnection(channels=[_rx_channel, _tx_channel])
@@ -73,9 +95,50 @@ async def main():
     while not (_rx_channel.is_open and _tx_channel.is_open):
         await asyncio.sleep(0)
 
+    next_partition_check = datetime.datetime.now(datetime.timezone.utc)
+    next_rollup_update = next_partition_check
+    backfill_done = False
     while not _finish:
+        if datetime.datetime.now(datetime.timezone.utc) >= next_partition_check:
+            try:
+                await asyncio.to_thread(dao.create_physical_timeseries_partitions, _partition_months_ahead)
+            except dao.DAOException:
+                logging.exception('Failed to create physical_timeseries partitions')
+
+            next_partition_check = datetime.datetime.now(datetime.timezone.utc) + _partition_check_interval
+
+        # The rollups are updated a bounded step at a time. While they are behind, eg on the
+        # first run against a large database, the next step is taken the next time around
+        # the loop so the other tasks and shutdown are not held up.
+        if datetime.datetime.now(datetime.timezone.utc) >= next_rollup_update:
+            rollups_behind = False
+            try:
+                rollups_behind = await asyncio.to_thread(dao.update_timeseries_rollups, _rollup_max_uids) >= _rollup_max_uids
+            except dao.DAOException:
+                logging.exception('Failed to update the timeseries rollups')
+
+            if not rollups_behind:
+                next_rollup_update = datetime.datetime.now(datetime.timezone.utc) + _rollup_interval
+
+        # Add the values of messages stored before the timeseries_values table existed, a
+        # batch each time around the loop so the backfill does not swamp the database.
+        if not backfill_done:
+            try:
+                backfill_done = await asyncio.to_thread(dao.backfill_timeseries_values) == 0
+            except dao.DAOException:
+                logging.exception('Failed to backfill timeseries_values')
+
         await asyncio.sleep(2)
 
+    # Write any buffered messages, then give the event loop a chance to run the acks
+    # and publishes scheduled by the writer callbacks before closing the connections.
+    _ts_writer.stop()
+    await asyncio.sleep(1)
+
+    device_cache.stop()
+    dao.stop()
+    _mq_client.stop()
+
     while not _mq_client.stopped:
         await asyncio.sleep(1)
 
@@ -83,6 +146,11 @@ async def main():
 def on_message(channel, method, properties, body):
     """
     This function is called when a message arrives from RabbitMQ.
+
+    The message is given to the batch writer to be written to physical_timeseries, which
+    also adds the logical device id from the physical device's current mapping. The rest of
+    the processing, including the ack to RabbitMQ, happens in on_message_flushed once the
+    message is safely in the database.
     """
 
     global _rx_channel, _tx_channel, _finish
@@ -99,7 +167,7 @@ def on_message(channel, method, properties, body):
         msg = json.loads(body)
 
         p_uid = msg[BrokerConstants.PHYSICAL_DEVICE_UID_KEY]
-        pd = dao.get_physical_device(p_uid)
+        pd = device_cache.get_physical_device(p_uid)
         if pd is None:
             lu.cid_logger.error(f'Physical device not found, cannot continue. Dropping message.', extra=msg)
             # Ack the message, even though we cannot process it. We don't want it redelivered.
@@ -109,26 +177,47 @@ def on_message(channel, method, properties, body):
 
         lu.cid_logger.info(f'Accepted message from {pd.name}', extra=msg)
 
-        mapping = dao.get_current_device_mapping(p_uid)
-        if mapping is None or mapping.is_active is not True:
-            # Add the message even though it has no logical device id in it.
-            dao.insert_physical_timeseries_message(msg)
+        # The logical device id comes only from the physical device's current mapping.
+        msg.pop(BrokerConstants.LOGICAL_DEVICE_UID_KEY, None)
 
-            if mapping is None:
-                lu.cid_logger.warning(f'No device mapping found for {pd.source_ids}, cannot continue. Dropping message.', extra=msg)
-            else:
-                lu.cid_logger.warning(f'Mapping for {pd.source_ids} is paused, cannot continue. Dropping message.', extra=msg)
+        # Messages from unmapped or paused devices are still written, even though they have
+        # no logical device id in them.
+        _ts_writer.add(msg, lambda m, uid, err: on_message_flushed(delivery_tag, pd, m, uid, err))
 
-            # Ack the message, even though we cannot process it. We don't want it redelivered.
-            # We can change this to a Nack if that would provide extra context somewhere.
-            _rx_channel._channel.basic_ack(delivery_tag)
-            return
+    except BaseException as e:
+        logging.exception('Error while processing message')
+        _rx_channel._channel.basic_ack(delivery_tag)
 
-        msg[BrokerConstants.LOGICAL_DEVICE_UID_KEY] = mapping.ld.uid
 
-        dao.insert_physical_timeseries_message(msg)
+def on_message_flushed(delivery_tag, pd, msg, pts_uid, err) -> None:
+    """
+    Called by the batch writer thread once msg has been written to physical_timeseries as
+    the row with uid pts_uid, or the write failed. If the physical device has an active
+    mapping the logical device id has been added to msg, and the logical device's last_seen
+    and last_msg have been updated by the same write.
 
-        ld = mapping.ld
+    pika is not thread safe so anything touching the RabbitMQ channels is handed back to
+    the event loop thread.
+    """
+    if err is not None:
+        if dao.is_unavailable(err):
+            # The message is not in the database, so have RabbitMQ redeliver it.
+            lu.cid_logger.error('Failed to write message to physical_timeseries, requeuing message.', extra=msg)
+            _loop.call_soon_threadsafe(_settle_message, delivery_tag, None, False)
+        else:
+            # The message itself cannot be written, so redelivering it would fail forever.
+            lu.cid_logger.error(f'Message cannot be written to physical_timeseries, dropping message: {err}', extra=msg)
+            _loop.call_soon_threadsafe(_settle_message, delivery_tag, None, True)
+        return
+
+    try:
+        if BrokerConstants.LOGICAL_DEVICE_UID_KEY not in msg:
+            lu.cid_logger.warning(f'No active device mapping found for {pd.source_ids}, cannot continue. Dropping message.', extra=msg)
+
+            # Ack the message, even though we cannot process it. We don't want it redelivered.
+            # We can change this to a Nack if that would provide extra context somewhere.
+            _loop.call_soon_threadsafe(_settle_message, delivery_tag, None, True)
+            return
 
         # Determine if the message has a future timestamp.
         ts_str: datetime.datetime = msg[BrokerConstants.TIMESTAMP_KEY]
@@ -136,32 +225,44 @@ def on_message(channel, method, properties, body):
         utc_now = datetime.datetime.now(datetime.timezone.utc)
         ts_delta = utc_now - ts
 
-        # Drop messages with a timestamp more than 1 hour in the future.
+        # Drop messages with a timestamp more than 1 hour in the future. The logical device
+        # was not updated from them.
         if ts_delta < _max_delta:
             lu.cid_logger.warning(f'Message with future timestamp. Dropping message.', extra=msg)
             # Ack the message, even though we cannot process it. We don't want it redelivered.
             # We can change this to a Nack if that would provide extra context somewhere.
-            _rx_channel._channel.basic_ack(delivery_tag)
+            _loop.call_soon_threadsafe(_settle_message, delivery_tag, None, True)
             return
 
-        if ts > utc_now:
-            # If the timestamp is a bit in the future then make the last seen time 'now'.
-            ld.last_seen = utc_now
-        else:
-            ld.last_seen = ts
+        _loop.call_soon_threadsafe(_settle_message, delivery_tag, msg, True, pts_uid)
+
+    except BaseException as e:
+        logging.exception('Error while processing message')
+        _loop.call_soon_threadsafe(_settle_message, delivery_tag, None, True)
 
-        lu.cid_logger.info(f'Timestamp from message for LD last seen update: {ld.last_seen}', extra=msg)
-        ld.properties[BrokerConstants.LAST_MSG] = msg
-        dao.update_logical_device(ld)
 
-        _tx_channel.publish_message('logical_timeseries', msg)
+def _settle_message(delivery_tag, msg, ack: bool, pts_uid: int | None = None) -> None:
+    """
+    Runs on the event loop thread. Publishes msg to the logical_timeseries exchange if it
+    is not None, then acks or requeues the incoming message.
 
-        # This tells RabbitMQ the message is handled and can be deleted from the queue.
-        _rx_channel._channel.basic_ack(delivery_tag)
+    The uid of msg's physical_timeseries row is sent in a header so delivery services can
+    store a reference to the row rather than a copy of the message.
+    """
+    try:
+        if msg is not None:
+            headers = {BrokerConstants.PHYSICAL_TIMESERIES_UID_HEADER: pts_uid} if pts_uid is not None else None
+            _tx_channel.publish_message('logical_timeseries', msg, headers)
 
+        # This tells RabbitMQ the message is handled and can be deleted from the queue.
+        if ack:
+            _rx_channel._channel.basic_ack(delivery_tag)
+        else:
+            _rx_channel._channel.basic_nack(delivery_tag, requeue=True)
     except BaseException as e:
-        logging.exception('Error while processing message')
-        _rx_channel._channel.basic_ack(delivery_tag)
+        # If the channel has closed the message will be redelivered when the connection
+        # is re-established.
+        logging.exception(f'Failed to settle delivery tag {delivery_tag}')
 
 
 if __name__ == '__main__':
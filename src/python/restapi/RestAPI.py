@@ -10,13 +10,15 @@ import json
 import logging
 
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, Response, status, Query
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPBasic
 
 #from fastapi.responses import JSONResponse
-from typing import Annotated, List, Dict
+from typing import Annotated, AsyncIterator, List, Literal, Dict
 
 from pdmodels.Models import DeviceNote, PhysicalDevice, LogicalDevice, PhysicalToLogicalMapping
-import api.client.DAO as dao
+import api.client.AsyncDAO as dao
+import api.client.TokenCache as token_cache
 
 import base64
 
@@ -33,7 +35,7 @@ async def get_all_physical_sources() -> List[str]:
     Return a list of all physical device sources.
     """
     try:
-        return dao.get_all_physical_sources()
+        return await dao.get_all_physical_sources()
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -70,9 +72,9 @@ async def query_physical_devices(source_name: str = None, include_properties: bo
     """
 
     if source_name is None:
-        devs = dao.get_all_physical_devices()
+        devs = await dao.get_all_physical_devices()
     else:
-        devs = dao.get_physical_devices_from_source(source_name)
+        devs = await dao.get_physical_devices_from_source(source_name)
 
     if include_properties != True:
         for d in devs:
@@ -87,7 +89,7 @@ async def get_physical_device(uid: int) -> PhysicalDevice:
     Get the PhysicalDevice specified by uid.
     """
     try:
-        dev = dao.get_physical_device(uid)
+        dev = await dao.get_physical_device(uid)
         if dev is None:
             raise HTTPException(status_code=404, detail="Physical device not found")
 
@@ -102,7 +104,7 @@ async def get_unmapped_physical_devices() -> List[PhysicalDevice]:
     Returns a list of unmapped PhysicalDevices.
     """
     try:
-        return dao.get_unmapped_physical_devices()
+        return await dao.get_unmapped_physical_devices()
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -113,7 +115,7 @@ async def create_physical_device(device: PhysicalDevice, request: Request, respo
     Create a new PhysicalDevice. The new device is returned in the response.
     """
     try:
-        pd = dao.create_physical_device(device)
+        pd = await dao.create_physical_device(device)
         response.headers['Location'] = f'{request.url}{pd.uid}'
         return pd
     except dao.DAOException as err:
@@ -126,7 +128,7 @@ async def update_physical_device(device: PhysicalDevice) -> PhysicalDevice:
     Update a PhysicalDevice. The updated device is returned in the respose.
     """
     try:
-        return dao.update_physical_device(device)
+        return await dao.update_physical_device(device)
     except dao.DAODeviceNotFound as daonf:
         raise HTTPException(status_code=404, detail=daonf.msg)
     except dao.DAOException as err:
@@ -140,7 +142,7 @@ async def delete_physical_device(uid: int) -> None:
     Delete a PhysicalDevice. The deleted device is returned in the response.
     """
     try:
-        pd = dao.delete_physical_device(uid)
+        pd = await dao.delete_physical_device(uid)
         if pd is None:
             raise HTTPException(status_code=404)
 
@@ -157,7 +159,7 @@ async def create_physical_device_note(uid: int, note: DeviceNote, request: Reque
     Create a new note for a PhysicalDevice.
     """
     try:
-        dao.create_physical_device_note(uid, note.note)
+        await dao.create_physical_device_note(uid, note.note)
         #response.headers['Location'] = f'{request.url}{pd.uid}'
     except dao.DAODeviceNotFound as err:
         raise HTTPException(status_code=404, detail=err.msg)
@@ -168,7 +170,7 @@ async def create_physical_device_note(uid: int, note: DeviceNote, request: Reque
 @router.get("/physical/devices/notes/{uid}", tags=['physical devices'], dependencies=[Depends(token_auth_scheme)])
 async def get_physical_device_notes(uid: int) -> List[DeviceNote]:
     try:
-        return dao.get_physical_device_notes(uid)
+        return await dao.get_physical_device_notes(uid)
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -176,7 +178,7 @@ async def get_physical_device_notes(uid: int) -> List[DeviceNote]:
 @router.patch("/physical/devices/notes/", tags=['physical devices'], dependencies=[Depends(token_auth_scheme)])
 async def patch_physical_device_note(note: DeviceNote) -> None:
     try:
-        dao.update_physical_device_note(note)
+        await dao.update_physical_device_note(note)
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -187,7 +189,7 @@ async def delete_physical_device_note(uid: int) -> None:
     Delete the given device note.
     """
     try:
-        dao.delete_physical_device_note(uid)
+        await dao.delete_physical_device_note(uid)
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -201,7 +203,7 @@ async def create_logical_device(device: LogicalDevice, request: Request, respons
     Create a new LogicalDevice. The new device is returned in the response.
     """
     try:
-        ld = dao.create_logical_device(device)
+        ld = await dao.create_logical_device(device)
         response.headers['Location'] = f'{request.url}{ld.uid}'
         return ld
     except dao.DAOException as err:
@@ -214,7 +216,7 @@ async def get_logical_devices(include_properties: bool | None = True) -> List[Lo
     Get all LogicalDevices.
     """
     try:
-        devs = dao.get_logical_devices()
+        devs = await dao.get_logical_devices()
 
         if include_properties != True:
             for d in devs:
@@ -231,7 +233,7 @@ async def get_logical_device(uid: int) -> LogicalDevice:
     Get the LogicalDevice specified by uid.
     """
     try:
-        dev = dao.get_logical_device(uid)
+        dev = await dao.get_logical_device(uid)
         if dev is None:
             raise HTTPException(status_code=404, detail="Logical device not found")
 
@@ -246,7 +248,7 @@ async def update_logical_device(device: LogicalDevice) -> LogicalDevice:
     Update a LogicalDevice. The updated device is returned in the respose.
     """
     try:
-        return dao.update_logical_device(device)
+        return await dao.update_logical_device(device)
     except dao.DAODeviceNotFound as daonf:
         raise HTTPException(status_code=404, detail=daonf.msg)
     except dao.DAOException as err:
@@ -260,7 +262,7 @@ async def delete_logical_device(uid: int) -> None:
     Delete a LogicalDevice. The deleted device is returned in the response.
     """
     try:
-        ld = dao.delete_logical_device(uid)
+        ld = await dao.delete_logical_device(uid)
         if ld is None:
             raise HTTPException(status_code=404)
     except dao.DAOException as err:
@@ -282,7 +284,7 @@ async def insert_mapping(mapping: PhysicalToLogicalMapping) -> None:
     If the logical device already has a mapping, that mapping is ended.
     """
     try:
-        dao.insert_mapping(mapping)
+        await dao.insert_mapping(mapping)
     except dao.DAODeviceNotFound as daonf:
         raise HTTPException(status_code=404, detail=daonf.msg)
     except dao.DAOUniqeConstraintException as err:
@@ -301,7 +303,7 @@ async def get_current_mappings(return_uids: bool = True) -> PhysicalToLogicalMap
     device.
     """
     try:
-        mappings = dao.get_all_current_mappings(return_uids=return_uids)
+        mappings = await dao.get_all_current_mappings(return_uids=return_uids)
         return mappings
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
@@ -317,26 +319,28 @@ async def toggle_device_mapping(is_active:bool, puid: int = None, luid:int = Non
     if puid == None and luid == None:
         raise HTTPException(status_code=400, detail="A uid must be provided")
 
-    current_mapping = dao.get_current_device_mapping(pd=puid, ld=luid)
+    current_mapping = await dao.get_current_device_mapping(pd=puid, ld=luid, return_uids=True)
     if current_mapping == None:
         raise HTTPException(status_code=404, detail="Device with uid provided could not be found")
 
     try:
-        dao.toggle_device_mapping(is_active=is_active, pd=puid, ld=luid);
+        await dao.toggle_device_mapping(is_active=is_active, pd=puid, ld=luid);
 
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
 
 @router.get("/mappings/physical/current/{uid}", tags=['device mapping'], response_model=PhysicalToLogicalMapping, dependencies=[Depends(token_auth_scheme)])
-async def get_current_mapping_from_physical_uid(uid: int) -> PhysicalToLogicalMapping:
+async def get_current_mapping_from_physical_uid(uid: int, return_uids: bool = False) -> PhysicalToLogicalMapping:
     """
     Returns the _current_ mapping for the given physical device. A current mapping is one with no
     end time set, meaning messages from the physical device will be forwarded to the logical
     device.
+
+    If `return_uids` is true the mapping holds the device uids rather than the devices.
     """
     try:
-        mapping = dao.get_current_device_mapping(pd=uid)
+        mapping = await dao.get_current_device_mapping(pd=uid, return_uids=return_uids)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for physical device {uid} not found.')
 
@@ -346,13 +350,15 @@ async def get_current_mapping_from_physical_uid(uid: int) -> PhysicalToLogicalMa
 
 
 @router.get("/mappings/physical/latest/{uid}", tags=['device mapping'], response_model=PhysicalToLogicalMapping, dependencies=[Depends(token_auth_scheme)])
-async def get_latest_mapping_from_physical_uid(uid: int) -> PhysicalToLogicalMapping:
+async def get_latest_mapping_from_physical_uid(uid: int, return_uids: bool = False) -> PhysicalToLogicalMapping:
     """
     Returns the _latest_ mapping for the given physical device. The latest mapping is the most recent
     mapping for the logical device, even if it has ended.
+
+    If `return_uids` is true the mapping holds the device uids rather than the devices.
     """
     try:
-        mapping = dao.get_current_device_mapping(pd=uid, only_current_mapping=False)
+        mapping = await dao.get_current_device_mapping(pd=uid, only_current_mapping=False, return_uids=return_uids)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for physical device {uid} not found.')
 
@@ -361,12 +367,14 @@ async def get_latest_mapping_from_physical_uid(uid: int) -> PhysicalToLogicalMap
         raise HTTPException(status_code=500, detail=err.msg)
 
 @router.get("/mappings/physical/all/{uid}", tags=['device mapping'], response_model=List[PhysicalToLogicalMapping], dependencies=[Depends(token_auth_scheme)])
-async def get_all_mappings_to_physical_uid(uid: int) -> List[PhysicalToLogicalMapping]:
+async def get_all_mappings_to_physical_uid(uid: int, return_uids: bool = False) -> List[PhysicalToLogicalMapping]:
     """
     Returns the all mappings for the given physical device
+
+    If `return_uids` is true the mappings hold the device uids rather than the devices.
     """
     try:
-        mappings = dao.get_physical_device_mappings(pd=uid)
+        mappings = await dao.get_physical_device_mappings(pd=uid, return_uids=return_uids)
         if mappings is None:
             raise HTTPException(status_code=404, detail=f'Device mappings for physical device {uid} not found.')
 
@@ -382,24 +390,26 @@ async def end_mapping_of_physical_uid(uid: int) -> None:
     after this call.
     """
     try:
-        mapping = dao.get_current_device_mapping(pd=uid)
+        mapping = await dao.get_current_device_mapping(pd=uid, return_uids=True)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for physical device {uid} not found.')
 
-        dao.end_mapping(pd=uid)
+        await dao.end_mapping(pd=uid)
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
 
 @router.get("/mappings/logical/current/{uid}", tags=['device mapping'], response_model=PhysicalToLogicalMapping, dependencies=[Depends(token_auth_scheme)])
-async def get_current_mapping_to_logical_uid(uid: int) -> PhysicalToLogicalMapping:
+async def get_current_mapping_to_logical_uid(uid: int, return_uids: bool = False) -> PhysicalToLogicalMapping:
     """
     Returns the _current_ mapping for the given logical device. A current mapping is one with no
     end time set, meaning messages from the physical device will be forwarded to the logical
     device.
+
+    If `return_uids` is true the mapping holds the device uids rather than the devices.
     """
     try:
-        mapping = dao.get_current_device_mapping(ld=uid)
+        mapping = await dao.get_current_device_mapping(ld=uid, return_uids=return_uids)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for logical device {uid} not found.')
 
@@ -409,13 +419,15 @@ async def get_current_mapping_to_logical_uid(uid: int) -> PhysicalToLogicalMappi
 
 
 @router.get("/mappings/logical/latest/{uid}", tags=['device mapping'], response_model=PhysicalToLogicalMapping, dependencies=[Depends(token_auth_scheme)])
-async def get_latest_mapping_to_logical_uid(uid: int) -> PhysicalToLogicalMapping:
+async def get_latest_mapping_to_logical_uid(uid: int, return_uids: bool = False) -> PhysicalToLogicalMapping:
     """
     Returns the _latest_ mapping for the given logical device. The latest mapping is the most recent
     mapping for the logical device, even if it has ended.
+
+    If `return_uids` is true the mapping holds the device uids rather than the devices.
     """
     try:
-        mapping = dao.get_current_device_mapping(ld=uid, only_current_mapping=False)
+        mapping = await dao.get_current_device_mapping(ld=uid, only_current_mapping=False, return_uids=return_uids)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for logical device {uid} not found.')
 
@@ -425,12 +437,14 @@ async def get_latest_mapping_to_logical_uid(uid: int) -> PhysicalToLogicalMappin
 
 
 @router.get("/mappings/logical/all/{uid}", tags=['device mapping'], dependencies=[Depends(token_auth_scheme)])
-async def get_all_mappings_to_logical_uid(uid: int) -> List[PhysicalToLogicalMapping]:
+async def get_all_mappings_to_logical_uid(uid: int, return_uids: bool = False) -> List[PhysicalToLogicalMapping]:
     """
     Returns all mappings made to the given logical device.
+
+    If `return_uids` is true the mappings hold the device uids rather than the devices.
     """
     try:
-        mappings = dao.get_logical_device_mappings(ld=uid)
+        mappings = await dao.get_logical_device_mappings(ld=uid, return_uids=return_uids)
         if mappings is None:
             raise HTTPException(status_code=404, detail=f'No mappings to logical device {uid} were found.')
 
@@ -447,11 +461,11 @@ async def end_mapping_of_logical_uid(uid: int) -> None:
     after this call.
     """
     try:
-        mapping = dao.get_current_device_mapping(ld=uid)
+        mapping = await dao.get_current_device_mapping(ld=uid, return_uids=True)
         if mapping is None:
             raise HTTPException(status_code=404, detail=f'Device mapping for logical device {uid} not found.')
 
-        dao.end_mapping(ld=uid)
+        await dao.end_mapping(ld=uid)
     except dao.DAOException as err:
         raise HTTPException(status_code=500, detail=err.msg)
 
@@ -470,10 +484,16 @@ async def get_physical_timeseries(
         start: datetime.datetime = None,
         end: datetime.datetime = None,
         include_received_at: bool = False,
-        only_timestamp: bool = False) -> List[Dict]:
+        only_timestamp: bool = False,
+        ascending: bool = False,
+        stream: bool = False) -> List[Dict]:
     """
     Get the physical_timeseries entries described by the physical device uid and the parameters.
 
+    If stream is true the entries are sent as they are read from the database, as newline
+    delimited JSON with one entry per line, and count may be omitted to return every entry
+    in the time range.
+
     Args:
         request: The HTTP request object.
         p_uid: The unique identifier of a physical device. Mutually exclusive with l_uid.
@@ -483,6 +503,8 @@ async def get_physical_timeseries(
         start: The start date and time of the time range.
         end: The end date and time of the time range.
         only_timestamp: Whether to only return the timestamp of the entries.
+        ascending: Return the oldest entries first rather than the newest.
+        stream: Stream the entries as newline delimited JSON.
 
     Returns:
         A list of dictionaries containing the entries.
@@ -522,11 +544,15 @@ async def get_physical_timeseries(
 
             start = end - diff
 
+        if stream and (p_uid is not None or l_uid is not None):
+            msgs = await dao.stream_physical_timeseries_message(start, end, count, only_timestamp, include_received_at, p_uid=p_uid, l_uid=l_uid, ascending=ascending)
+            return StreamingResponse(_ndjson_lines(msgs), media_type='application/x-ndjson')
+
         msgs = None
         if p_uid is not None:
-            msgs = dao.get_physical_timeseries_message(start, end, count, only_timestamp, include_received_at, p_uid=p_uid)
+            msgs = await dao.get_physical_timeseries_message(start, end, count, only_timestamp, include_received_at, p_uid=p_uid, ascending=ascending)
         elif l_uid is not None:
-            msgs = dao.get_physical_timeseries_message(start, end, count, only_timestamp, include_received_at, l_uid=l_uid)
+            msgs = await dao.get_physical_timeseries_message(start, end, count, only_timestamp, include_received_at, l_uid=l_uid, ascending=ascending)
 
         if msgs is None:
             raise HTTPException(status_code=404, detail="Failed to retrieve messages")
@@ -534,11 +560,72 @@ async def get_physical_timeseries(
         #logging.info(msgs)
         #logging.info(f'read {len(msgs)} messages')
         return msgs
+    except dao.DAOBusy as err:
+        logging.warning(err.msg)
+        raise HTTPException(status_code=503, detail=err.msg, headers={'Retry-After': '30'})
+    except dao.DAOException as err:
+        logging.exception(err)
+        raise HTTPException(status_code=500, detail=err.msg)
+
+
+@router.get("/rollups", tags=['Messages'], dependencies=[Depends(token_auth_scheme)])
+async def get_timeseries_rollups(
+        l_uid: int,
+        interval: Literal['hour', 'day'] = 'hour',
+        start: datetime.datetime = None,
+        end: datetime.datetime = None,
+        name: Annotated[List[str] | None, Query()] = None) -> List[Dict]:
+    """
+    Get the hourly or daily count, minimum, maximum and average of a logical device's timeseries values.
+
+    Args:
+        l_uid: The unique identifier of a logical device.
+        interval: The aggregation interval, 'hour' or 'day'. Buckets are UTC hours or days.
+        start: Return buckets starting at or after this time.
+        end: Return buckets starting before this time.
+        name: Only return aggregates for these value names. May be given more than once.
+
+    Returns:
+        A list of dictionaries with the keys name, bucket, count, min, max and avg, ordered by name and bucket.
+
+    Raises:
+        HTTPException: If an error occurs.
+    """
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=422, detail={"detail": [{"loc": ["query", "start"], "msg": "ensure start value is less than end"}]})
+
+    try:
+        return await dao.get_timeseries_rollups(l_uid, interval, start, end, name)
     except dao.DAOException as err:
         logging.exception(err)
         raise HTTPException(status_code=500, detail=err.msg)
 
 
+async def _ndjson_lines(msgs: AsyncIterator[Dict]) -> AsyncIterator[str]:
+    """
+    Yields the messages as newline delimited JSON, a few hundred kB at a time.
+    """
+    lines = []
+    size = 0
+    try:
+        async for msg in msgs:
+            line = json.dumps(msg) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size >= 262144:
+                yield ''.join(lines)
+                lines = []
+                size = 0
+
+        if len(lines) > 0:
+            yield ''.join(lines)
+
+    except dao.DAOException as err:
+        # The response has already started so the status code cannot be changed, the
+        # client sees a truncated response.
+        logging.exception(err)
+
+
 """--------------------------------------------------------------------------
 USER AUTHENTICATION
 --------------------------------------------------------------------------"""
@@ -551,7 +638,7 @@ async def get_user_token(request: Request) -> str:
     """
     basic_auth = request.headers['Authorization'].split(' ')[1]
     username, password = base64.b64decode(basic_auth).decode().split(":")
-    user_auth_token = dao.user_get_token(username=username, password=password)
+    user_auth_token = await dao.user_get_token(username=username, password=password)
     if user_auth_token != None:
         return user_auth_token
     else:
@@ -565,7 +652,9 @@ async def change_password(password:str, request:Request) -> str:
     Change users password
     """
     try:
-        user_auth_token=dao.user_change_password_and_token(new_passwd=password, prev_token=request.headers['Authorization'].replace("Bearer ",""))
+        prev_token = request.headers['Authorization'].replace("Bearer ","")
+        user_auth_token=await dao.user_change_password_and_token(new_passwd=password, prev_token=prev_token)
+        token_cache.invalidate_token(prev_token)
         return user_auth_token
 
     except dao.DAOException as err:
@@ -576,6 +665,16 @@ app = FastAPI(title='IoT Device Broker', version='1.0.0')
 app.include_router(router)
 
 
+@app.on_event('startup')
+async def start_token_cache() -> None:
+    token_cache.start()
+
+
+@app.on_event('shutdown')
+async def stop_token_cache() -> None:
+    token_cache.stop()
+
+
 @app.middleware("http")
 async def check_auth_header(request: Request, call_next):
 
@@ -585,16 +684,14 @@ async def check_auth_header(request: Request, call_next):
                 return Response(content="", status_code=401)
 
             token = request.headers['Authorization'].split(' ')[1]
-            is_valid=dao.token_is_valid(token)
+            user = await token_cache.get_user(token)
 
-            if not is_valid:
+            if user is None or not user.valid:
                 print(f'Authentication failed for url: {request.url}')
                 return Response(content="", status_code=401)
 
-            if request.method != 'GET':
-                user=dao.get_user(auth_token=token)
-                if user is None or user.read_only is True:
-                    return Response(content="", status_code=403)
+            if request.method != 'GET' and user.read_only is True:
+                return Response(content="", status_code=403)
     except:
         return Response(content="", status_code=401)
 
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Measure REST API throughput and latency under concurrent load.
+
+Runs a fixed number of concurrent clients against one endpoint for a fixed
+time and reports requests per second and latency percentiles. Run it against
+the broker before and after a change to compare the two, for example:
+
+    python BenchRestAPI.py --url http://localhost:5687 --token $TOKEN \\
+        --path /broker/api/physical/devices/ --concurrency 1,10,50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+
+async def run_client(client: httpx.AsyncClient, path: str, end_time: float, latencies: List[float], errors: Dict[str, int]) -> None:
+    """
+    Send requests to path one after another until time.monotonic() reaches end_time. The latency
+    of each successful request is appended to latencies, and failed requests are counted in errors
+    by status code or exception name.
+    """
+    while time.monotonic() < end_time:
+        start = time.monotonic()
+        try:
+            r = await client.get(path)
+            if r.status_code == 200:
+                latencies.append(time.monotonic() - start)
+            else:
+                errors[str(r.status_code)] = errors.get(str(r.status_code), 0) + 1
+        except httpx.HTTPError as err:
+            errors[type(err).__name__] = errors.get(type(err).__name__, 0) + 1
+
+
+async def bench(url: str, token: str, path: str, concurrency: int, duration: float) -> Dict[str, float]:
+    """
+    Run concurrency clients against path on the REST API at url for duration seconds. Returns the
+    request count, error count, requests per second and latency percentiles in milliseconds.
+    """
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {'Authorization': f'Bearer {token}'}
+
+    async with httpx.AsyncClient(base_url=url, headers=headers, limits=limits, timeout=60.0) as client:
+        start = time.monotonic()
+        end_time = start + duration
+        await asyncio.gather(*[run_client(client, path, end_time, latencies, errors) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+
+    if errors:
+        print(f'Errors: {errors}', file=sys.stderr)
+
+    result = {'requests': len(latencies), 'errors': sum(errors.values()), 'rps': len(latencies) / elapsed}
+    if len(latencies) > 1:
+        q = statistics.quantiles(latencies, n=100)
+        result.update({'p50_ms': q[49] * 1000, 'p95_ms': q[94] * 1000, 'p99_ms': q[98] * 1000})
+
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure REST API throughput under concurrent load.')
+    parser.add_argument('--url', default='http://localhost:5687', help='Base URL of the REST API.')
+    parser.add_argument('--token', default=os.getenv('RESTAPI_TOKEN'), help='Bearer token, defaults to $RESTAPI_TOKEN.')
+    parser.add_argument('--path', default='/broker/api/physical/devices/', help='Endpoint to request.')
+    parser.add_argument('--concurrency', default='1,10,50', help='Comma separated list of client counts to test.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run each test for.')
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error('A token must be given with --token or $RESTAPI_TOKEN.')
+
+    print('concurrency  requests  errors      req/s   p50 ms   p95 ms   p99 ms')
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        r = asyncio.run(bench(args.url, args.token, args.path, concurrency, args.duration))
+        print(f'{concurrency:11d}  {r["requests"]:8d}  {r["errors"]:6d}  {r["rps"]:9.1f}  '
+              f'{r.get("p50_ms", 0):7.1f}  {r.get("p95_ms", 0):7.1f}  {r.get("p99_ms", 0):7.1f}')
+
+
+if __name__ == '__main__':
+    main()
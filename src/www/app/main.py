@@ -1,13 +1,16 @@
 import atexit
+import csv
+import dateutil.parser
 import io
+import json
 import logging
-import pandas as pd
+import tempfile
 import time
-from typing import Dict, Tuple
+from typing import Dict, Iterator, List, Tuple
 import uuid
 from zoneinfo import ZoneInfo
 
-from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory
 
 import folium
 import folium.plugins
@@ -684,6 +687,33 @@ def UpdateMappings():
         return f"HTTP request with RestAPI failed with error {e.response.status_code}", e.response.status_code
 
 
+def _csv_rows(rows, l_uid: int, names: List[str], user_timezone: str) -> Iterator[str]:
+    """
+    Yield the CSV for the download-data page from a file of JSON encoded rows in timestamp
+    order, a block of rows at a time. The rows file is closed when the CSV is complete.
+    """
+    tz = ZoneInfo(user_timezone) if user_timezone else timezone.utc
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    try:
+        writer.writerow(['l_uid', 'ts', 'received_at'] + names + ['ts_local'])
+        for i, line in enumerate(rows):
+            item = json.loads(line)
+            ts = dateutil.parser.isoparse(item['ts'])
+            received_at = dateutil.parser.isoparse(item['received_at']) if item['received_at'] is not None else None
+            writer.writerow([l_uid, ts, received_at] + [item.get(name) for name in names] + [ts.astimezone(tz)])
+
+            if i % 1000 == 999:
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+
+        yield out.getvalue()
+    finally:
+        rows.close()
+
+
 @app.route('/download-data', methods=['POST'])
 def DownloadData():
     try:
@@ -722,31 +752,32 @@ def DownloadData():
             end = end + timedelta(days=1)
             logging.info(f'adjusted end = {end}')
 
-        msgs = get_messages(token, l_uid, start, end)
-        if len(msgs) < 1:
+        # The CSV header needs the name of every timeseries value in the time range, so the
+        # rows are written to a temporary file as the messages arrive, and the CSV is streamed
+        # from that file. This keeps memory use constant however many messages there are.
+        rows = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode='w+', encoding='UTF-8')
+        names = {}
+        try:
+            for msg in stream_messages(token, l_uid, start, end):
+                item = {'ts': msg['timestamp'], 'received_at': msg['received_at_utc']}
+                for obj in msg['timeseries']:
+                    item[obj['name']] = obj['value']
+                    names[obj['name']] = True
+
+                rows.write(json.dumps(item) + '\n')
+        except BaseException:
+            rows.close()
+            raise
+
+        if rows.tell() < 1:
+            rows.close()
             return 'No messages.', 204
 
-        dataset = []
-        for msg in msgs:
-            item = {'l_uid': l_uid, 'ts': msg['timestamp'], 'received_at': msg['received_at_utc']}
-            for obj in msg['timeseries']:
-                item[obj['name']] = obj['value']
-            dataset.append(item)
-
-        df = pd.DataFrame(dataset)
-        df['ts'] = pd.to_datetime(df['ts'])
-        df['received_at'] = pd.to_datetime(df['received_at'])
-        df['ts_local'] = df['ts'].dt.tz_convert(user_timezone)
-        df.set_index(['l_uid', 'ts'], inplace=True)
-        df.sort_index(level=0, sort_remaining=True, inplace=True, ascending=True)
-
-        buffer = io.BytesIO()
-        df.to_csv(buffer, encoding='UTF-8')
-        buffer.seek(0)
-
+        rows.seek(0)
         sanitised_dev_name = re.sub(r'[^a-zA-Z0-9_-]', '', logical_dev.name)
 
-        return send_file(buffer, as_attachment=True, download_name=f'{sanitised_dev_name}.csv')
+        return Response(_csv_rows(rows, l_uid, list(names), user_timezone), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={sanitised_dev_name}.csv'})
 
 
     except requests.exceptions.HTTPError as e:
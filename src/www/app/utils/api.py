@@ -1,6 +1,6 @@
 import logging
 import json, os
-from typing import Any, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 import requests
 from datetime import datetime, timezone
 import base64
@@ -207,6 +207,35 @@ def get_messages(token: str, l_uid: int, start_ts: Optional[datetime] = None, en
     return response.json()
 
 
+def stream_messages(token: str, l_uid: int, start_ts: Optional[datetime] = None, end_ts: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+    """
+        Yield every message for a logical device in the time range, oldest first, as they are
+        received from the restAPI, so any number of messages can be processed without holding
+        them all in memory.
+
+        Params:
+            token: str - user's authentication token
+            l_uid: int - the logical device uid
+            start_ts: datetime - return messages after this time
+            end_ts: datetime - return messages up to and including this time
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    params = {"l_uid": l_uid, "include_received_at": True, "ascending": True, "stream": True}
+    if start_ts is not None:
+        params['start'] = start_ts
+    if end_ts is not None:
+        params['end'] = end_ts
+
+    with requests.get(f'{end_point}/broker/api/messages', headers=headers, params=params, stream=True) as response:
+        if response.status_code != 200:
+            logging.error(response.text)
+
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
 def end_physical_mapping(uid: str, token: str):
     """
         End device mapping from a physical device (if any). If there was a mapping, the logical device also has no mapping after this call.
@@ -0,0 +1,73 @@
+import logging, threading, time, unittest
+
+import psycopg2
+
+from api.client.ConnectionPool import ConnectionPool, PoolTimeout
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(1, 2, timeout=0.5, max_age=3600, check_after_idle=0.1)
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_acquire_waits_then_times_out(self):
+        conn1 = self.pool.getconn()
+        conn2 = self.pool.getconn()
+
+        start = time.monotonic()
+        self.assertRaises(PoolTimeout, self.pool.getconn)
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+        # A connection returned while a caller is waiting is handed to that caller.
+        threading.Timer(0.1, self.pool.putconn, (conn1,)).start()
+        self.assertIs(self.pool.getconn(timeout=2), conn1)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['in_use'], 2)
+        self.assertEqual(stats['exhausted'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreater(stats['max_wait'], 0.05)
+
+        self.pool.putconn(conn1)
+        self.pool.putconn(conn2)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_broken_connections_are_recycled(self):
+        conn = self.pool.getconn()
+        conn.close()
+        self.pool.putconn(conn)
+        self.assertEqual(self.pool.stats()['recycled'], 1)
+
+        conn = self.pool.getconn()
+        self.assertEqual(conn.closed, 0)
+
+        # Simulate a database restart by terminating the idle connection's backend.
+        with conn.cursor() as cursor:
+            cursor.execute('select pg_backend_pid()')
+            pid = cursor.fetchone()[0]
+        conn.rollback()
+        self.pool.putconn(conn)
+
+        killer = psycopg2.connect('')
+        killer.autocommit = True
+        with killer.cursor() as cursor:
+            cursor.execute('select pg_terminate_backend(%s)', (pid, ))
+        killer.close()
+
+        time.sleep(0.2)
+        conn = self.pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute('select 1')
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.pool.putconn(conn)
+
+        self.assertEqual(self.pool.stats()['failed_checks'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
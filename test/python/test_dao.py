@@ -1,7 +1,8 @@
-import copy, datetime, logging, time, unittest, uuid, warnings, dateutil.parser
+import asyncio, copy, datetime, logging, time, unittest, uuid, warnings, dateutil.parser
 
 import BrokerConstants
 import api.client.DAO as dao
+import api.client.AsyncDAO as async_dao
 from pdmodels.Models import PhysicalDevice, PhysicalToLogicalMapping, Location, LogicalDevice
 from typing import Tuple
 import os
@@ -33,6 +34,7 @@ class TestDAO(unittest.TestCase):
                     truncate physical_logical_map cascade;
                     truncate device_notes cascade;
                     truncate physical_timeseries cascade;
+                    truncate timeseries_values;
                     truncate raw_messages cascade;
                     delete from sources where source_name = 'axistech';''')
         finally:
@@ -265,6 +267,20 @@ class TestDAO(unittest.TestCase):
         new_dev.uid = -1
         self.assertRaises(dao.DAODeviceNotFound, dao.update_logical_device, new_dev)
 
+    def test_init_logical_device_property(self):
+        dev, new_dev = self._create_default_logical_device()
+
+        self.assertEqual(dao.init_logical_device_property(new_dev.uid, ['ubidots', 'label'], 'a'), 'a')
+        # An existing value is not replaced.
+        self.assertEqual(dao.init_logical_device_property(new_dev.uid, ['ubidots', 'label'], 'b'), 'a')
+        self.assertEqual(dao.init_logical_device_property(new_dev.uid, ['ubidots', 'id'], 1), 1)
+
+        updated_dev = dao.get_logical_device(new_dev.uid)
+        self.assertEqual(updated_dev.properties, new_dev.properties | {'ubidots': {'label': 'a', 'id': 1}})
+
+        self.assertIsNone(dao.init_logical_device_property(-1, ['ubidots', 'label'], 'a'))
+        self.assertRaises(ValueError, dao.init_logical_device_property, new_dev.uid, [], 'a')
+
     def test_delete_logical_device(self):
         dev, new_dev = self._create_default_logical_device()
         self.assertEqual(dao.delete_logical_device(new_dev.uid), new_dev)
@@ -510,6 +526,39 @@ class TestDAO(unittest.TestCase):
         self.assertEqual(mappings[1], mapping2)
         self.assertEqual(mappings[2], mapping1)
 
+    def test_get_mappings_return_uids(self):
+        pdev, new_pdev = self._create_physical_device()
+        ldev, new_ldev = self._create_default_logical_device()
+        mapping = PhysicalToLogicalMapping(pd=new_pdev, ld=new_ldev, start_time=_now())
+        dao.insert_mapping(mapping)
+
+        full = dao.get_current_device_mapping(pd=new_pdev.uid)
+        self.assertEqual(full.pd, new_pdev)
+        self.assertEqual(full.ld, new_ldev)
+
+        for m in [dao.get_current_device_mapping(pd=new_pdev.uid, return_uids=True),
+                  dao.get_physical_device_mappings(new_pdev, return_uids=True)[0],
+                  dao.get_logical_device_mappings(new_ldev, return_uids=True)[0],
+                  dao.get_all_current_mappings(return_uids=True)[0]]:
+            self.assertEqual(m.pd, new_pdev.uid)
+            self.assertEqual(m.ld, new_ldev.uid)
+            self.assertEqual(m.start_time, full.start_time)
+            self.assertEqual(m.is_active, full.is_active)
+
+        self.assertEqual(dao.get_all_current_mappings(return_uids=False)[0], full)
+        self.assertEqual(dao.get_physical_device_mappings(new_pdev)[0], full)
+
+    def test_async_dao(self):
+        pdev, new_pdev = self._create_physical_device()
+
+        async def run():
+            return await asyncio.gather(*[async_dao.get_physical_device(new_pdev.uid) for _ in range(20)])
+
+        for dev in asyncio.run(run()):
+            self.assertEqual(dev, new_pdev)
+
+        self.assertRaises(async_dao.DAODeviceNotFound, asyncio.run, async_dao.update_logical_device(LogicalDevice(uid=-1, name='Missing')))
+
     def test_get_unmapped_devices(self):
         pdev, new_pdev = self._create_physical_device()
         ldev, new_ldev = self._create_default_logical_device()
@@ -619,6 +668,220 @@ class TestDAO(unittest.TestCase):
             self.assertEqual(ts, msg_ts)
             self.assertEqual(msg, retrieved_msg)
 
+    def test_insert_physical_timeseries_messages(self):
+        dev, new_dev = self._create_physical_device()
+
+        msgs = []
+        for i in range(5):
+            msgs.append({
+                BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_dev.uid,
+                BrokerConstants.TIMESTAMP_KEY: f'2023-02-20T07:5{i}:52Z',
+                BrokerConstants.TIMESERIES_KEY: [{'name': 'x', 'value': i}],
+                # Confirm escaping for the COPY text format.
+                'text': f'tab\tbackslash\\ newline\n {i}',
+                BrokerConstants.CORRELATION_ID_KEY: str(uuid.uuid4())
+            })
+
+        msgs[2][BrokerConstants.LOGICAL_DEVICE_UID_KEY] = 42
+
+        uids = dao.insert_physical_timeseries_messages(msgs)
+        self.assertEqual(len(uids), len(msgs))
+        self.assertEqual([], dao.insert_physical_timeseries_messages([]))
+
+        with dao._get_connection() as conn, conn.cursor() as cursor:
+            for uid, msg in zip(uids, msgs):
+                cursor.execute('select physical_uid, logical_uid, ts, json_msg from physical_timeseries where uid = %s', (uid, ))
+                phys_uid, log_uid, ts, retrieved_msg = cursor.fetchone()
+                self.assertEqual(phys_uid, new_dev.uid)
+                self.assertEqual(log_uid, msg.get(BrokerConstants.LOGICAL_DEVICE_UID_KEY))
+                self.assertEqual(ts, dateutil.parser.isoparse(msg[BrokerConstants.TIMESTAMP_KEY]))
+                self.assertEqual(msg, retrieved_msg)
+
+    def test_physical_timeseries_batch_writer(self):
+        dev, new_dev = self._create_physical_device()
+
+        results = []
+        writer = dao.PhysicalTimeseriesBatchWriter(max_rows=3, max_wait=0.1)
+        for i in range(7):
+            msg = {BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_dev.uid, BrokerConstants.TIMESTAMP_KEY: _now().isoformat(), 'i': i}
+            writer.add(msg, lambda m, uid, err: results.append((m, uid, err)))
+
+        writer.stop()
+        self.assertRaises(dao.DAOException, writer.add, {}, None)
+
+        self.assertEqual(len(results), 7)
+        self.assertEqual([m['i'] for m, _, _ in results], list(range(7)))
+        for _, uid, err in results:
+            self.assertIsNotNone(uid)
+            self.assertIsNone(err)
+
+        # A message for a physical device that does not exist fails the batch due to the foreign key.
+        results.clear()
+        writer = dao.PhysicalTimeseriesBatchWriter(max_rows=10, max_wait=0.1)
+        writer.add({BrokerConstants.PHYSICAL_DEVICE_UID_KEY: -1, BrokerConstants.TIMESTAMP_KEY: _now().isoformat()}, lambda m, uid, err: results.append((m, uid, err)))
+        writer.stop()
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[0][2], dao.DAOException)
+        self.assertFalse(dao.is_unavailable(results[0][2]))
+
+        # The other messages in a batch with an invalid message are still written.
+        results.clear()
+        writer = dao.PhysicalTimeseriesBatchWriter(max_rows=5, max_wait=0.1)
+        for i in range(5):
+            p_uid = -1 if i == 3 else new_dev.uid
+            writer.add({BrokerConstants.PHYSICAL_DEVICE_UID_KEY: p_uid, BrokerConstants.TIMESTAMP_KEY: _now().isoformat(), 'i': i}, lambda m, uid, err: results.append((m, uid, err)))
+
+        writer.stop()
+        self.assertEqual(sorted(m['i'] for m, _, _ in results), list(range(5)))
+        for m, uid, err in results:
+            if m['i'] == 3:
+                self.assertIsNone(uid)
+                self.assertFalse(dao.is_unavailable(err))
+            else:
+                self.assertIsNotNone(uid)
+                self.assertIsNone(err)
+
+    def test_map_and_record_physical_timeseries_messages(self):
+        _, mapped_pd = self._create_physical_device()
+        _, paused_pd = self._create_physical_device()
+        _, unmapped_pd = self._create_physical_device()
+        _, ld = self._create_default_logical_device()
+        _, paused_ld = self._create_default_logical_device()
+        dao.insert_mapping(PhysicalToLogicalMapping(pd=mapped_pd, ld=ld, start_time=_now()))
+        dao.insert_mapping(PhysicalToLogicalMapping(pd=paused_pd, ld=paused_ld, start_time=_now()))
+        dao.toggle_device_mapping(False, pd=paused_pd)
+
+        now = _now()
+        msgs = []
+        for pd, ts in ((mapped_pd, now - datetime.timedelta(minutes=2)), (mapped_pd, now - datetime.timedelta(minutes=1)),
+                       (mapped_pd, now + datetime.timedelta(hours=2)), (paused_pd, now), (unmapped_pd, now)):
+            msgs.append({
+                BrokerConstants.PHYSICAL_DEVICE_UID_KEY: pd.uid,
+                BrokerConstants.TIMESTAMP_KEY: ts.isoformat(),
+                BrokerConstants.TIMESERIES_KEY: [{'name': 'x', 'value': len(msgs)}],
+                BrokerConstants.CORRELATION_ID_KEY: str(uuid.uuid4())
+            })
+
+        results = dao.map_and_record_physical_timeseries_messages(msgs)
+        self.assertEqual([], dao.map_and_record_physical_timeseries_messages([]))
+
+        self.assertEqual([(r.l_uid, r.is_active) for r in results], [(ld.uid, True)] * 3 + [(paused_ld.uid, False), (None, None)])
+        self.assertEqual([m.get(BrokerConstants.LOGICAL_DEVICE_UID_KEY) for m in msgs], [ld.uid] * 3 + [None, None])
+
+        with dao._get_connection() as conn, conn.cursor() as cursor:
+            for result, msg in zip(results, msgs):
+                cursor.execute('select logical_uid, json_msg from physical_timeseries where uid = %s', (result.uid, ))
+                log_uid, retrieved_msg = cursor.fetchone()
+                self.assertEqual(log_uid, msg.get(BrokerConstants.LOGICAL_DEVICE_UID_KEY))
+                self.assertEqual(msg, retrieved_msg)
+
+        # The logical device is updated from the last message that is not too far in the future.
+        updated_ld = dao.get_logical_device(ld.uid)
+        self.assertEqual(updated_ld.last_seen, dateutil.parser.isoparse(msgs[1][BrokerConstants.TIMESTAMP_KEY]))
+        self.assertEqual(updated_ld.properties[BrokerConstants.LAST_MSG], msgs[1])
+        self.assertEqual(updated_ld.properties['other'], 'z')
+
+        # A paused mapping does not update its logical device.
+        self.assertEqual(dao.get_logical_device(paused_ld.uid), paused_ld)
+
+    def test_create_physical_timeseries_partitions(self):
+        dev, new_dev = self._create_physical_device()
+
+        # A message beyond the existing partitions goes to the default partition, and must be
+        # moved into the new partition when it is created.
+        future_ts = _now() + datetime.timedelta(days=31 * 8)
+        future_partition = f'physical_timeseries_{future_ts.strftime("%Y_%m")}'
+        dao.insert_physical_timeseries_message({BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_dev.uid, BrokerConstants.TIMESTAMP_KEY: future_ts.isoformat()})
+
+        dao.create_physical_timeseries_partitions(1)
+        self.assertEqual(0, dao.create_physical_timeseries_partitions(1))
+        dao.create_physical_timeseries_partitions(9)
+
+        # Every month from the current month until 9 months ahead must have an attached partition
+        # in both partitioned tables.
+        now = _now()
+        months = [f'{now.year + (now.month - 1 + i) // 12}_{(now.month - 1 + i) % 12 + 1:02d}' for i in range(10)]
+
+        with dao._get_connection() as conn, conn.cursor() as cursor:
+            for parent in ('physical_timeseries', 'timeseries_values'):
+                cursor.execute('select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid where i.inhparent = %s::regclass', (parent, ))
+                attached = {row[0] for row in cursor.fetchall()}
+                for m in months:
+                    self.assertIn(f'{parent}_{m}', attached)
+
+            cursor.execute('select count(*) from physical_timeseries_default')
+            self.assertEqual(0, cursor.fetchone()[0])
+            cursor.execute(f'select count(*) from {future_partition}')
+            self.assertEqual(1, cursor.fetchone()[0])
+
+    def test_timeseries_rollups(self):
+        _, new_pdev = self._create_physical_device()
+        _, new_ldev = self._create_default_logical_device()
+
+        base = datetime.datetime(2024, 5, 10, 10, 0, tzinfo=datetime.timezone.utc)
+        msgs = []
+        for i, minutes in enumerate([0, 20, 40, 70]):
+            msgs.append({BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_pdev.uid, BrokerConstants.LOGICAL_DEVICE_UID_KEY: new_ldev.uid,
+                         BrokerConstants.TIMESTAMP_KEY: (base + datetime.timedelta(minutes=minutes)).isoformat(),
+                         BrokerConstants.TIMESERIES_KEY: [{'name': 'temp', 'value': i}, {'name': 'status', 'value': 'ok'}]})
+
+        dao.insert_physical_timeseries_messages(msgs)
+
+        # Rows are added to the rollups by the update after the one that first sees them.
+        dao.update_timeseries_rollups()
+        dao.update_timeseries_rollups()
+
+        hour = datetime.timedelta(hours=1)
+        hourly = dao.get_timeseries_rollups(new_ldev.uid, 'hour')
+        self.assertEqual([(r['name'], r['bucket'], r['count'], r['min'], r['max'], r['avg']) for r in hourly],
+                         [('temp', base.isoformat(), 3, 0, 2, 1), ('temp', (base + hour).isoformat(), 1, 3, 3, 3)])
+
+        daily = dao.get_timeseries_rollups(new_ldev.uid, 'day', names=['temp'])
+        self.assertEqual([(r['bucket'], r['count'], r['min'], r['max'], r['avg']) for r in daily],
+                         [(base.replace(hour=0).isoformat(), 4, 0, 3, 1.5)])
+
+        self.assertEqual(1, len(dao.get_timeseries_rollups(new_ldev.uid, 'hour', start=base + hour)))
+        self.assertEqual(1, len(dao.get_timeseries_rollups(new_ldev.uid, 'hour', end=base + hour)))
+        self.assertEqual([], dao.get_timeseries_rollups(new_ldev.uid, 'hour', names=['status']))
+        self.assertRaises(ValueError, dao.get_timeseries_rollups, new_ldev.uid, 'week')
+
+    def test_timeseries_values(self):
+        _, new_pdev = self._create_physical_device()
+        _, new_ldev = self._create_default_logical_device()
+
+        base = datetime.datetime(2024, 5, 10, 10, 0, tzinfo=datetime.timezone.utc)
+        msgs = []
+        for i in range(5):
+            msgs.append({BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_pdev.uid, BrokerConstants.LOGICAL_DEVICE_UID_KEY: new_ldev.uid,
+                         BrokerConstants.TIMESTAMP_KEY: (base + datetime.timedelta(minutes=i)).isoformat(),
+                         BrokerConstants.TIMESERIES_KEY: [{'name': 'soil_moisture', 'value': i / 2}, {'name': 'status', 'value': 'ok'}]})
+
+        dao.insert_physical_timeseries_messages(msgs[:4])
+        dao.insert_physical_timeseries_message(msgs[4])
+
+        expected = [{BrokerConstants.LOGICAL_DEVICE_UID_KEY: new_ldev.uid, 'ts': (base + datetime.timedelta(minutes=i)).isoformat(), 'value': i / 2} for i in range(5)]
+        self.assertEqual(expected, dao.get_timeseries_variable('soil_moisture', l_uids=[new_ldev.uid, new_ldev.uid + 1000]))
+        self.assertEqual(expected[1:3], dao.get_timeseries_variable('soil_moisture', l_uids=[new_ldev.uid], start=base, end=base + datetime.timedelta(minutes=2)))
+        self.assertEqual(5, len(dao.get_timeseries_variable('soil_moisture', p_uids=[new_pdev.uid])))
+
+        # Only numeric values are stored.
+        self.assertIn('soil_moisture', dao.get_timeseries_variables())
+        self.assertNotIn('status', dao.get_timeseries_variables())
+        self.assertEqual([], dao.get_timeseries_variable('status', l_uids=[new_ldev.uid]))
+        self.assertRaises(ValueError, dao.get_timeseries_variable, 'soil_moisture')
+
+        # Simulate messages stored before timeseries_values existed, and backfill them.
+        with dao.get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('truncate timeseries_values')
+            cursor.execute('update timeseries_values_backfill_state set next_uid = (select max(uid) from physical_timeseries)')
+
+        self.assertEqual([], dao.get_timeseries_variable('soil_moisture', l_uids=[new_ldev.uid]))
+        while dao.backfill_timeseries_values(2) > 0:
+            pass
+
+        self.assertEqual(expected, dao.get_timeseries_variable('soil_moisture', l_uids=[new_ldev.uid]))
+
     def test_get_physical_timeseries_messages(self):
         _, new_pdev = self._create_physical_device()
 
@@ -784,6 +1047,138 @@ class TestDAO(unittest.TestCase):
         dao.user_change_password(uname, 'nuiscyeriygsreiuliu')
         self.assertIsNotNone(dao.user_get_token(username=uname, password='nuiscyeriygsreiuliu'))
 
+    def test_delivery_claims(self):
+        name = 'test_' + os.urandom(4).hex()
+        dao.create_delivery_table(name)
+        try:
+            for i in range(5):
+                dao.add_delivery_msg(name, {'i': i})
+
+            dao.add_delivery_msgs(name, [{'i': i} for i in range(5, 8)])
+            self.assertEqual(dao.get_delivery_msg_count(name), 8)
+
+            # Claims by different workers never overlap.
+            a = dao.claim_delivery_msgs(name, 'a', batch_size=3)
+            b = dao.claim_delivery_msgs(name, 'b')
+            self.assertEqual([m['i'] for _, m, _ in a], [0, 1, 2])
+            self.assertEqual([m['i'] for _, m, _ in b], [3, 4, 5, 6, 7])
+            self.assertEqual(len(dao.claim_delivery_msgs(name, 'c')), 0)
+
+            # Finishing with the wrong claimant changes nothing.
+            dao.finish_delivery_msgs(name, 'b', remove=[a[0][0]])
+            self.assertEqual(dao.get_delivery_msg_count(name), 8)
+
+            dao.finish_delivery_msgs(name, 'a', remove=[a[0][0]], retry=[a[1][0]], release=[a[2][0]])
+            self.assertEqual(dao.get_delivery_msg_count(name), 7)
+
+            c = dao.claim_delivery_msgs(name, 'c')
+            self.assertEqual([(m['i'], retry_count) for _, m, retry_count in c], [(1, 1), (2, 0)])
+
+            # Messages whose lease has expired can be claimed by another worker.
+            dao.finish_delivery_msgs(name, 'b', release=[uid for uid, _, _ in b])
+            dao.finish_delivery_msgs(name, 'c', release=[uid for uid, _, _ in c])
+            d = dao.claim_delivery_msgs(name, 'd', lease_seconds=0.1)
+            self.assertEqual([m['i'] for _, m, _ in d], [1, 2, 3, 4, 5, 6, 7])
+            self.assertEqual(len(dao.claim_delivery_msgs(name, 'e')), 0)
+            time.sleep(0.2)
+            e = dao.claim_delivery_msgs(name, 'e')
+            self.assertEqual([uid for uid, _, _ in e], [uid for uid, _, _ in d])
+
+            dao.finish_delivery_msgs(name, 'e', remove=[uid for uid, _, _ in e])
+            self.assertEqual(dao.get_delivery_msg_count(name), 0)
+        finally:
+            with dao._get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(f'drop table {name}_delivery_q')
+            dao.free_conn(conn)
+
+    def test_delivery_retry_backoff(self):
+        name = 'test_' + os.urandom(4).hex()
+        dao.create_delivery_table(name)
+        try:
+            self.assertIsNone(dao.get_delivery_wait(name))
+            for i in range(3):
+                dao.add_delivery_msg(name, {'i': i})
+
+            self.assertEqual(dao.get_delivery_wait(name), 0.0)
+
+            a = dao.claim_delivery_msgs(name, 'a', batch_size=1)
+            dao.finish_delivery_msgs(name, 'a', retry=[a[0][0]], backoff_base=0.5)
+
+            # The message being retried does not block the ones behind it.
+            b = dao.claim_delivery_msgs(name, 'b')
+            self.assertEqual([m['i'] for _, m, _ in b], [1, 2])
+            dao.finish_delivery_msgs(name, 'b', remove=[uid for uid, _, _ in b])
+            self.assertEqual(len(dao.claim_delivery_msgs(name, 'b')), 0)
+
+            wait = dao.get_delivery_wait(name)
+            self.assertGreater(wait, 0.0)
+            self.assertLessEqual(wait, 0.5)
+
+            time.sleep(0.6)
+            c = dao.claim_delivery_msgs(name, 'c')
+            self.assertEqual([(m['i'], retry_count) for _, m, retry_count in c], [(0, 1)])
+
+            # The second retry waits backoff_base * backoff_factor seconds, limited to backoff_max.
+            dao.finish_delivery_msgs(name, 'c', retry=[c[0][0]], backoff_base=0.5, backoff_factor=10, backoff_max=1.0)
+            time.sleep(0.6)
+            self.assertEqual(len(dao.claim_delivery_msgs(name, 'd')), 0)
+            time.sleep(0.6)
+            d = dao.claim_delivery_msgs(name, 'd')
+            self.assertEqual(len(d), 1)
+
+            # Deferred messages wait without their retry count being incremented.
+            dao.finish_delivery_msgs(name, 'd', defer=[d[0][0]], defer_seconds=0.5)
+            self.assertEqual(len(dao.claim_delivery_msgs(name, 'e')), 0)
+            time.sleep(0.6)
+            e = dao.claim_delivery_msgs(name, 'e')
+            self.assertEqual([retry_count for _, _, retry_count in e], [2])
+        finally:
+            with dao._get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(f'drop table {name}_delivery_q')
+            dao.free_conn(conn)
+
+    def test_delivery_references(self):
+        dev, new_dev = self._create_physical_device()
+
+        msgs = []
+        for i in range(3):
+            msgs.append({
+                BrokerConstants.PHYSICAL_DEVICE_UID_KEY: new_dev.uid,
+                BrokerConstants.LOGICAL_DEVICE_UID_KEY: 40 + i,
+                BrokerConstants.TIMESTAMP_KEY: f'2023-02-20T07:5{i}:52Z',
+                BrokerConstants.TIMESERIES_KEY: [{'name': 'x', 'value': i}],
+                BrokerConstants.CORRELATION_ID_KEY: str(uuid.uuid4())
+            })
+
+        pts_uids = dao.insert_physical_timeseries_messages(msgs)
+
+        name = 'test_' + os.urandom(4).hex()
+        dao.create_delivery_table(name)
+        try:
+            # Referenced and copied messages can share a delivery table.
+            dao.add_delivery_msgs(name, msgs, [pts_uids[0], None, pts_uids[2]])
+
+            with dao._get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(f'select json_msg is null from {name}_delivery_q order by uid')
+                self.assertEqual([row[0] for row in cursor.fetchall()], [True, False, True])
+            dao.free_conn(conn)
+
+            # Messages for excluded logical devices are skipped whether referenced or copied.
+            a = dao.claim_delivery_msgs(name, 'a', exclude_l_uids=[40, 41])
+            self.assertEqual([msg for _, msg, _ in a], [msgs[2]])
+
+            b = dao.claim_delivery_msgs(name, 'b')
+            self.assertEqual([msg for _, msg, _ in b], msgs[:2])
+
+            # A reference to a row that no longer exists is returned as None.
+            dao.add_delivery_msgs(name, [msgs[0]], [-1])
+            c = dao.claim_delivery_msgs(name, 'c')
+            self.assertEqual([msg for _, msg, _ in c], [None])
+        finally:
+            with dao._get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(f'drop table {name}_delivery_q')
+            dao.free_conn(conn)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,272 @@
+import datetime, logging, threading, time, unittest
+
+import BrokerConstants
+from delivery.BaseWriter import BaseWriter, DeliveryItem
+from delivery.CircuitBreaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from delivery.DeliveryLanes import DeliveryLanes
+from delivery.DeliveryPolicies import COALESCED, DEADBAND, INTERVAL, DeliveryPolicies
+from pdmodels.Models import LogicalDevice
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
+
+
+_base_ts = datetime.datetime(2024, 5, 10, 10, 0, tzinfo=datetime.timezone.utc)
+
+
+def _msg(minutes: float, **values) -> dict:
+    return {
+        BrokerConstants.TIMESTAMP_KEY: (_base_ts + datetime.timedelta(minutes=minutes)).isoformat(),
+        BrokerConstants.TIMESERIES_KEY: [{'name': name, 'value': value} for name, value in values.items()],
+    }
+
+
+class TestDeliveryLanes(unittest.TestCase):
+
+    def test_device_order_and_fairness(self):
+        lanes = DeliveryLanes(1)
+        for i in range(5):
+            lanes.put(1, f'a{i}')
+        lanes.put(2, 'b0')
+
+        # Devices are served in turn, each device's messages in order.
+        self.assertEqual(lanes.take(0, 2), (1, ['a0', 'a1']))
+        self.assertEqual(lanes.take(0, 2), (2, ['b0']))
+        self.assertEqual(lanes.take(0, 2), (1, ['a2', 'a3']))
+
+        # A device that arrives later is served before the busy device's next turn.
+        lanes.put(3, 'c0')
+        self.assertEqual(lanes.take(0, 2), (1, ['a4']))
+        self.assertEqual(lanes.take(0, 2), (3, ['c0']))
+
+    def test_devices_stay_in_their_lane(self):
+        lanes = DeliveryLanes(4)
+        for l_uid in range(20):
+            lanes.put(l_uid, l_uid)
+
+        for lane in range(4):
+            while lanes.stats()['depth'][lane] > 0:
+                l_uid, items = lanes.take(lane, 10)
+                self.assertEqual(lanes.lane_of(l_uid), lane)
+                self.assertEqual(items, [l_uid])
+                lanes.done(l_uid, len(items))
+
+        self.assertEqual(lanes.in_flight(), 0)
+        self.assertEqual(sum(lanes.stats()['delivered']), 20)
+
+    def test_depth_and_busy_devices(self):
+        lanes = DeliveryLanes(2)
+        for i in range(3):
+            lanes.put(1, i)
+        lanes.put(2, 0)
+
+        self.assertEqual(lanes.in_flight(), 4)
+        self.assertEqual(lanes.busy_devices(3), [1])
+
+        # Messages being delivered still count until done() is called.
+        l_uid, items = lanes.take(lanes.lane_of(1), 3)
+        self.assertEqual(lanes.busy_devices(3), [1])
+        lanes.done(l_uid, len(items))
+        self.assertEqual(lanes.busy_devices(3), [])
+        self.assertEqual(lanes.in_flight(), 1)
+
+    def test_close(self):
+        lanes = DeliveryLanes(1)
+        results = []
+        t = threading.Thread(target=lambda: results.append(lanes.take(0, 1)))
+        t.start()
+        time.sleep(0.1)
+
+        # A waiting take() returns None when the lanes are closed, and queued items are returned.
+        self.assertEqual(lanes.close(), [])
+        t.join(1)
+        self.assertEqual(results, [None])
+
+        lanes = DeliveryLanes(1)
+        lanes.put(1, 'a')
+        lanes.put(2, 'b')
+        self.assertEqual(sorted(lanes.close()), ['a', 'b'])
+        self.assertIsNone(lanes.take(0, 1))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_transitions(self):
+        changes = []
+        breaker = CircuitBreaker('test', threshold=2, open_seconds=0.1, max_open_seconds=0.3, on_change=changes.append)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+        # A success resets the count of consecutive failures.
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.wait_time(), 0.0)
+
+        # Once the open time has passed, a single probe is allowed.
+        time.sleep(0.11)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+        # A failed probe opens the breaker for twice as long.
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.open_for, 0.2)
+        time.sleep(0.11)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+
+        # The open time is limited to max_open_seconds.
+        breaker.failure()
+        self.assertEqual(breaker.open_for, 0.3)
+        time.sleep(0.31)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.open_for, 0.3)
+
+        # A successful probe closes the breaker and resets the open time.
+        time.sleep(0.31)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.open_for, 0.1)
+        self.assertEqual(breaker.wait_time(), 0.0)
+
+        self.assertEqual(changes, [OPEN, HALF_OPEN, OPEN, HALF_OPEN, OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED])
+        self.assertEqual(breaker.stats()['times_opened'], 4)
+
+    def test_no_result_allows_another_probe(self):
+        breaker = CircuitBreaker('test', threshold=1, open_seconds=0.05, max_open_seconds=1)
+        breaker.failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.no_result()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+    def test_threshold_zero_never_opens(self):
+        breaker = CircuitBreaker('test', threshold=0, open_seconds=1, max_open_seconds=1)
+        for _ in range(100):
+            breaker.failure()
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+
+class TestDeliveryPolicies(unittest.TestCase):
+
+    def _sent(self, policies: DeliveryPolicies, properties: dict, msgs: list) -> list:
+        """
+        Filter the messages one at a time, as if each was claimed on its own, and return the
+        indexes of those sent.
+        """
+        sent = []
+        for i, msg in enumerate(msgs):
+            send, _ = policies.filter([(i, 1, properties, msg)])
+            for key in send:
+                policies.delivered(1, msg)
+                sent.append(key)
+
+        return sent
+
+    def test_no_policy(self):
+        policies = DeliveryPolicies('test')
+        self.assertIsNone(policies.policy_for({}))
+        self.assertIsNone(policies.policy_for({BrokerConstants.DELIVERY_POLICY_KEY: {'min_interval': 'x'}}))
+        self.assertEqual(self._sent(policies, {}, [_msg(i, x=1) for i in range(5)]), list(range(5)))
+
+    def test_min_interval(self):
+        policies = DeliveryPolicies('test')
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'min_interval': 900}}
+        self.assertEqual(self._sent(policies, properties, [_msg(i, x=1) for i in range(20)]), [0, 15])
+        self.assertEqual(policies.stats()['suppressed'][INTERVAL], 18)
+
+    def test_deadband(self):
+        policies = DeliveryPolicies('test')
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'deadband': {'x': 0.5, '*': 10}}}
+        msgs = [_msg(0, x=1.0, y=0), _msg(1, x=1.4, y=5), _msg(2, x=1.6, y=5), _msg(3, x=1.7, y=16), _msg(4, x=1.7, y=16, z='on')]
+        self.assertEqual(self._sent(policies, properties, msgs), [0, 2, 3, 4])
+        self.assertEqual(policies.stats()['suppressed'][DEADBAND], 1)
+
+    def test_interval_or_deadband(self):
+        policies = DeliveryPolicies('test')
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'min_interval': 600, 'deadband': 1}}
+        msgs = [_msg(0, x=0), _msg(5, x=0.5), _msg(6, x=2), _msg(11, x=2), _msg(16, x=2.5)]
+        self.assertEqual(self._sent(policies, properties, msgs), [0, 2, 4])
+
+    def test_coalesce(self):
+        policies = DeliveryPolicies('test')
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'coalesce': True}}
+        items = [(i, 1, properties, _msg(m, x=i)) for i, m in enumerate([2, 0, 3, 1])]
+        items.append((4, 2, {}, _msg(0, x=0)))
+
+        send, suppressed = policies.filter(items)
+        self.assertEqual(send, [2, 4])
+        self.assertEqual(sorted(suppressed), [(0, COALESCED), (1, COALESCED), (3, COALESCED)])
+
+    def test_writer_override(self):
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'min_interval': 900, 'ubidots': {'min_interval': 0}}}
+        self.assertIsNone(DeliveryPolicies('ubidots').policy_for(properties))
+        self.assertEqual(DeliveryPolicies('databolt').policy_for(properties).min_interval, 900)
+
+    def test_invalid_timestamp_is_sent(self):
+        policies = DeliveryPolicies('test')
+        properties = {BrokerConstants.DELIVERY_POLICY_KEY: {'min_interval': 900}}
+        msg = _msg(1, x=1)
+        msg[BrokerConstants.TIMESTAMP_KEY] = 'x'
+        self.assertEqual(self._sent(policies, properties, [_msg(0, x=1), msg]), [0, 1])
+
+
+class TestSplitBatches(unittest.TestCase):
+
+    def _items(self, l_uids: list, size: int = 10) -> list:
+        return [(i, DeliveryItem(None, LogicalDevice(uid=l_uid, name='x'), {'i': i, 'pad': 'x' * size}, 0)) for i, l_uid in enumerate(l_uids)]
+
+    def test_max_items_by_device(self):
+        writer = BaseWriter('test')
+        writer.batch_max_items = 2
+        writer.batch_by_logical_device = True
+
+        batches = writer._split_batches(self._items([1, 2, 1, 1, 2]))
+        self.assertEqual([[uid for uid, _ in batch] for batch in batches], [[0, 2], [3], [1, 4]])
+
+    def test_max_bytes(self):
+        writer = BaseWriter('test')
+        writer.batch_max_items = 100
+        writer.batch_by_logical_device = False
+        writer.batch_max_bytes = 70
+
+        # Each message is about 30 bytes, and a message larger than the limit has a batch of its own.
+        items = self._items([1, 2, 3, 4])
+        items.insert(2, (9, DeliveryItem(None, LogicalDevice(uid=5, name='x'), {'pad': 'x' * 100}, 0)))
+        batches = writer._split_batches(items)
+        self.assertEqual([[uid for uid, _ in batch] for batch in batches], [[0, 1], [9], [2, 3]])
+
+    def test_held_while_breaker_not_closed(self):
+        writer = BaseWriter('test')
+        writer.breaker = CircuitBreaker('test', threshold=1, open_seconds=0.05, max_open_seconds=1)
+        self.assertFalse(writer._held([1, 2], None))
+
+        writer.breaker.failure()
+        self.assertTrue(writer._held([1, 2], None))
+
+        # Only the probe is delivered while the breaker is half-open.
+        time.sleep(0.06)
+        self.assertTrue(writer.breaker.allow())
+        self.assertTrue(writer._held([1, 2], None))
+        self.assertTrue(writer._held([1, 2], 3))
+        self.assertFalse(writer._held([3], 3))
+
+        writer.breaker.success()
+        self.assertFalse(writer._held([1, 2], None))
+        writer.keep_running = False
+        self.assertTrue(writer._held([1, 2], None))
@@ -0,0 +1,78 @@
+import logging, time, unittest
+
+import api.client.DAO as dao
+import api.client.DeviceCache as device_cache
+from pdmodels.Models import PhysicalDevice, PhysicalToLogicalMapping, LogicalDevice
+import test_utils as tu
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
+
+
+def _wait_for(predicate, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if predicate():
+            return True
+        time.sleep(0.05)
+
+    return False
+
+
+class TestDeviceCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        device_cache.start()
+        if not _wait_for(device_cache.is_active):
+            raise RuntimeError('Device cache listener did not connect.')
+
+    @classmethod
+    def tearDownClass(cls):
+        device_cache.stop()
+
+    def setUp(self):
+        with dao.get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''truncate physical_logical_map;
+            truncate physical_devices cascade;
+            truncate logical_devices cascade;''')
+
+        device_cache.invalidate_all()
+
+        self.pd = dao.create_physical_device(PhysicalDevice(source_name='ttn', name='Cached PD', source_ids={'x': 1}))
+        self.ld = dao.create_logical_device(LogicalDevice(name='Cached LD'))
+
+    def test_device_invalidation(self):
+        self.assertEqual(device_cache.get_physical_device(self.pd.uid), self.pd)
+        self.assertEqual(device_cache.get_logical_device(self.ld.uid), self.ld)
+
+        # Modifying the returned copy must not affect the cache.
+        device_cache.get_logical_device(self.ld.uid).name = 'Modified copy'
+        self.assertEqual(device_cache.get_logical_device(self.ld.uid).name, 'Cached LD')
+
+        self.ld.name = 'Renamed LD'
+        dao.update_logical_device(self.ld)
+        self.assertTrue(_wait_for(lambda: device_cache.get_logical_device(self.ld.uid).name == 'Renamed LD'))
+
+        self.pd.name = 'Renamed PD'
+        dao.update_physical_device(self.pd)
+        self.assertTrue(_wait_for(lambda: device_cache.get_physical_device(self.pd.uid).name == 'Renamed PD'))
+
+        dao.delete_logical_device(self.ld.uid)
+        self.assertTrue(_wait_for(lambda: device_cache.get_logical_device(self.ld.uid) is None))
+
+    def test_mapping_invalidation(self):
+        self.assertIsNone(device_cache.get_current_device_mapping(self.pd.uid))
+
+        dao.insert_mapping(PhysicalToLogicalMapping(pd=self.pd, ld=self.ld, start_time=tu.now()))
+        self.assertTrue(_wait_for(lambda: device_cache.get_current_device_mapping(self.pd.uid) is not None))
+        self.assertEqual(device_cache.get_current_device_mapping(self.pd.uid).ld.uid, self.ld.uid)
+
+        dao.toggle_device_mapping(False, pd=self.pd.uid)
+        self.assertTrue(_wait_for(lambda: device_cache.get_current_device_mapping(self.pd.uid).is_active is False))
+
+        dao.end_mapping(pd=self.pd.uid)
+        self.assertTrue(_wait_for(lambda: device_cache.get_current_device_mapping(self.pd.uid) is None))
+
+
+if __name__ == '__main__':
+    unittest.main()
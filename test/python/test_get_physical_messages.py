@@ -189,3 +189,50 @@ def test_invalid_start_end(test_client):
 def test_invalid_count_end(test_client):
     response = test_client.get(f'/broker/api/messages/', params={'p_uid': pd.uid, 'count': 1, 'end': timestamps[4]})
     assert response.status_code == 422
+
+
+def test_stream(test_client):
+    # Streaming is not limited to 65536 messages, so all 65537 are returned.
+    response = test_client.get(f'/broker/api/messages', params={'p_uid': pd.uid, 'stream': True})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+
+    streamed = [json.loads(line) for line in response.iter_lines() if line]
+    assert len(streamed) == len(msgs)
+    for a, b in zip(streamed, msgs):
+        _test_id_and_ts(a, b)
+
+
+def test_stream_ascending_count(test_client):
+    response = test_client.get(f'/broker/api/messages', params={'p_uid': pd.uid, 'stream': True, 'ascending': True, 'count': 10})
+    assert response.status_code == 200
+
+    streamed = [json.loads(line) for line in response.iter_lines() if line]
+    assert len(streamed) == 10
+    for a, b in zip(streamed, reversed(msgs)):
+        _test_id_and_ts(a, b)
+
+
+def test_stream_busy(test_client):
+    # Hold every streaming connection slot so the next stream is refused.
+    held = 0
+    while dao._stream_slots.acquire(blocking=False):
+        held += 1
+
+    try:
+        response = test_client.get(f'/broker/api/messages', params={'p_uid': pd.uid, 'stream': True})
+        assert response.status_code == 503
+    finally:
+        for _ in range(held):
+            dao._stream_slots.release()
+
+    response = test_client.get(f'/broker/api/messages', params={'p_uid': pd.uid, 'stream': True, 'count': 1})
+    assert response.status_code == 200
+
+
+def test_dao_stream_itersize(create_msgs):
+    streamed = dao.stream_physical_timeseries_message(p_uid=pd.uid, start=timestamps[100], itersize=7)
+    for a, b in zip(streamed, msgs[:100]):
+        _test_id_and_ts(a, b)
+
+    assert len(list(dao.stream_physical_timeseries_message(p_uid=pd.uid, start=timestamps[100], itersize=7))) == 100
@@ -0,0 +1,75 @@
+import asyncio, logging, time, unittest
+
+import api.client.DAO as dao
+import api.client.TokenCache as token_cache
+import test_utils as tu
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
+
+
+def _wait_for(predicate, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if predicate():
+            return True
+        time.sleep(0.05)
+
+    return False
+
+
+def _get_user(token: str):
+    return asyncio.run(token_cache.get_user(token))
+
+
+class TestTokenCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        token_cache.start()
+        if not _wait_for(token_cache.is_active):
+            raise RuntimeError('Token cache listener did not connect.')
+
+    @classmethod
+    def tearDownClass(cls):
+        token_cache.stop()
+
+    def setUp(self):
+        self.user = tu.create_test_user()
+
+    def tearDown(self):
+        dao.user_rm(self.user.username)
+
+    def test_token_changes_invalidate(self):
+        self.assertEqual(_get_user(self.user.auth_token), self.user)
+        self.assertIsNone(_get_user('not a token'))
+
+        dao.token_disable(self.user.username)
+        self.assertTrue(_wait_for(lambda: _get_user(self.user.auth_token).valid is False))
+
+        dao.token_enable(self.user.username)
+        self.assertTrue(_wait_for(lambda: _get_user(self.user.auth_token).valid is True))
+
+        dao.token_refresh(self.user.username)
+        self.assertTrue(_wait_for(lambda: _get_user(self.user.auth_token) is None))
+
+        token = dao.user_get_token(self.user.username, 'password')
+        new_token = dao.user_change_password_and_token('new password', token)
+        self.assertTrue(_wait_for(lambda: _get_user(token) is None))
+        self.assertEqual(_get_user(new_token).uid, self.user.uid)
+
+    def test_invalidate_token(self):
+        self.assertTrue(_get_user(self.user.auth_token).valid)
+
+        # A change that sends no notification is only seen after a direct invalidation.
+        with dao.get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('alter table users disable trigger users_notify_trigger')
+            cursor.execute('update users set read_only = not read_only where uid = %s', (self.user.uid, ))
+            cursor.execute('alter table users enable trigger users_notify_trigger')
+
+        self.assertEqual(_get_user(self.user.auth_token).read_only, self.user.read_only)
+        token_cache.invalidate_token(self.user.auth_token)
+        self.assertEqual(_get_user(self.user.auth_token).read_only, not self.user.read_only)
+
+
+if __name__ == '__main__':
+    unittest.main()